@@ -22,12 +22,15 @@ from hanser.train.cls import SuperLearner
 
 HEIGHT = WIDTH = 768
 IGNORE_LABEL = 255
+# False for TFRecords converted with --map_label, which already store train ids
+MAP_LABEL = True
 
 @curry
 def preprocess(example, crop_h=HEIGHT, crop_w=WIDTH, ignore_label=IGNORE_LABEL, training=True):
     image, label = decode(example)
     label = tf.cast(label, tf.int32)
-    label = map_label(label)
+    if MAP_LABEL:
+        label = map_label(label)
 
     mean_rgb = tf.convert_to_tensor([123.68, 116.779, 103.939], tf.float32)
     std_rgb = tf.convert_to_tensor([58.393, 57.12, 57.375], tf.float32)
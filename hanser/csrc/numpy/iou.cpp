@@ -6,6 +6,7 @@
 #include <iostream>
 #include <numeric>
 #include <random>
+#include <stdexcept>
 #include <tuple>
 #include <vector>
 
@@ -164,6 +165,191 @@ template <typename T> double giou_11(const T *box1, const T *box2) {
     return giou;
 }
 
+
+inline double iou_nonzero(const double *a, const double *b) {
+    // Same as `hanser.detection.eval.iou_mn`, 0 if boxes do not intersect
+    double h = max(min(a[2], b[2]) - max(a[0], b[0]), 0.0);
+    double w = max(min(a[3], b[3]) - max(a[1], b[1]), 0.0);
+    double inter = h * w;
+    if (inter == 0) {
+        return 0;
+    }
+    double area_a = (a[2] - a[0]) * (a[3] - a[1]);
+    double area_b = (b[2] - b[0]) * (b[3] - b[1]);
+    return inter / (area_a + area_b - inter);
+}
+
+double average_precision_pr(const vector<double> &precision,
+                            const vector<double> &recall, bool use_07_metric) {
+    int64_t n = precision.size();
+    double ap = 0;
+    if (use_07_metric) {
+        loop(k, 11) {
+            double t = k * 0.1;
+            double p = 0;
+            loop(i, n) {
+                if (recall[i] >= t) {
+                    p = max(p, precision[i]);
+                }
+            }
+            ap += p / 11;
+        }
+        return ap;
+    }
+    vector<double> mrec(n + 2), mpre(n + 2);
+    mrec[0] = 0;
+    mpre[0] = 0;
+    loop(i, n) {
+        mrec[i + 1] = recall[i];
+        mpre[i + 1] = precision[i];
+    }
+    mrec[n + 1] = 1;
+    mpre[n + 1] = 0;
+    for (int64_t i = n + 1; i > 0; i--) {
+        mpre[i - 1] = max(mpre[i - 1], mpre[i]);
+    }
+    for (int64_t i = 1; i < n + 2; i++) {
+        if (mrec[i] != mrec[i - 1]) {
+            ap += (mrec[i] - mrec[i - 1]) * mpre[i];
+        }
+    }
+    return ap;
+}
+
+// Per-class AP of detections against ground truths, with the same matching as
+// `hanser.detection.eval.average_precision`. Image ids and labels are integers,
+// bboxes are [n, 4] in the same coordinate order for detections and gts.
+tuple<vector<int64_t>, vector<double>>
+average_precision(const int64_t *dt_image_ids, const int64_t *dt_labels,
+                  const double *dt_scores, const double *dt_bboxes, int64_t n_dts,
+                  const int64_t *gt_image_ids, const int64_t *gt_labels,
+                  const double *gt_bboxes, const bool *gt_difficult, int64_t n_gts,
+                  double iou_threshold, bool use_07_metric, bool ignore_difficult) {
+
+    // Group gts by (label, image), keeping their order
+    vector<int64_t> gt_order(n_gts);
+    iota(gt_order.begin(), gt_order.end(), 0);
+    stable_sort(gt_order.begin(), gt_order.end(), [&](int64_t a, int64_t b) {
+        if (gt_labels[a] != gt_labels[b]) return gt_labels[a] < gt_labels[b];
+        return gt_image_ids[a] < gt_image_ids[b];
+    });
+
+    vector<int64_t> dt_order(n_dts);
+    iota(dt_order.begin(), dt_order.end(), 0);
+    stable_sort(dt_order.begin(), dt_order.end(), [&](int64_t a, int64_t b) {
+        return dt_labels[a] < dt_labels[b];
+    });
+
+    vector<int64_t> classes;
+    vector<double> aps;
+    vector<char> seen(n_gts, 0);
+    int64_t gi = 0, di = 0;
+    while (gi < n_gts) {
+        int64_t c = gt_labels[gt_order[gi]];
+        int64_t g_end = gi;
+        while (g_end < n_gts && gt_labels[gt_order[g_end]] == c) g_end++;
+
+        // (image -> range of gt_order) of this class
+        vector<int64_t> img_starts;
+        for (int64_t k = gi; k < g_end; k++) {
+            if (k == gi || gt_image_ids[gt_order[k]] != gt_image_ids[gt_order[k - 1]]) {
+                img_starts.push_back(k);
+            }
+        }
+        img_starts.push_back(g_end);
+
+        int64_t n_positive = 0;
+        for (int64_t k = gi; k < g_end; k++) {
+            if (!(ignore_difficult && gt_difficult[gt_order[k]])) n_positive++;
+        }
+
+        while (di < n_dts && dt_labels[dt_order[di]] < c) di++;
+        int64_t d_end = di;
+        while (d_end < n_dts && dt_labels[dt_order[d_end]] == c) d_end++;
+
+        classes.push_back(c);
+        if (d_end == di) {
+            aps.push_back(0);
+            gi = g_end;
+            continue;
+        }
+
+        // Sort by descending scores, ties are ordered by the first detection of
+        // their images and then by their indices, like grouping and stable sorting
+        vector<int64_t> dts(dt_order.begin() + di, dt_order.begin() + d_end);
+        vector<pair<int64_t, int64_t>> first_seen;
+        {
+            vector<int64_t> by_image(dts);
+            stable_sort(by_image.begin(), by_image.end(), [&](int64_t a, int64_t b) {
+                return dt_image_ids[a] < dt_image_ids[b];
+            });
+            for (size_t k = 0; k < by_image.size(); k++) {
+                if (k == 0 || dt_image_ids[by_image[k]] != dt_image_ids[by_image[k - 1]]) {
+                    first_seen.emplace_back(dt_image_ids[by_image[k]], by_image[k]);
+                }
+            }
+        }
+        auto image_rank = [&](int64_t image_id) {
+            return lower_bound(first_seen.begin(), first_seen.end(), make_pair(image_id, (int64_t)-1))->second;
+        };
+        vector<int64_t> ranks(dts.size());
+        loop(k, (int64_t)dts.size()) { ranks[k] = image_rank(dt_image_ids[dts[k]]); }
+        vector<int64_t> order(dts.size());
+        iota(order.begin(), order.end(), 0);
+        sort(order.begin(), order.end(), [&](int64_t a, int64_t b) {
+            double sa = dt_scores[dts[a]], sb = dt_scores[dts[b]];
+            if (sa != sb) return sa > sb;
+            if (ranks[a] != ranks[b]) return ranks[a] < ranks[b];
+            return dts[a] < dts[b];
+        });
+
+        int64_t n = dts.size();
+        vector<double> precision(n), recall(n);
+        int64_t acc_tp = 0, acc_fp = 0;
+        loop(k, n) {
+            int64_t d = dts[order[k]];
+            int64_t image_id = dt_image_ids[d];
+            bool tp = false, fp = false;
+            auto it = lower_bound(img_starts.begin(), img_starts.end() - 1, image_id,
+                                  [&](int64_t start, int64_t id) { return gt_image_ids[gt_order[start]] < id; });
+            if (it == img_starts.end() - 1 || gt_image_ids[gt_order[*it]] != image_id) {
+                fp = true;
+            } else {
+                int64_t j_max = -1;
+                double iou_max = 0;
+                for (int64_t j = *it; j < *(it + 1); j++) {
+                    double iou = iou_nonzero(dt_bboxes + 4 * d, gt_bboxes + 4 * gt_order[j]);
+                    if (j_max == -1 || iou > iou_max) {
+                        j_max = j;
+                        iou_max = iou;
+                    }
+                }
+                int64_t g = gt_order[j_max];
+                if (iou_max > iou_threshold) {
+                    if (!(ignore_difficult && gt_difficult[g])) {
+                        if (!seen[g]) {
+                            tp = true;
+                            seen[g] = 1;
+                        } else {
+                            fp = true;
+                        }
+                    }
+                } else {
+                    fp = true;
+                }
+            }
+            acc_tp += tp;
+            acc_fp += fp;
+            recall[k] = n_positive > 0 ? (double)acc_tp / n_positive : 0;
+            precision[k] = acc_tp / (acc_fp + acc_tp + 1e-10);
+        }
+        aps.push_back(n_positive > 0 ? average_precision_pr(precision, recall, use_07_metric) : 0);
+        gi = g_end;
+        di = d_end;
+    }
+    return make_tuple(classes, aps);
+}
+
 template <typename T>
 py::array_t<T>
 Py_iou_mm(py::array_t<T, py::array::c_style | py::array::forcecast> boxes) {
@@ -190,6 +376,35 @@ T Py_iou_11(py::array_t<T, py::array::c_style | py::array::forcecast> box1,
     return iou_11(box1.data(), box2.data());
 }
 
+using int_array = py::array_t<int64_t, py::array::c_style | py::array::forcecast>;
+using float_array = py::array_t<double, py::array::c_style | py::array::forcecast>;
+using bool_array = py::array_t<bool, py::array::c_style | py::array::forcecast>;
+
+py::tuple Py_average_precision(int_array dt_image_ids, int_array dt_labels,
+                               float_array dt_scores, float_array dt_bboxes,
+                               int_array gt_image_ids, int_array gt_labels,
+                               float_array gt_bboxes, bool_array gt_difficult,
+                               double iou_threshold, bool use_07_metric,
+                               bool ignore_difficult) {
+    int64_t n_dts = dt_image_ids.size();
+    int64_t n_gts = gt_image_ids.size();
+    if (dt_labels.size() != n_dts || dt_scores.size() != n_dts || dt_bboxes.size() != 4 * n_dts)
+        throw std::invalid_argument("Detections must have the same number of elements");
+    if (gt_labels.size() != n_gts || gt_difficult.size() != n_gts || gt_bboxes.size() != 4 * n_gts)
+        throw std::invalid_argument("Ground truths must have the same number of elements");
+    vector<int64_t> classes;
+    vector<double> aps;
+    {
+        py::gil_scoped_release release;
+        tie(classes, aps) = average_precision(
+            dt_image_ids.data(), dt_labels.data(), dt_scores.data(), dt_bboxes.data(), n_dts,
+            gt_image_ids.data(), gt_labels.data(), gt_bboxes.data(), gt_difficult.data(), n_gts,
+            iou_threshold, use_07_metric, ignore_difficult);
+    }
+    return py::make_tuple(py::array_t<int64_t>(classes.size(), classes.data()),
+                          py::array_t<double>(aps.size(), aps.data()));
+}
+
 PYBIND11_MODULE(_numpy, m) {
     m.def("iou_mm", &Py_iou_mm<double>,
           "Calculate ious for boxes with themselves.");
@@ -199,4 +414,10 @@ PYBIND11_MODULE(_numpy, m) {
     m.def("iou_mn", &Py_iou_mn<float>, "iou_mn");
     m.def("iou_11", &Py_iou_11<double>, "iou_11");
     m.def("iou_11", &Py_iou_11<float>, "iou_11");
-}
\ No newline at end of file
+    m.def("average_precision", &Py_average_precision,
+          "Per-class average precision of detections against ground truths.",
+          py::arg("dt_image_ids"), py::arg("dt_labels"), py::arg("dt_scores"), py::arg("dt_bboxes"),
+          py::arg("gt_image_ids"), py::arg("gt_labels"), py::arg("gt_bboxes"), py::arg("gt_difficult"),
+          py::arg("iou_threshold") = 0.5, py::arg("use_07_metric") = true,
+          py::arg("ignore_difficult") = true);
+}
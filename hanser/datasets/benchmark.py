@@ -0,0 +1,246 @@
+"""Measure and tune the throughput of input pipelines.
+
+Examples:
+    >>> from hanser.datasets.imagenet import make_imagenet_dataset, make_imagenet_transform
+    >>> make_dataset = functools.partial(
+    ...     make_imagenet_dataset, 256, 256, make_imagenet_transform(), data_dir=data_dir)
+    >>> best, results = sweep(make_dataset, {
+    ...     'cycle_length': [8, 16, 32],
+    ...     'shuffle_buffer': [2500, 10000],
+    ...     'num_parallel_calls': [16, 32, AUTOTUNE],
+    ...     'threadpool_size': [None, 32, 64],
+    ...     'prefetch': [True, 2, 8],
+    ... })
+
+or from the command line:
+
+    python -m hanser.datasets.benchmark imagenet --data-dir gs://... --batch-size 256
+
+Per-transformation statistics of `tf.data` are not computed here, pass `trace_dir`
+to trace the best config and see them in the Input Pipeline Analyzer of TensorBoard.
+"""
+import os
+import time
+import inspect
+import argparse
+import functools
+
+import numpy as np
+
+import tensorflow as tf
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# Options applied on the dataset returned by the factory
+DATASET_OPTIONS = ['threadpool_size']
+
+
+def with_threadpool(ds, threadpool_size):
+    options = tf.data.Options()
+    threading = getattr(options, 'threading', None) or options.experimental_threading
+    threading.private_threadpool_size = threadpool_size
+    return ds.with_options(options)
+
+
+def _batch_size(batch):
+    x = tf.nest.flatten(batch)[0]
+    return int(x.shape[0]) if len(x.shape) else 1
+
+
+def benchmark(ds, num_batches=100, warmup=10, trace_dir=None):
+    """Steady-state throughput of `ds` and latency of getting each batch.
+
+    With `trace_dir`, the measured batches are traced by `tf.profiler`, the trace
+    includes the per-transformation statistics of `tf.data` (Input Pipeline Analyzer
+    in TensorBoard).
+    """
+    it = iter(ds)
+    for _ in range(warmup):
+        next(it)
+
+    if trace_dir is not None:
+        tf.profiler.experimental.start(trace_dir)
+    latencies = []
+    n_examples = 0
+    start = time.perf_counter()
+    try:
+        for _ in range(num_batches):
+            t = time.perf_counter()
+            batch = next(it)
+            latencies.append(time.perf_counter() - t)
+            n_examples += _batch_size(batch)
+    finally:
+        if trace_dir is not None:
+            tf.profiler.experimental.stop()
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'examples_per_sec': n_examples / elapsed,
+        'batches_per_sec': num_batches / elapsed,
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+        },
+    }
+
+
+def _accepts(fn, name):
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    params = inspect.signature(fn).parameters
+    return name in params or any(p.kind == p.VAR_KEYWORD for p in params.values())
+
+
+def benchmark_config(make_dataset, config, num_batches=100, warmup=10, trace_dir=None):
+    """Build the dataset with `make_dataset(**config)` and benchmark it.
+
+    `make_dataset` may return a dataset or a tuple whose first element is the
+    dataset to benchmark, like `make_imagenet_dataset`.
+    """
+    kwargs = {k: v for k, v in config.items() if k not in DATASET_OPTIONS}
+    ds = make_dataset(**kwargs)
+    if isinstance(ds, tuple):
+        ds = ds[0]
+    if config.get('threadpool_size') is not None:
+        ds = with_threadpool(ds, config['threadpool_size'])
+    return benchmark(ds, num_batches, warmup, trace_dir)
+
+
+def sweep(make_dataset, grid, base=None, num_batches=100, warmup=10, print_fn=print, trace_dir=None):
+    """Tune the options of `grid` (name -> candidate values) one at a time.
+
+    Each option is swept with the others fixed at the best values found so far,
+    starting from `base` or the first candidates. Options not accepted by
+    `make_dataset` are skipped, except `threadpool_size` which is set on the
+    returned dataset. With `trace_dir`, the best config is run once more and traced.
+
+    Returns:
+        The best config and a list of (config, result) of all runs.
+    """
+    grid = {
+        k: v for k, v in grid.items()
+        if k in DATASET_OPTIONS or _accepts(make_dataset, k)
+    }
+    best = {k: v[0] for k, v in grid.items()}
+    best.update(base or {})
+    best_result = None
+    results = []
+    for name, values in grid.items():
+        for value in values:
+            config = {**best, name: value}
+            if best_result is not None and value == best[name]:
+                continue
+            result = benchmark_config(make_dataset, config, num_batches, warmup)
+            results.append((config, result))
+            if print_fn:
+                print_fn("%s: %.1f examples/sec, p50 %.2f ms, p99 %.2f ms" % (
+                    config, result['examples_per_sec'], result['latency_ms']['p50'], result['latency_ms']['p99']))
+            if best_result is None or result['examples_per_sec'] > best_result['examples_per_sec']:
+                best, best_result = config, result
+    if print_fn:
+        print_fn("Best: %s, %.1f examples/sec" % (best, best_result['examples_per_sec']))
+    if trace_dir is not None:
+        benchmark_config(make_dataset, best, num_batches, warmup, trace_dir)
+    return best, results
+
+
+def _make_imagenet(args):
+    from hanser.datasets.imagenet import make_imagenet_dataset_split, get_filenames, make_imagenet_transform
+    filenames = get_filenames(args.data_dir, training=True)
+    if args.num_files:
+        filenames = filenames[:args.num_files]
+
+    def make_dataset(**kwargs):
+        return make_imagenet_dataset_split(
+            args.batch_size, make_imagenet_transform(), filenames, 'train', training=True, **kwargs)
+    grid = {
+        'cycle_length': [8, 16, 32, 64],
+        'shuffle_buffer': [2500, 10000, 40000],
+        'num_parallel_calls': [16, 32, 64, AUTOTUNE],
+        'threadpool_size': [None, 16, 32, 64],
+        'prefetch': [True, 2, 4, 8],
+    }
+    return make_dataset, grid
+
+
+def _make_cifar(args):
+    from hanser.datasets.classification.cifar import make_cifar10_dataset
+    from hanser.transform import random_crop, to_tensor
+
+    def transform(image, label, training):
+        if training:
+            image = random_crop(image, (32, 32), (4, 4))
+            image = tf.image.random_flip_left_right(image)
+        return to_tensor(image, label)
+
+    def make_dataset(**kwargs):
+        return make_cifar10_dataset(
+            args.batch_size, args.batch_size, lambda training: functools.partial(transform, training=training),
+            **kwargs)
+    grid = {
+        'num_parallel_calls': [4, 8, 16, AUTOTUNE],
+        'threadpool_size': [None, 8, 16, 32],
+        'prefetch': [True, 2, 4, 8],
+    }
+    return make_dataset, grid
+
+
+def _make_segmentation(args):
+    from hanser.datasets.segmentation.tfrecord import make_tfrecord_dataset, parse_tfexample_to_img_seg
+    from hanser.transform.segmentation import random_scale, pad, random_crop, flip_dim
+    train_files = sorted(tf.io.gfile.glob(os.path.join(args.data_dir, "train*")))
+    val_files = sorted(tf.io.gfile.glob(os.path.join(args.data_dir, "val*")))
+    if args.num_files:
+        train_files = train_files[:args.num_files]
+    crop_size = (args.crop_size, args.crop_size)
+
+    def transform(example):
+        example = parse_tfexample_to_img_seg(example)
+        image = tf.image.decode_image(example['image/encoded'], channels=3, expand_animations=False)
+        label = tf.image.decode_png(example['image/segmentation/class/encoded'], channels=1)
+        image, label = random_scale(tf.cast(image, tf.float32), label)
+        image, label = pad(image, label, crop_size, 0, 255)
+        image, label = random_crop([image, label], crop_size)
+        image, label = flip_dim([image, label])
+        return image, label
+
+    def make_dataset(**kwargs):
+        return make_tfrecord_dataset(
+            train_files, val_files, args.batch_size, args.batch_size, lambda training: transform, **kwargs)
+    grid = {
+        'buffer_size': [256, 1024, 4096],
+        'num_parallel_calls': [8, 16, 32, AUTOTUNE],
+        'threadpool_size': [None, 16, 32, 64],
+        'prefetch': [True, 2, 4, 8],
+    }
+    return make_dataset, grid
+
+
+DATASETS = {
+    'imagenet': _make_imagenet,
+    'cifar10': _make_cifar,
+    'segmentation': _make_segmentation,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune input pipeline options for throughput.")
+    parser.add_argument('dataset', choices=list(DATASETS))
+    parser.add_argument('--data-dir', type=str, default=None)
+    parser.add_argument('--num-files', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--num-batches', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--crop-size', type=int, default=512)
+    parser.add_argument('--trace-dir', type=str, default=None)
+    args = parser.parse_args()
+
+    make_dataset, grid = DATASETS[args.dataset](args)
+    sweep(make_dataset, grid, num_batches=args.num_batches, warmup=args.warmup, trace_dir=args.trace_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+import tensorflow as tf
+
+from hhutil.io import fmt_path
+
+from hanser.transform import resize
+
+
+def cache_key(*parts):
+    data = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def _downscale(short_side):
+    def fn(image, label):
+        shape = tf.shape(image)
+        shorter = tf.minimum(shape[0], shape[1])
+        image = tf.cond(shorter > short_side, lambda: resize(image, short_side), lambda: image)
+        return image, label
+    return fn
+
+
+def write_image_cache(ds, cache_dir, short_side=None, shard_bytes=1 << 30,
+                      log_interval=30, heartbeat=None):
+    """Write decoded (image, label) pairs of `ds` as uint8 shards to `cache_dir`.
+
+    Images are downscaled so that the shorter side is at most `short_side`. Each
+    shard is a raw byte file, `index.npy` holds (shard, offset, height, width,
+    channels) of every image. `meta.json` is written last and marks the cache as
+    complete, a partially written cache is never read. Progress is printed every
+    `log_interval` seconds, when `heartbeat` is also called.
+
+    Every writer writes to its own temporary dir which is renamed to `cache_dir`,
+    so processes building the same cache concurrently don't interfere. If a
+    complete cache already exists when the rename happens, it is kept (it may be
+    memory-mapped by another process) and this copy is discarded.
+    """
+    cache_dir = fmt_path(cache_dir)
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = fmt_path(tempfile.mkdtemp(prefix="_%s_tmp" % cache_dir.name, dir=cache_dir.parent))
+    os.chmod(tmp_dir, 0o755)
+    try:
+        _write_shards(ds, tmp_dir, short_side, shard_bytes, log_interval, heartbeat)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError as e:
+        # Renaming to a non-empty dir fails, another writer finished first
+        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST) or not (cache_dir / "meta.json").exists():
+            raise
+        shutil.rmtree(tmp_dir)
+
+
+def _write_shards(ds, tmp_dir, short_side, shard_bytes, log_interval, heartbeat):
+    if short_side is not None:
+        ds = ds.map(_downscale(short_side), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+    index, labels = [], []
+    shard, offset = 0, 0
+    start = last_log = time.time()
+    f = open(tmp_dir / ("%05d.bin" % shard), 'wb')
+    try:
+        for image, label in ds.as_numpy_iterator():
+            assert image.dtype == np.uint8 and image.ndim == 3
+            if offset + image.nbytes > shard_bytes and offset != 0:
+                f.close()
+                shard, offset = shard + 1, 0
+                f = open(tmp_dir / ("%05d.bin" % shard), 'wb')
+            f.write(image.tobytes())
+            index.append((shard, offset, *image.shape))
+            labels.append(label)
+            offset += image.nbytes
+            if time.time() - last_log >= log_interval:
+                last_log = time.time()
+                print('>> Cached %d images (%.2f GB) in %ds' % (
+                    len(index), (shard * shard_bytes + offset) / (1 << 30), last_log - start))
+                if heartbeat is not None:
+                    heartbeat()
+    finally:
+        f.close()
+
+    np.save(tmp_dir / "index.npy", np.array(index, dtype=np.int64).reshape(-1, 5))
+    np.save(tmp_dir / "labels.npy", np.stack(labels))
+    meta = {'num_examples': len(index), 'num_shards': shard + 1, 'short_side': short_side}
+    (tmp_dir / "meta.json").write_text(json.dumps(meta))
+
+
+def read_image_cache(cache_dir):
+    """Dataset of indices into a cache written by `write_image_cache`, and a function
+    mapping an index to the memory-mapped (image, label).
+
+    The index dataset is cheap to shuffle in full, and image bytes are only read
+    from the page cache when mapped.
+    """
+    cache_dir = fmt_path(cache_dir)
+    meta = json.loads((cache_dir / "meta.json").read_text())
+    index = np.load(cache_dir / "index.npy")
+    labels = np.load(cache_dir / "labels.npy")
+    shards = [
+        np.memmap(cache_dir / ("%05d.bin" % i), dtype=np.uint8, mode='r')
+        if os.path.getsize(cache_dir / ("%05d.bin" % i)) > 0 else np.zeros([0], np.uint8)
+        for i in range(meta['num_shards'])
+    ]
+    channels = int(index[0, 4]) if len(index) else None
+
+    def read(i):
+        shard, offset, h, w, c = index[i]
+        image = np.asarray(shards[shard][offset:offset + h * w * c]).reshape(h, w, c)
+        return image, labels[i]
+
+    def load(i):
+        image, label = tf.numpy_function(read, [i], (tf.uint8, tf.as_dtype(labels.dtype)))
+        image.set_shape([None, None, channels])
+        label.set_shape(labels.shape[1:])
+        return image, label
+
+    ds = tf.data.Dataset.range(meta['num_examples'])
+    return ds, load
+
+
+def _try_lock(lock_file):
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+
+def image_cache(ds, cache_dir, key, short_side=None, poll_interval=5, stale_timeout=600):
+    """Cache decoded images of `ds` to `cache_dir/key`, writing it on first use.
+
+    Only one process writes the cache, the one creating `cache_dir/key.lock`. Others
+    (e.g. workers on the same machine) wait until it is complete. The lock is
+    touched when the writer prints progress, a lock not touched for `stale_timeout`
+    seconds is left by a killed writer and is taken over.
+
+    Returns the index dataset and load function of `read_image_cache`.
+    """
+    cache_dir = fmt_path(cache_dir) / key
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    lock_file = cache_dir.parent / ("%s.lock" % key)
+    waiting = False
+    while not (cache_dir / "meta.json").exists():
+        if _try_lock(lock_file):
+            try:
+                if not (cache_dir / "meta.json").exists():
+                    print('Writing image cache to %s' % cache_dir)
+                    write_image_cache(ds, cache_dir, short_side, heartbeat=lock_file.touch)
+            finally:
+                lock_file.unlink()
+            break
+        if not waiting:
+            print('Waiting for image cache %s written by another process, remove %s if it was killed'
+                  % (cache_dir, lock_file))
+            waiting = True
+        try:
+            if time.time() - lock_file.stat().st_mtime > stale_timeout:
+                lock_file.unlink()
+                continue
+        except FileNotFoundError:
+            continue
+        time.sleep(poll_interval)
+    return read_image_cache(cache_dir)
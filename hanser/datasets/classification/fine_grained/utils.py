@@ -1,9 +1,24 @@
 import math
 from typing import Type, Callable, Optional
 
-from hanser.datasets import prepare
+from hanser.datasets.utils import prepare, get_batch_size
 from hanser.datasets.classification.general import ImageListBuilder
-from hanser.datasets.tfds.helper import load as tfds_load
+from hanser.datasets.tfds.helper import load as tfds_load, load_encoded
+from hanser.datasets.host import make_host_dataset
+
+
+def _make_host_fg_dataset(
+    dataset_name, train_split, eval_split, batch_size, eval_batch_size, transform, data_dir,
+    batch_transform, num_workers):
+    # `transform(image, label, training, rng)` from `hanser.transform.host`, images are decoded
+    # with Pillow in the worker threads.
+    images, labels = load_encoded(dataset_name, split=train_split, data_dir=data_dir)
+    ds_train = make_host_dataset(images, labels, batch_size, transform(training=True), training=True,
+                                 repeat=True, batch_transform=batch_transform, num_workers=num_workers)
+    images, labels = load_encoded(dataset_name, split=eval_split, data_dir=data_dir)
+    ds_eval = make_host_dataset(images, labels, eval_batch_size, transform(training=False), training=False,
+                                repeat=False, num_workers=num_workers)
+    return ds_train, ds_eval
 
 
 def make_fg_dataset(
@@ -14,20 +29,27 @@ def make_fg_dataset(
     data_dir: Optional[str] = None,
     train_split: str = 'train',
     eval_split: str = 'val',
-    zip_transform=None, batch_transform=None):
+    zip_transform=None, batch_transform=None,
+    backend='tf', num_workers=8, input_context=None, seed=None):
+    assert backend in ['tf', 'host']
     dataset_name = dataset_cls.name
     n_train, n_val = dataset_cls.SPLITS[train_split], dataset_cls.SPLITS[eval_split]
     steps_per_epoch = n_train // batch_size
     eval_steps = math.ceil(n_val / eval_batch_size)
 
+    if backend == 'host':
+        return _make_host_fg_dataset(
+            dataset_name, train_split, eval_split, batch_size, eval_batch_size, transform, data_dir,
+            batch_transform, num_workers) + (steps_per_epoch, eval_steps)
+
     ds_train = tfds_load(dataset_name, split=train_split, shuffle_files=True,
-                         data_dir=data_dir)
+                         data_dir=data_dir, input_context=input_context, seed=seed)
     ds_eval = tfds_load(dataset_name, split=eval_split, shuffle_files=False,
-                        data_dir=data_dir)
-    ds_train = prepare(ds_train, batch_size, transform(training=True),
+                        data_dir=data_dir, input_context=input_context)
+    ds_train = prepare(ds_train, get_batch_size(batch_size, input_context), transform(training=True),
                        batch_transform=batch_transform, zip_transform=zip_transform,
-                       training=True, repeat=True)
-    ds_eval = prepare(ds_eval, eval_batch_size, transform(training=False),
+                       training=True, repeat=True, seed=seed)
+    ds_eval = prepare(ds_eval, get_batch_size(eval_batch_size, input_context), transform(training=False),
                       training=False, repeat=False)
     return ds_train, ds_eval, steps_per_epoch, eval_steps
 
@@ -40,18 +62,25 @@ def make_fg_dataset_sub(
     eval_batch_size: int,
     transform: Callable,
     data_dir: Optional[str] = None,
-    zip_transform=None, batch_transform=None):
+    zip_transform=None, batch_transform=None,
+    backend='tf', num_workers=8, input_context=None, seed=None):
+    assert backend in ['tf', 'host']
     dataset_name = dataset_cls.name
     steps_per_epoch = n_train // batch_size
     eval_steps = math.ceil(n_val / eval_batch_size)
 
+    if backend == 'host':
+        return _make_host_fg_dataset(
+            dataset_name, f"train[:{n_train}]", f"train[:{n_val}]", batch_size, eval_batch_size, transform,
+            data_dir, batch_transform, num_workers) + (steps_per_epoch, eval_steps)
+
     ds_train = tfds_load(dataset_name, split=f"train[:{n_train}]", shuffle_files=True,
-                         data_dir=data_dir)
+                         data_dir=data_dir, input_context=input_context, seed=seed)
     ds_eval = tfds_load(dataset_name, split=f"train[:{n_val}]", shuffle_files=False,
-                        data_dir=data_dir)
-    ds_train = prepare(ds_train, batch_size, transform(training=True),
+                        data_dir=data_dir, input_context=input_context)
+    ds_train = prepare(ds_train, get_batch_size(batch_size, input_context), transform(training=True),
                        batch_transform=batch_transform, zip_transform=zip_transform,
-                       training=True, repeat=True)
-    ds_eval = prepare(ds_eval, eval_batch_size, transform(training=False),
+                       training=True, repeat=True, seed=seed)
+    ds_eval = prepare(ds_eval, get_batch_size(eval_batch_size, input_context), transform(training=False),
                       training=False, repeat=False)
     return ds_train, ds_eval, steps_per_epoch, eval_steps
\ No newline at end of file
@@ -1,33 +1,201 @@
+import os
 import math
+import uuid
+import inspect
 import numpy as np
 
 import tensorflow as tf
 
-from hanser.datasets.utils import prepare
+from hanser.datasets.utils import prepare, get_batch_size
+from hanser.datasets.host import make_host_dataset
 
 
-def subsample(*arrays, ratio):
+def subsample_indices(n, ratio, seed=None):
+    n = int(n * ratio)
+    return np.random.RandomState(seed).choice(n, n, replace=False)
+
+
+def subsample(*arrays, ratio, seed=None):
     lens = [len(a) for a in arrays]
     assert len(set(lens)) == 1
-    n = int(lens[0] * ratio)
-    indices = np.random.choice(n, n, replace=False)
+    indices = subsample_indices(lens[0], ratio, seed)
     sub_arrays = tuple(a[indices] for a in arrays)
     return sub_arrays
 
 
+def shard_arrays(*arrays, input_context=None):
+    if input_context is None or input_context.num_input_pipelines == 1:
+        return arrays
+    i, n = input_context.input_pipeline_id, input_context.num_input_pipelines
+    return tuple(a[i::n] for a in arrays)
+
+
+def load_array(x):
+    # Paths of `.npy` files are memory-mapped instead of read
+    if isinstance(x, (str, os.PathLike)):
+        return np.load(x, mmap_mode='r')
+    return x
+
+
+def as_memmap(x, fp):
+    """Save `x` to `fp` (`.npy`) if it doesn't exist and return it memory-mapped."""
+    if isinstance(x, np.memmap):
+        return x
+    if not os.path.exists(fp):
+        # Processes saving the same array concurrently write to their own files,
+        # any complete one may win the rename
+        tmp_fp = "%s.%s.tmp.npy" % (fp, uuid.uuid4().hex)
+        try:
+            np.save(tmp_fp, x)
+            os.replace(tmp_fp, fp)
+        finally:
+            if os.path.exists(tmp_fp):
+                os.remove(tmp_fp)
+    return np.load(fp, mmap_mode='r')
+
+
+def _gather(x, y):
+    def fn(indices):
+        # Sorted indices read the memmap sequentially
+        order = np.argsort(indices)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        sorted_indices = indices[order]
+        return np.asarray(x[sorted_indices])[inverse], np.asarray(y[sorted_indices])[inverse]
+    return fn
+
+
+def make_memmap_dataset(x, y, batch_size, transform=None, training=True, drop_remainder=None,
+                        repeat=True, aug_repeats=None, zip_transform=None, batch_transform=None,
+                        batched_transform=None, seed=None, prefetch=True, indices=None):
+    """Dataset over (memory-mapped) arrays `x` and `y` without copying them into the graph.
+
+    Only a permutation of indices is shuffled, and each batch is gathered from the
+    arrays in one vectorized call, so memory stays flat and the page cache of a
+    memory-mapped file is shared by all processes reading it. `indices` restricts
+    the dataset to a subset of examples (e.g. a subsample or shard) in that order.
+    """
+    x, y = load_array(x), load_array(y)
+    assert len(x) == len(y)
+    if indices is None:
+        n = len(x)
+        ds = tf.data.Dataset.range(n)
+    else:
+        n = len(indices)
+        ds = tf.data.Dataset.from_tensor_slices(np.asarray(indices, dtype=np.int64))
+    if drop_remainder is None:
+        drop_remainder = training
+
+    if training:
+        ds = ds.shuffle(n, seed=seed, reshuffle_each_iteration=True)
+        if aug_repeats is not None:
+            ds = ds.flat_map(lambda i: tf.data.Dataset.from_tensors(i).repeat(aug_repeats))
+        if type(repeat) == int:
+            ds = ds.repeat(repeat)
+        elif repeat:
+            ds = ds.repeat()
+    ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+
+    def gather(indices):
+        images, labels = tf.numpy_function(
+            _gather(x, y), [indices], (tf.as_dtype(x.dtype), tf.as_dtype(y.dtype)))
+        images.set_shape(indices.shape.concatenate(x.shape[1:]))
+        labels.set_shape(indices.shape.concatenate(y.shape[1:]))
+        return images, labels
+
+    ds = ds.map(gather, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if transform:
+        ds = ds.unbatch()
+        ds = ds.map(transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if training and zip_transform:
+            ds = tf.data.Dataset.zip((ds, ds)).map(zip_transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+    if batched_transform:
+        ds = ds.map(batched_transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if batch_transform:
+        ds = ds.map(batch_transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if not training and repeat:
+        ds = ds.repeat()
+    if prefetch:
+        ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+    return ds
+
+
+def _check_kwargs(backend, fn, kwargs):
+    # Other backends don't accept all arguments of `prepare`
+    params = inspect.signature(fn).parameters
+    unsupported = sorted(k for k in kwargs if k not in params)
+    if unsupported:
+        raise ValueError("Arguments %s are not supported by backend '%s'" % (", ".join(unsupported), backend))
+
+
 def make_numpy_dataset(
     x_train, y_train, x_test, y_test,
     batch_size, eval_batch_size, transform,
-    sub_ratio=None, aug_repeats=None, **kwargs):
-    if sub_ratio is not None:
-        x_train, y_train = subsample(x_train, y_train, ratio=sub_ratio)
-        x_test, y_test = subsample(x_test, y_test, ratio=sub_ratio)
-    n_train, n_test = len(x_train), len(x_test)
+    sub_ratio=None, aug_repeats=None, backend='tf', memmap_dir=None, input_context=None, **kwargs):
+    """`backend='host'` decodes and transforms batches in a NumPy thread pool
+    (see `hanser.datasets.host`), `transform` should then be built from
+    `hanser.transform.host`.
+
+    `backend='memmap'` reads arrays or `.npy` paths with `make_memmap_dataset`.
+    In-memory arrays are saved to `memmap_dir` first if given, so that processes
+    on the same host share them.
+
+    Other `kwargs` are passed to `prepare`, `make_host_dataset` or `make_memmap_dataset`
+    of the backend for the train set, `ValueError` is raised for those it doesn't accept.
+
+    With `input_context`, examples are sharded across input pipelines and batches are
+    per replica, steps are for the global batch sizes."""
+    assert backend in ['tf', 'host', 'memmap']
+    _check_kwargs(backend, {
+        'tf': prepare, 'host': make_host_dataset, 'memmap': make_memmap_dataset}[backend], kwargs)
+    if backend == 'memmap':
+        x_train, y_train, x_test, y_test = [load_array(a) for a in [x_train, y_train, x_test, y_test]]
+        if memmap_dir is not None:
+            os.makedirs(memmap_dir, exist_ok=True)
+            x_train, y_train, x_test, y_test = [
+                as_memmap(a, os.path.join(memmap_dir, name + ".npy"))
+                for a, name in zip([x_train, y_train, x_test, y_test], ['x_train', 'y_train', 'x_test', 'y_test'])
+            ]
+    # All input pipelines must subsample the same examples before sharding
+    seed = kwargs.get('seed', 0 if input_context is not None else None)
+    if backend == 'memmap':
+        # Memory-mapped arrays are subsampled and sharded by indices, fancy indexing would copy them
+        train_indices, test_indices = np.arange(len(x_train)), np.arange(len(x_test))
+        if sub_ratio is not None:
+            train_indices = subsample_indices(len(x_train), sub_ratio, seed)
+            test_indices = subsample_indices(len(x_test), sub_ratio, seed)
+        n_train, n_test = len(train_indices), len(test_indices)
+    else:
+        if sub_ratio is not None:
+            x_train, y_train = subsample(x_train, y_train, ratio=sub_ratio, seed=seed)
+            x_test, y_test = subsample(x_test, y_test, ratio=sub_ratio, seed=seed)
+        n_train, n_test = len(x_train), len(x_test)
     if aug_repeats is not None:
         n_train *= aug_repeats
     steps_per_epoch = n_train // batch_size
     test_steps = math.ceil(n_test / eval_batch_size)
 
+    batch_size = get_batch_size(batch_size, input_context)
+    eval_batch_size = get_batch_size(eval_batch_size, input_context)
+
+    if backend == 'memmap':
+        train_indices, test_indices = shard_arrays(train_indices, test_indices, input_context=input_context)
+        ds_train = make_memmap_dataset(x_train, y_train, batch_size, transform(training=True), training=True,
+                                       aug_repeats=aug_repeats, indices=train_indices, **kwargs)
+        ds_test = make_memmap_dataset(x_test, y_test, eval_batch_size, transform(training=False), training=False,
+                                      indices=test_indices)
+        return ds_train, ds_test, steps_per_epoch, test_steps
+
+    x_train, y_train, x_test, y_test = shard_arrays(x_train, y_train, x_test, y_test, input_context=input_context)
+    n_train = len(x_train) * (aug_repeats or 1)
+
+    if backend == 'host':
+        ds_train = make_host_dataset(x_train, y_train, batch_size, transform(training=True), training=True,
+                                     aug_repeats=aug_repeats, **kwargs)
+        ds_test = make_host_dataset(x_test, y_test, eval_batch_size, transform(training=False), training=False)
+        return ds_train, ds_test, steps_per_epoch, test_steps
+
     ds_train = tf.data.Dataset.from_tensor_slices((x_train, y_train))
     ds_test = tf.data.Dataset.from_tensor_slices((x_test, y_test))
 
@@ -1,6 +1,6 @@
 import math
 import tensorflow_datasets as tfds
-from hanser.datasets import prepare
+from hanser.datasets.utils import prepare, get_batch_size
 from hanser.datasets.detection.general import decode
 
 LABEL_MAP = [
@@ -24,7 +24,8 @@ NUM_EXAMPLES = {
 
 
 def make_dataset(
-    batch_size, eval_batch_size, transform, data_dir=None, drop_remainder=None):
+    batch_size, eval_batch_size, transform, data_dir=None, drop_remainder=None,
+    input_context=None, seed=None):
     n_train, n_val = NUM_EXAMPLES['train'], NUM_EXAMPLES['validation']
     steps_per_epoch = n_train // batch_size
     if drop_remainder:
@@ -32,35 +33,38 @@ def make_dataset(
     else:
         val_steps = math.ceil(n_val / eval_batch_size)
 
-    read_config = tfds.ReadConfig(try_autocache=False, skip_prefetch=True)
+    read_config = tfds.ReadConfig(
+        try_autocache=False, skip_prefetch=True, input_context=input_context, shuffle_seed=seed)
     ds_train = tfds.load("coco/2017", split=f"train", data_dir=data_dir,
                           shuffle_files=True, read_config=read_config)
     ds_val = tfds.load("coco/2017", split=f"validation", data_dir=data_dir,
                        shuffle_files=False, read_config=read_config)
-    ds_train = prepare(ds_train, batch_size, transform(training=True),
-                       training=True, repeat=True)
-    ds_val = prepare(ds_val, eval_batch_size, transform(training=False),
+    ds_train = prepare(ds_train, get_batch_size(batch_size, input_context), transform(training=True),
+                       training=True, repeat=True, seed=seed)
+    ds_val = prepare(ds_val, get_batch_size(eval_batch_size, input_context), transform(training=False),
                      training=False, repeat=False, drop_remainder=drop_remainder)
     return ds_train, ds_val, steps_per_epoch, val_steps
 
 
 def make_dataset_sub(
-    n_train, n_val, batch_size, eval_batch_size, transform, data_dir=None, drop_remainder=None):
+    n_train, n_val, batch_size, eval_batch_size, transform, data_dir=None, drop_remainder=None,
+    input_context=None, seed=None):
     steps_per_epoch = n_train // batch_size
     if drop_remainder:
         val_steps = n_val // eval_batch_size
     else:
         val_steps = math.ceil(n_val / eval_batch_size)
 
-    read_config = tfds.ReadConfig(try_autocache=False, skip_prefetch=True)
+    read_config = tfds.ReadConfig(
+        try_autocache=False, skip_prefetch=True, input_context=input_context, shuffle_seed=seed)
     train_split = f"validation[:{n_train}]" if n_train != 5000 else 'validation'
     val_split = f"validation[:{n_val}]" if n_val != 5000 else 'validation'
     ds_train = tfds.load("coco/2017", split=train_split, data_dir=data_dir,
                           shuffle_files=False, read_config=read_config)
     ds_val = tfds.load("coco/2017", split=val_split, data_dir=data_dir,
                        shuffle_files=False, read_config=read_config)
-    ds_train = prepare(ds_train, batch_size, transform(training=True),
-                       training=True, repeat=True)
-    ds_val = prepare(ds_val, eval_batch_size, transform(training=False),
+    ds_train = prepare(ds_train, get_batch_size(batch_size, input_context), transform(training=True),
+                       training=True, repeat=True, seed=seed)
+    ds_val = prepare(ds_val, get_batch_size(eval_batch_size, input_context), transform(training=False),
                      training=False, repeat=False, drop_remainder=drop_remainder)
     return ds_train, ds_val, steps_per_epoch, val_steps
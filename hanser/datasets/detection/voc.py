@@ -1,7 +1,7 @@
 import math
 import tensorflow as tf
 import tensorflow_datasets as tfds
-from hanser.datasets import prepare
+from hanser.datasets.utils import prepare, get_batch_size
 
 
 def decode(example):
@@ -28,7 +28,8 @@ NUM_EXAMPLES = {
 }
 
 def make_voc_dataset(
-    batch_size, eval_batch_size, transform, data_dir=None, drop_remainder=None):
+    batch_size, eval_batch_size, transform, data_dir=None, drop_remainder=None,
+    input_context=None, seed=None):
     n_train, n_val = NUM_EXAMPLES['train'], NUM_EXAMPLES['val']
     steps_per_epoch = n_train // batch_size
     if drop_remainder:
@@ -36,31 +37,36 @@ def make_voc_dataset(
     else:
         val_steps = math.ceil(n_val / eval_batch_size)
 
+    read_config = tfds.ReadConfig(
+        try_autocache=False, skip_prefetch=True, input_context=input_context, shuffle_seed=seed)
     ds_train1 = tfds.load("voc/2007", split=f"train+validation", data_dir=data_dir,
-                          shuffle_files=True, read_config=tfds.ReadConfig(try_autocache=False, skip_prefetch=True))
+                          shuffle_files=True, read_config=read_config)
     ds_train2 = tfds.load("voc/2012", split=f"train+validation", data_dir=data_dir,
-                          shuffle_files=True, read_config=tfds.ReadConfig(try_autocache=False, skip_prefetch=True))
+                          shuffle_files=True, read_config=read_config)
     ds_train = ds_train1.concatenate(ds_train2)
     ds_val = tfds.load("voc/2007", split=f"test", data_dir=data_dir,
-                       shuffle_files=False, read_config=tfds.ReadConfig(try_autocache=False, skip_prefetch=True))
-    ds_train = prepare(ds_train, batch_size, transform(training=True),
-                       training=True, repeat=True)
-    ds_val = prepare(ds_val, eval_batch_size, transform(training=False),
+                       shuffle_files=False, read_config=read_config)
+    ds_train = prepare(ds_train, get_batch_size(batch_size, input_context), transform(training=True),
+                       training=True, repeat=True, seed=seed)
+    ds_val = prepare(ds_val, get_batch_size(eval_batch_size, input_context), transform(training=False),
                      training=False, repeat=False, drop_remainder=drop_remainder)
     return ds_train, ds_val, steps_per_epoch, val_steps
 
 
 def make_voc_dataset_sub(
-    n_train, n_val, batch_size, eval_batch_size, transform, data_dir=None, prefetch=True):
+    n_train, n_val, batch_size, eval_batch_size, transform, data_dir=None, prefetch=True,
+    input_context=None, seed=None):
     steps_per_epoch, val_steps = n_train // batch_size, n_val // eval_batch_size
 
+    read_config = tfds.ReadConfig(
+        try_autocache=False, skip_prefetch=True, input_context=input_context, shuffle_seed=seed)
     ds_train = tfds.load("voc/2012", split=f"train[:{n_train}]", data_dir=data_dir,
-                         shuffle_files=True, read_config=tfds.ReadConfig(try_autocache=False, skip_prefetch=True))
+                         shuffle_files=True, read_config=read_config)
     ds_val = tfds.load("voc/2012", split=f"train[:{n_val}]", data_dir=data_dir,
-                       shuffle_files=False, read_config=tfds.ReadConfig(try_autocache=False, skip_prefetch=True))
-    ds_train = prepare(ds_train, batch_size, transform(training=True),
-                       training=True, repeat=True, prefetch=prefetch)
-    ds_val = prepare(ds_val, eval_batch_size, transform(training=False),
+                       shuffle_files=False, read_config=read_config)
+    ds_train = prepare(ds_train, get_batch_size(batch_size, input_context), transform(training=True),
+                       training=True, repeat=True, seed=seed, prefetch=prefetch)
+    ds_val = prepare(ds_val, get_batch_size(eval_batch_size, input_context), transform(training=False),
                      training=False, repeat=False, drop_remainder=False,
                      prefetch=prefetch)
     return ds_train, ds_val, steps_per_epoch, val_steps
\ No newline at end of file
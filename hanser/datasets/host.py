@@ -0,0 +1,150 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.transform.host import decode_image
+
+
+class HostLoader:
+    """Decode and transform whole batches on the host with a thread pool.
+
+    `images` is an uint8 array of shape [N, H, W, C], or a sequence of encoded
+    images or file paths which are decoded with Pillow. `transform(image, label, rng)`
+    works on NumPy arrays (see `hanser.transform.host`) and must return arrays of
+    fixed shapes. Workers write samples directly into preallocated batch arrays,
+    and `prefetch` batches are kept in flight while the current one is consumed.
+
+    Each worker thread has its own `np.random.Generator` spawned from `seed`.
+    """
+
+    def __init__(self, images, labels, batch_size, transform, training=True, drop_remainder=None,
+                 repeat=True, aug_repeats=None, num_workers=8, prefetch=2, seed=None):
+        assert len(images) == len(labels)
+        if drop_remainder is None:
+            drop_remainder = training
+        self.images = images
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.transform = transform
+        self.training = training
+        self.drop_remainder = drop_remainder
+        self.repeat = repeat
+        self.aug_repeats = aug_repeats
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self._seed_seq = np.random.SeedSequence(seed)
+
+        image, label = self._load(0, np.random.default_rng(0))
+        self._image_spec = (image.shape, image.dtype)
+        self._label_spec = (label.shape, label.dtype)
+
+    def __len__(self):
+        n = len(self.images) * (self.aug_repeats or 1)
+        if self.drop_remainder:
+            return n // self.batch_size
+        return -(-n // self.batch_size)
+
+    def _load(self, i, rng):
+        image, label = self.transform(decode_image(self.images[i]), self.labels[i], rng=rng)
+        return np.asarray(image), np.asarray(label)
+
+    def _epoch_indices(self, rng):
+        indices = np.arange(len(self.images))
+        if self.training:
+            indices = rng.permutation(indices)
+            if self.aug_repeats is not None:
+                indices = np.repeat(indices, self.aug_repeats)
+        return indices
+
+    def _batch_indices(self, rng):
+        epoch = 0
+        while self.repeat is True or epoch < int(self.repeat or 1):
+            indices = self._epoch_indices(rng)
+            n = len(indices)
+            stop = n - n % self.batch_size if self.drop_remainder else n
+            for start in range(0, stop, self.batch_size):
+                yield indices[start:start + self.batch_size]
+            epoch += 1
+
+    def __iter__(self):
+        seeds = iter(self._seed_seq.spawn(self.num_workers + 1))
+        shuffle_rng = np.random.default_rng(next(seeds))
+        local = threading.local()
+        lock = threading.Lock()
+
+        def get_rng():
+            if not hasattr(local, 'rng'):
+                with lock:
+                    local.rng = np.random.default_rng(next(seeds))
+            return local.rng
+
+        def fill(indices, images, labels, offset):
+            rng = get_rng()
+            for j, i in enumerate(indices):
+                images[offset + j], labels[offset + j] = self._load(i, rng)
+
+        def submit(pool, indices):
+            n = len(indices)
+            images = np.empty((n, *self._image_spec[0]), self._image_spec[1])
+            labels = np.empty((n, *self._label_spec[0]), self._label_spec[1])
+            chunk = -(-n // self.num_workers)
+            futures = [
+                pool.submit(fill, indices[start:start + chunk], images, labels, start)
+                for start in range(0, n, chunk)
+            ]
+            return futures, images, labels
+
+        pool = ThreadPoolExecutor(self.num_workers)
+        pending = deque()
+        try:
+            batches = self._batch_indices(shuffle_rng)
+            for indices in batches:
+                pending.append(submit(pool, indices))
+                if len(pending) <= self.prefetch:
+                    continue
+                yield self._wait(pending.popleft())
+            while pending:
+                yield self._wait(pending.popleft())
+        finally:
+            for futures, _, _ in pending:
+                for f in futures:
+                    f.cancel()
+            pool.shutdown(wait=True)
+
+    @staticmethod
+    def _wait(batch):
+        futures, images, labels = batch
+        for f in futures:
+            f.result()
+        # Arrays yielded to `from_generator` are not copied, so every batch owns its arrays
+        return images, labels
+
+    @property
+    def element_spec(self):
+        batch_size = self.batch_size if self.drop_remainder else None
+        (image_shape, image_dtype), (label_shape, label_dtype) = self._image_spec, self._label_spec
+        return (
+            tf.TensorSpec((batch_size, *image_shape), tf.as_dtype(image_dtype)),
+            tf.TensorSpec((batch_size, *label_shape), tf.as_dtype(label_dtype)),
+        )
+
+    def to_dataset(self, batch_transform=None, prefetch=True):
+        ds = tf.data.Dataset.from_generator(self.__iter__, output_signature=self.element_spec)
+        if batch_transform:
+            ds = ds.map(batch_transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if prefetch:
+            ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+        return ds
+
+
+def make_host_dataset(images, labels, batch_size, transform, training=True, drop_remainder=None,
+                      repeat=True, aug_repeats=None, batch_transform=None, num_workers=8, prefetch=2,
+                      seed=None):
+    loader = HostLoader(
+        images, labels, batch_size, transform, training=training, drop_remainder=drop_remainder,
+        repeat=repeat, aug_repeats=aug_repeats, num_workers=num_workers, prefetch=prefetch, seed=seed)
+    return loader.to_dataset(batch_transform=batch_transform)
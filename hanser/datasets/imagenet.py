@@ -2,7 +2,10 @@ import os
 import math
 import functools
 import tensorflow as tf
-from hanser.datasets import prepare
+from hanser.datasets.utils import prepare, shard, shard_files, get_batch_size
+from hanser.datasets.tfrecord import count_records, sample_records
+from hanser.datasets.benchmark import benchmark
+from hanser.transform import random_resized_crop, resize, center_crop, center_crop_jpeg, to_tensor, normalize
 from hanser.datasets.classification.imagenet_classes import IMAGENET_CLASSES
 
 NUM_IMAGES = {
@@ -51,10 +54,35 @@ def parse_and_transform(transform, training):
     return fn
 
 
+def parse_and_decode(example_serialized):
+    image, label = parse_example_proto(example_serialized)
+    image = tf.image.decode_jpeg(image, channels=3)
+    return image, label
+
+
 def make_imagenet_dataset_split(
     batch_size, transform, filenames, split, training=None,
     cache_parsed=False, drop_remainder=None, repeat=None,
-    n_batches_per_step=1, **kwargs):
+    n_batches_per_step=1, cache_dir=None, cache_short_side=None,
+    cycle_length=16, shuffle_buffer=_SHUFFLE_BUFFER, prefetch=True,
+    input_context=None, seed=None, deterministic=False, subset=None, **kwargs):
+    """
+    With `cache_dir`, decoded images downscaled to `cache_short_side` are cached on local
+    disk and `transform` receives uint8 images instead of encoded JPEGs.
+
+    `cycle_length`, `shuffle_buffer`, `prefetch` and `num_parallel_calls` (passed to
+    `prepare`) can be tuned with `hanser.datasets.benchmark`.
+
+    With `input_context` (see `hanser.distribute.distribute_dataset_builder`), files are
+    sharded across input pipelines (examples if there are too few files) and batches
+    are per replica. `steps` is always for the global batch size. With `deterministic`,
+    files are still read in parallel but the order of examples only depends on `seed`.
+
+    If the TFRecord files have sidecar indices (see `hanser.datasets.tfrecord`), steps are
+    computed from the exact number of examples, otherwise it is estimated from the number
+    of files. With indices, `subset` examples can be sampled randomly (with `seed`) and
+    read by offset, e.g. for a quick validation subset.
+    """
     assert split in NUM_IMAGES.keys()
 
     if training is None:
@@ -71,27 +99,54 @@ def make_imagenet_dataset_split(
 
     batch_size = batch_size // n_batches_per_step
 
-    dataset = tf.data.Dataset.from_tensor_slices(filenames)
-
-    if training:
-        dataset = dataset.shuffle(buffer_size=len(filenames))
-    dataset = dataset.interleave(
-        tf.data.TFRecordDataset,
-        cycle_length=16,
-        num_parallel_calls=tf.data.experimental.AUTOTUNE,
-        deterministic=False)
-
-    if cache_parsed:
+    if subset is not None:
+        # Same sampled examples in all input pipelines
+        files = filenames
+        shard_examples = True
+        dataset = sample_records(filenames, subset, seed=seed if seed is not None else 0)
+        dataset = shard(dataset, input_context)
+    else:
+        files = shard_files(filenames, input_context)
+        shard_examples = files is None
+        if shard_examples:
+            files = filenames
+        dataset = tf.data.Dataset.from_tensor_slices(files)
+
+        # Sharding examples needs the same order of examples in all input pipelines
+        if training and not (shard_examples and seed is None):
+            dataset = dataset.shuffle(buffer_size=len(files), seed=seed)
+        dataset = dataset.interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=cycle_length,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic or shard_examples)
+        if shard_examples:
+            dataset = shard(dataset, input_context)
+
+    cache = True
+    if cache_dir is not None:
+        cache = cache_dir
+        kwargs.update(
+            cache_key=('imagenet', split, sorted(os.path.basename(f) for f in files),
+                       (subset, seed) if subset is not None else None,
+                       (input_context.input_pipeline_id, input_context.num_input_pipelines)
+                       if shard_examples and input_context is not None else None),
+            cache_transform=parse_and_decode, cache_short_side=cache_short_side)
+        transform = functools.partial(transform, training=training)
+    elif cache_parsed:
         dataset = dataset.map(parse_example_proto, num_parallel_calls=tf.data.experimental.AUTOTUNE)
         transform = functools.partial(transform, training=training)
     else:
         transform = parse_and_transform(transform, training)
-    ds = prepare(dataset, batch_size, transform, training=training, buffer_size=_SHUFFLE_BUFFER,
-                 cache=True, prefetch=True, repeat=repeat, drop_remainder=drop_remainder, **kwargs)
-
-    n = NUM_IMAGES[split]
-    chunksize = math.ceil(n / NUM_FILES[split])
-    n = min(len(filenames) * chunksize, n)
+    ds = prepare(dataset, get_batch_size(batch_size, input_context), transform, training=training,
+                 buffer_size=shuffle_buffer, cache=cache, prefetch=prefetch, repeat=repeat,
+                 drop_remainder=drop_remainder, seed=seed, **kwargs)
+
+    n = subset if subset is not None else count_records(filenames)
+    if n is None:
+        n = NUM_IMAGES[split]
+        chunksize = math.ceil(n / NUM_FILES[split])
+        n = min(len(filenames) * chunksize, n)
     if 'repeat' in kwargs and type(kwargs['repeat']) == int:
         n *= kwargs['repeat']
     if 'aug_repeats' in kwargs and type(kwargs['aug_repeats']) == int:
@@ -122,3 +177,55 @@ def make_imagenet_dataset(
         eval_batch_size, transform, eval_files, 'validation', training=False,
         drop_remainder=drop_remainder, n_batches_per_step=1, **kwargs)
     return ds_train, ds_eval, steps_per_epoch, eval_steps
+
+
+def make_imagenet_transform(
+    train_size=224, eval_size=224, scale=(0.08, 1.0), ratio=(0.75, 1.33), crop_padding=32,
+    augment=None, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+    label_offset=1, num_classes=1000, fused=True):
+    """Standard ImageNet transform taking encoded JPEG or decoded images.
+
+    With `fused`, the crop window is sampled from the JPEG header and only the
+    cropped region is decoded by `tf.image.decode_and_crop_jpeg`. Otherwise the
+    whole image is decoded first, which gives the same outputs up to the random
+    crop and is kept for comparison.
+    """
+    def transform(image, label, training):
+        encoded = image.dtype == tf.string
+        if encoded and not fused:
+            image = tf.image.decode_jpeg(image, channels=3)
+            encoded = False
+        if training:
+            image = random_resized_crop(image, train_size, scale=scale, ratio=ratio)
+            image = tf.image.random_flip_left_right(image)
+            if augment is not None:
+                image = augment(image)
+        else:
+            if encoded:
+                image = center_crop_jpeg(image, eval_size, crop_padding)
+            else:
+                image = resize(image, eval_size + crop_padding)
+                image = center_crop(image, eval_size)
+
+        image, label = to_tensor(image, label, label_offset=label_offset)
+        image = normalize(image, mean, std)
+
+        label = tf.one_hot(label, num_classes)
+        return image, label
+    return transform
+
+
+def benchmark_transform(filenames, transform, training=True, batch_size=256, num_batches=50, warmup=5):
+    """Images per second of parsing and transforming examples of `filenames`.
+
+    Examples:
+        >>> for fused in [False, True]:
+        ...     t = make_imagenet_transform(fused=fused)
+        ...     print(fused, benchmark_transform(get_filenames(data_dir, True)[:16], t))
+    """
+    ds = tf.data.TFRecordDataset(filenames, num_parallel_reads=tf.data.experimental.AUTOTUNE)
+    ds = ds.repeat()
+    ds = ds.map(parse_and_transform(transform, training), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.batch(batch_size)
+    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+    return benchmark(ds, num_batches, warmup)['examples_per_sec']
@@ -1,5 +1,7 @@
 import io
+import os
 import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from PIL import Image
 
@@ -7,6 +9,9 @@ import numpy as np
 from hhutil.io import fmt_path
 import tensorflow as tf
 
+from hanser.datasets.utils import prepare, shard, shard_files, get_batch_size
+from hanser.datasets.tfrecord import IndexedTFRecordWriter, count_records, scan_tfrecord
+
 
 def read_image(fp):
     fp = fmt_path(fp)
@@ -77,10 +82,137 @@ def parse_tfexample_to_img_seg(example_proto):
     return tf.io.parse_single_example(example_proto, features)
 
 
+def _identity(x):
+    return x
+
+
+def _resized_size(width, height, size):
+    if isinstance(size, (tuple, list)):
+        return size[1], size[0]
+    scale = size / min(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _center_crop_box(width, height, crop_size):
+    if not isinstance(crop_size, (tuple, list)):
+        crop_size = (crop_size, crop_size)
+    crop_height, crop_width = min(crop_size[0], height), min(crop_size[1], width)
+    left, top = (width - crop_width) // 2, (height - crop_height) // 2
+    return left, top, left + crop_width, top + crop_height
+
+
+def _check_label_map(label_map):
+    # Labels are encoded as uint8, negative or larger ids would wrap around
+    label_map = np.asarray(label_map)
+    if label_map.size and (label_map.min() < 0 or label_map.max() > 255):
+        raise ValueError("label_map must be in [0, 255], got [%d, %d]" % (label_map.min(), label_map.max()))
+    return label_map
+
+
+def _encode(image, format, jpeg_quality=95):
+    format = {'jpg': 'JPEG'}.get(format.lower(), format.upper())
+    data = io.BytesIO()
+    if format == 'JPEG':
+        image.save(data, format=format, quality=jpeg_quality)
+    else:
+        image.save(data, format=format)
+    return data.getvalue()
+
+
+def process_example(image_fp, label_fp, image_format='jpg', label_format='png',
+                    size=None, crop_size=None, label_map=None, jpeg_quality=95):
+    """Read an image and its label for `image_label_to_tfexample`.
+
+    The image is only decoded and re-encoded if it is resized (bilinear, shorter side
+    to `size` if it is an int) or center cropped to `crop_size`, the label is resized
+    with nearest neighbours and remapped by `label_map[label]` (e.g. `LABEL_MAP` of
+    Cityscapes), whose values must be in [0, 255].
+
+    Returns:
+        (image_data, (width, height, channels)), label_data
+    """
+    image = Image.open(image_fp)
+    label = Image.fromarray(np.array(Image.open(label_fp)))
+    if image.size != label.size:
+        raise RuntimeError('Shape mismatched between image and label.')
+    channels = len(image.getbands())
+
+    if size is None and crop_size is None:
+        image_data = fmt_path(image_fp).read_bytes()
+    else:
+        if size is not None:
+            resized = _resized_size(*image.size, size)
+            image = image.resize(resized, Image.BILINEAR)
+            label = label.resize(resized, Image.NEAREST)
+        if crop_size is not None:
+            box = _center_crop_box(*image.size, crop_size)
+            image = image.crop(box)
+            label = label.crop(box)
+        image_data = _encode(image, image_format, jpeg_quality)
+
+    if label_map is not None:
+        label_map = _check_label_map(label_map)
+        label = Image.fromarray(label_map[np.array(label)].astype(np.uint8))
+    label_data = _encode(label, label_format)
+
+    width, height = image.size
+    return (image_data, (width, height, channels)), label_data
+
+
+def _convert_segmentation_shard(output_f, image_fps, label_fps, filenames, image_format, label_format,
+                                size, crop_size, label_map, jpeg_quality):
+    with IndexedTFRecordWriter(output_f) as writer:
+        for image_fp, label_fp, filename in zip(image_fps, label_fps, filenames):
+            (image_data, (width, height, channels)), label_data = process_example(
+                image_fp, label_fp, image_format, label_format, size, crop_size, label_map, jpeg_quality)
+            example = image_label_to_tfexample(
+                image_data, filename, image_format, height, width, channels, label_data, label_format)
+            writer.write(example.SerializeToString())
+    return output_f
+
+
+def _convert_numpy_shard(output_f, X, y):
+    with IndexedTFRecordWriter(output_f) as writer:
+        for image, label in zip(X, y):
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': _bytes_feature(image.tobytes()),
+                'label': _int64_feature(label),
+            }))
+            writer.write(example.SerializeToString())
+    return output_f
+
+
+def _run_shards(fn, shard_args, num_workers):
+    num_shards = len(shard_args)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, num_shards)
+    if num_workers <= 1:
+        for i, args in enumerate(shard_args):
+            fn(*args)
+            print('>> Converted shard %d/%d' % (i + 1, num_shards))
+        return
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(fn, *args) for args in shard_args]
+        for i, future in enumerate(as_completed(futures)):
+            future.result()
+            print('>> Converted shard %d/%d' % (i + 1, num_shards))
+
+
 def convert_segmentation_dataset(
     split_f, output_dir, image_dir, label_dir,
     image_format='jpg', label_format='png', num_shards=4,
-    image_stem_transform=lambda x: x, label_stem_transform=lambda x: x):
+    image_stem_transform=_identity, label_stem_transform=_identity,
+    num_workers=None, size=None, crop_size=None, label_map=None, jpeg_quality=95):
+    """Convert images and labels listed in `split_f` to `num_shards` TFRecords.
+
+    Shards are written in parallel by `num_workers` processes (all CPUs by default).
+    `size`, `crop_size` and `label_map` are applied once here instead of every
+    epoch, see `process_example`. Stem transforms must be picklable, i.e. defined
+    at module level.
+    """
+    if label_map is not None:
+        _check_label_map(label_map)
     split_f = fmt_path(split_f)
     output_dir = fmt_path(output_dir)
     image_dir = fmt_path(image_dir)
@@ -94,30 +226,18 @@ def convert_segmentation_dataset(
 
     print('Processing ' + split)
 
+    shard_args = []
     for shard_id in range(num_shards):
         output_f = output_dir / ('%s-%05d-of-%05d.tfrecord' % (split, shard_id, num_shards))
-        with tf.io.TFRecordWriter(str(output_f)) as writer:
-            start_idx = shard_id * num_per_shard
-            end_idx = min((shard_id + 1) * num_per_shard, num_images)
-            for i in range(start_idx, end_idx):
-                print('\r>> Converting image %d/%d shard %d' % (i + 1, len(filenames), shard_id), end='')
-
-                image_fp = image_dir / (image_stem_transform(filenames[i]) + '.' + image_format)
-                image_data, (width, height, channels) = read_image(image_fp)
+        shard_filenames = filenames[shard_id * num_per_shard:(shard_id + 1) * num_per_shard]
+        image_fps = [image_dir / (image_stem_transform(f) + '.' + image_format) for f in shard_filenames]
+        label_fps = [label_dir / (label_stem_transform(f) + '.' + label_format) for f in shard_filenames]
+        shard_args.append((output_f, image_fps, label_fps, shard_filenames, image_format, label_format,
+                           size, crop_size, label_map, jpeg_quality))
+    _run_shards(_convert_segmentation_shard, shard_args, num_workers)
 
-                label_fp = label_dir / (label_stem_transform(filenames[i]) + '.' + label_format)
-                label_data, (label_width, label_height) = read_label(label_fp, format=label_format)
 
-                if height != label_height or width != label_width:
-                    raise RuntimeError('Shape mismatched between image and label.')
-
-                example = image_label_to_tfexample(
-                    image_data, filenames[i], image_format, height, width, channels, label_data, label_format)
-                writer.write(example.SerializeToString())
-        print()
-
-
-def convert_numpy_dataset(X, y, split, output_dir, num_shards=4):
+def convert_numpy_dataset(X, y, split, output_dir, num_shards=4, num_workers=None):
     assert len(X) == len(y)
 
     output_dir = fmt_path(output_dir)
@@ -125,19 +245,13 @@ def convert_numpy_dataset(X, y, split, output_dir, num_shards=4):
     num_examples = len(X)
     num_per_shard = int(math.ceil(num_examples / float(num_shards)))
 
+    shard_args = []
     for shard_id in range(num_shards):
         output_f = output_dir / ('%s-%05d-of-%05d.tfrecord' % (split, shard_id, num_shards))
-        with tf.io.TFRecordWriter(str(output_f)) as writer:
-            start_idx = shard_id * num_per_shard
-            end_idx = min((shard_id + 1) * num_per_shard, num_examples)
-            for i in range(start_idx, end_idx):
-                print('\r>> Converting image %d/%d shard %d' % (i + 1, num_examples, shard_id), end='')
-                example = tf.train.Example(features=tf.train.Features(feature={
-                    'image': _bytes_feature(X[i].tobytes()),
-                    'label': _int64_feature(y[i]),
-                }))
-                writer.write(example.SerializeToString())
-        print()
+        start_idx = shard_id * num_per_shard
+        end_idx = min((shard_id + 1) * num_per_shard, num_examples)
+        shard_args.append((output_f, X[start_idx:end_idx], y[start_idx:end_idx]))
+    _run_shards(_convert_numpy_shard, shard_args, num_workers)
 
 
 def parse_numpy_example(example_proto):
@@ -145,4 +259,55 @@ def parse_numpy_example(example_proto):
         'image': tf.io.FixedLenFeature((), tf.string, default_value=''),
         'label': tf.io.FixedLenFeature((), tf.int64, default_value=0),
     }
-    return tf.io.parse_single_example(example_proto, features)
\ No newline at end of file
+    return tf.io.parse_single_example(example_proto, features)
+
+
+def num_examples(filenames):
+    # From sidecar indices if they exist, otherwise by scanning record headers
+    n = count_records(filenames)
+    if n is None:
+        n = sum(len(scan_tfrecord(f)) for f in filenames)
+    return n
+
+
+def _records(filenames, input_context=None):
+    # Files of the input pipeline, or its examples if there are fewer files than pipelines
+    files = shard_files(filenames, input_context)
+    if files is None:
+        return shard(tf.data.TFRecordDataset(filenames), input_context)
+    return tf.data.TFRecordDataset(files)
+
+
+def make_tfrecord_dataset(
+    train_files, val_files, batch_size, eval_batch_size, transform, drop_remainder=None,
+    input_context=None, **kwargs):
+    """Datasets of segmentation TFRecords and their exact steps.
+
+    `transform(training)` returns the function applied to serialized examples, e.g.
+    parsing them by `parse_tfexample_to_img_seg`. Other `kwargs` are passed to
+    `prepare` of the training set.
+
+    `buffer_size` defaults to the number of training examples of the input pipeline.
+    The buffer holds serialized examples, which is several GB for Cityscapes, pass a
+    smaller one if memory is limited.
+
+    With `input_context`, files are sharded across input pipelines (examples if there
+    are too few files) and batches are per replica. Steps are for the global batch sizes.
+    """
+    n_train, n_val = num_examples(train_files), num_examples(val_files)
+    steps_per_epoch = n_train // batch_size
+    if drop_remainder:
+        val_steps = n_val // eval_batch_size
+    else:
+        val_steps = math.ceil(n_val / eval_batch_size)
+
+    num_input_pipelines = input_context.num_input_pipelines if input_context is not None else 1
+    kwargs.setdefault('buffer_size', math.ceil(n_train / num_input_pipelines))
+    batch_size = get_batch_size(batch_size, input_context)
+    eval_batch_size = get_batch_size(eval_batch_size, input_context)
+
+    ds_train = prepare(_records(train_files, input_context), batch_size, transform(training=True),
+                       training=True, repeat=True, **kwargs)
+    ds_val = prepare(_records(val_files, input_context), eval_batch_size, transform(training=False),
+                     training=False, repeat=False, drop_remainder=drop_remainder)
+    return ds_train, ds_val, steps_per_epoch, val_steps
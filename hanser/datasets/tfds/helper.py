@@ -14,7 +14,23 @@ class HGeneratorBasedBuilder(tfds.core.GeneratorBasedBuilder):
         return super().download_and_prepare(download_dir=download_dir, download_config=download_config)
 
 
-def load(name: str, *, split, data_dir=None, shuffle_files: bool = False):
+def load(name: str, *, split, data_dir=None, shuffle_files: bool = False, input_context=None, seed=None):
+    # Files are sharded by `input_context`, `seed` makes the order of files reproducible
+    read_config = tfds.ReadConfig(
+        try_autocache=False, skip_prefetch=True, input_context=input_context, shuffle_seed=seed)
     return tfds.load(
         name, split=split, data_dir=data_dir, download=False,
-        shuffle_files=shuffle_files, read_config=tfds.ReadConfig(try_autocache=False, skip_prefetch=True))
+        shuffle_files=shuffle_files, read_config=read_config)
+
+
+def load_encoded(name: str, *, split, data_dir=None):
+    # Images are kept as encoded bytes for host-side decoding
+    ds = tfds.load(
+        name, split=split, data_dir=data_dir, download=False,
+        decoders={'image': tfds.decode.SkipDecoding()},
+        read_config=tfds.ReadConfig(try_autocache=False, skip_prefetch=True))
+    images, labels = [], []
+    for example in tfds.as_numpy(ds):
+        images.append(example['image'])
+        labels.append(example['label'])
+    return images, labels
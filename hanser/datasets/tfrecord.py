@@ -1,3 +1,8 @@
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
 import tensorflow as tf
 
 
@@ -21,3 +26,138 @@ def _int64_feature(value):
 def _float_list_feature(values):
     """Returns a float_list from a float / double."""
     return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+
+# Sidecar index `{shard}.idx` of a TFRecord shard, one "offset size" line per record
+# (same format as DALI's tfrecord2idx). `size` includes the 12 bytes header and 4
+# bytes footer of the record.
+
+_HEADER_BYTES = 12
+_FOOTER_BYTES = 4
+
+
+def index_path(fp):
+    return str(fp) + ".idx"
+
+
+def scan_tfrecord(fp):
+    """Offsets and sizes of the records of `fp`, only record headers are read."""
+    entries = []
+    offset = 0
+    with tf.io.gfile.GFile(str(fp), 'rb') as f:
+        while True:
+            header = f.read(_HEADER_BYTES)
+            if not header:
+                break
+            if len(header) < _HEADER_BYTES:
+                raise ValueError("Truncated record at offset %d of %s" % (offset, fp))
+            length = struct.unpack('<Q', header[:8])[0]
+            size = _HEADER_BYTES + length + _FOOTER_BYTES
+            entries.append((offset, size))
+            offset += size
+            f.seek(offset)
+    return np.array(entries, dtype=np.int64).reshape(-1, 2)
+
+
+def write_tfrecord_index(fp, entries=None):
+    if entries is None:
+        entries = scan_tfrecord(fp)
+    data = "".join("%d %d\n" % (offset, size) for offset, size in entries)
+    with tf.io.gfile.GFile(index_path(fp), 'w') as f:
+        f.write(data)
+    return entries
+
+
+def read_tfrecord_index(fp, create=False):
+    """Index of `fp` as an [N, 2] array of (offset, size), or None if it doesn't
+    exist and `create` is False."""
+    idx_fp = index_path(fp)
+    if not tf.io.gfile.exists(idx_fp):
+        if not create:
+            return None
+        return write_tfrecord_index(fp)
+    with tf.io.gfile.GFile(idx_fp, 'r') as f:
+        data = f.read()
+    return np.array([line.split() for line in data.splitlines()], dtype=np.int64).reshape(-1, 2)
+
+
+def read_tfrecord_indices(filenames, create=False):
+    with ThreadPoolExecutor(16) as executor:
+        return list(executor.map(lambda fp: read_tfrecord_index(fp, create), filenames))
+
+
+def count_records(filenames, create=False):
+    """Exact number of records in `filenames` from their indices, or None if any
+    index is missing and `create` is False."""
+    indices = read_tfrecord_indices(filenames, create)
+    if any(index is None for index in indices):
+        return None
+    return sum(len(index) for index in indices)
+
+
+class IndexedTFRecordWriter:
+    """`tf.io.TFRecordWriter` which also writes the index of the shard on close."""
+
+    def __init__(self, fp, options=None):
+        self.fp = str(fp)
+        self._writer = tf.io.TFRecordWriter(self.fp, options)
+        self._entries = []
+        self._offset = 0
+        # Offsets are only known for uncompressed records
+        self._indexed = options is None or options == '' or \
+            getattr(options, 'compression_type', options) in ['', None]
+
+    def write(self, record):
+        self._writer.write(record)
+        size = _HEADER_BYTES + len(record) + _FOOTER_BYTES
+        self._entries.append((self._offset, size))
+        self._offset += size
+
+    def close(self):
+        self._writer.close()
+        if self._indexed:
+            write_tfrecord_index(self.fp, self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _read_record(filename, offset, size, file_size):
+    # Header and footer cover the rest of the file, so exactly one record is read
+    length = size - _HEADER_BYTES - _FOOTER_BYTES
+    header_bytes = offset + _HEADER_BYTES
+    return tf.data.FixedLengthRecordDataset(
+        filename, record_bytes=length, header_bytes=header_bytes,
+        footer_bytes=file_size - header_bytes - length)
+
+
+def sample_records(filenames, num_examples=None, indices=None, seed=None, create=False):
+    """Dataset of serialized records at random positions of `filenames`.
+
+    Either `num_examples` records are sampled uniformly without replacement (with
+    `seed`), or `indices` gives the global positions of the records in `filenames`.
+    Records are read by offset, whole files are never scanned. Records are returned
+    in file order.
+    """
+    index = read_tfrecord_indices(filenames, create)
+    if any(i is None for i in index):
+        raise ValueError("Missing index of TFRecord files, write them with `write_tfrecord_index`.")
+    file_ids = np.concatenate([np.full(len(i), fid) for fid, i in enumerate(index)])
+    file_sizes = np.array([int(i[-1].sum()) if len(i) else 0 for i in index], dtype=np.int64)
+    entries = np.concatenate(index)
+    if indices is None:
+        rng = np.random.RandomState(seed)
+        indices = rng.choice(len(entries), num_examples, replace=False)
+    indices = np.sort(np.asarray(indices))
+
+    files = np.array([str(f) for f in filenames])[file_ids[indices]]
+    offsets, sizes = entries[indices, 0], entries[indices, 1]
+    ds = tf.data.Dataset.from_tensor_slices((files, offsets, sizes, file_sizes[file_ids[indices]]))
+    ds = ds.interleave(
+        _read_record, cycle_length=16, block_length=1,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=True)
+    return ds
@@ -1,5 +1,9 @@
+import os
+
 import tensorflow as tf
 
+from hanser.datasets.cache import cache_key as make_cache_key, image_cache
+
 
 def make_repeat_fn(n):
     def fn(*args):
@@ -7,16 +11,64 @@ def make_repeat_fn(n):
     return fn
 
 
+def shard(ds: tf.data.Dataset, input_context=None):
+    if input_context is None or input_context.num_input_pipelines == 1:
+        return ds
+    return ds.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+
+
+def shard_files(filenames, input_context=None):
+    """Files of the input pipeline of `input_context`, or None if there are fewer
+    files than input pipelines and examples should be sharded instead."""
+    if input_context is None or input_context.num_input_pipelines == 1:
+        return filenames
+    if len(filenames) < input_context.num_input_pipelines:
+        return None
+    return filenames[input_context.input_pipeline_id::input_context.num_input_pipelines]
+
+
+def get_batch_size(batch_size, input_context=None):
+    # Global batch size -> batch size of each replica of the input pipeline
+    if input_context is None:
+        return batch_size
+    return input_context.get_per_replica_batch_size(batch_size)
+
+
 def prepare(ds: tf.data.Dataset, batch_size, transform=None, training=True, buffer_size=1024,
             drop_remainder=None, cache=True, repeat=True, prefetch=True,
-            zip_transform=None, batch_transform=None, aug_repeats=None):
+            zip_transform=None, batch_transform=None, aug_repeats=None,
+            cache_key=None, cache_transform=None, cache_short_side=None, batched_transform=None,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE, seed=None):
+    """
+    `batched_transform` is applied to whole batches right after batching (before
+    `batch_transform`), e.g. with `random_crop_batch` and `random_flip_left_right_batch`
+    from `hanser.transform`. It avoids per-element map overhead for small images.
+
+    If `cache` is a directory, elements are mapped by `cache_transform` to decoded uint8
+    (image, label), downscaled to `cache_short_side` and written to a local disk cache
+    under a hash of `cache_key` and `cache_short_side`, printing progress. It is written
+    when `prepare` is called, by one process while the others (e.g. workers sharing the
+    disk) wait. Later runs memory-map the cache and skip decoding. `cache_key` must
+    identify the dataset and `cache_transform`.
+
+    `prefetch` may be the number of batches to prefetch instead of True (autotuned).
+    `seed` makes the shuffling order reproducible.
+    """
 
     if drop_remainder is None:
         drop_remainder = training
-    if cache:
+    load = None
+    if isinstance(cache, (str, os.PathLike)):
+        assert cache_key is not None, "cache_key is required for disk cache"
+        if cache_transform:
+            ds = ds.map(cache_transform, num_parallel_calls=num_parallel_calls)
+        ds, load = image_cache(ds, cache, make_cache_key(cache_key, cache_short_side), cache_short_side)
+        # Only indices are shuffled, so the whole dataset fits in the buffer
+        buffer_size = int(ds.cardinality())
+    elif cache:
         ds = ds.cache()
     if training:
-        ds = ds.shuffle(buffer_size)
+        ds = ds.shuffle(buffer_size, seed=seed)
         if aug_repeats is not None:
             # assert len(ds.element_spec) == 2
             ds = ds.flat_map(make_repeat_fn(aug_repeats))
@@ -24,20 +76,28 @@ def prepare(ds: tf.data.Dataset, batch_size, transform=None, training=True, buff
             ds = ds.repeat(repeat)
         elif repeat:
             ds = ds.repeat()
+    if load:
+        ds = ds.map(load, num_parallel_calls=num_parallel_calls)
     if transform:
-        ds = ds.map(transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        ds = ds.map(transform, num_parallel_calls=num_parallel_calls)
     if training:
         if zip_transform:
-            ds = tf.data.Dataset.zip((ds, ds)).map(zip_transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            ds = tf.data.Dataset.zip((ds, ds)).map(zip_transform, num_parallel_calls=num_parallel_calls)
         ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+        if batched_transform:
+            ds = ds.map(batched_transform, num_parallel_calls=num_parallel_calls)
         if batch_transform:
-            ds = ds.map(batch_transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            ds = ds.map(batch_transform, num_parallel_calls=num_parallel_calls)
     else:
         ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+        if batched_transform:
+            ds = ds.map(batched_transform, num_parallel_calls=num_parallel_calls)
         if batch_transform:
-            ds = ds.map(batch_transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            ds = ds.map(batch_transform, num_parallel_calls=num_parallel_calls)
         if repeat:
             ds = ds.repeat()
-    if prefetch:
+    if prefetch is True:
         ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+    elif prefetch:
+        ds = ds.prefetch(prefetch)
     return ds
\ No newline at end of file
@@ -5,8 +5,8 @@ import numpy as np
 import tensorflow as tf
 
 from hanser.detection.anchor import AnchorGenerator
-from hanser.detection.assign import max_iou_match, atss_match, fcos_match, grid_points
-from hanser.detection.nms import batched_nms
+from hanser.detection.assign import max_iou_match, atss_match, fcos_match, grid_points, flat_grid_points
+from hanser.detection.nms import batched_nms, padded_nms
 from hanser.detection.iou import bbox_iou2
 from hanser.detection.bbox import BBoxCoder, FCOSBBoxCoder, coords_to_absolute
 from hanser.detection.loss import DetectionLoss, focal_loss, iou_loss, l1_loss, smooth_l1_loss, cross_entropy_det, GFLoss, GFLossV2
@@ -15,7 +15,8 @@ from hanser.detection.loss import DetectionLoss, focal_loss, iou_loss, l1_loss,
 def postprocess(bbox_preds, cls_scores, bbox_coder, centerness=None,
                 nms_pre=5000, iou_threshold=0.5, score_threshold=0.05,
                 topk=200, soft_nms_sigma=0., use_sigmoid=False, label_offset=0,
-                from_logits=True):
+                from_logits=True, use_padded_nms=False):
+    # With `use_padded_nms`, all shapes are fixed and it can be compiled in the eval step on TPU
     if from_logits:
         if use_sigmoid:
             scores = tf.sigmoid(cls_scores)
@@ -38,7 +39,8 @@ def postprocess(bbox_preds, cls_scores, bbox_coder, centerness=None,
         bboxes = bbox_coder.decode(bbox_preds)
 
     bboxes = tf.expand_dims(bboxes, 2)
-    bboxes, scores, labels, n_valids = batched_nms(
+    nms = padded_nms if use_padded_nms else batched_nms
+    bboxes, scores, labels, n_valids = nms(
         bboxes, scores, iou_threshold, score_threshold,
         soft_nms_sigma=soft_nms_sigma, max_per_class=100, topk=topk)
 
@@ -5,6 +5,39 @@ import tensorflow as tf
 from hanser.ops import _pair, _meshgrid
 
 
+# Process-wide cache of anchor and point grids as NumPy arrays, keyed by everything
+# they depend on. Tensors are made from them on each call, so they can be used in
+# any graph (tf.data, tf.function).
+_GRID_CACHE = {}
+
+
+def cached_grid(key, fn):
+    if key not in _GRID_CACHE:
+        _GRID_CACHE[key] = fn()
+    return _GRID_CACHE[key]
+
+
+def _is_static(featmap_sizes):
+    return all(isinstance(s, (int, np.integer)) for size in featmap_sizes for s in size[:2])
+
+
+def _static_sizes(featmap_sizes):
+    return tuple((int(size[0]), int(size[1])) for size in featmap_sizes)
+
+
+def _flatten(mlvl_grids):
+    return np.concatenate(mlvl_grids, axis=0), tuple(len(g) for g in mlvl_grids)
+
+
+def _grid_anchors(base_anchors, featmap_size, stride):
+    # NumPy version of `AnchorGenerator.single_level_grid_anchors`
+    shift_y = np.arange(featmap_size[0]) * stride[0]
+    shift_x = np.arange(featmap_size[1]) * stride[1]
+    shift_yy, shift_xx = [x.reshape(-1) for x in np.meshgrid(shift_y, shift_x, indexing='ij')]
+    shifts = np.stack([shift_yy, shift_xx, shift_yy, shift_xx], axis=-1).astype(base_anchors.dtype)
+    return (base_anchors[None, :, :] + shifts[:, None, :]).reshape(-1, 4)
+
+
 class AnchorGenerator(object):
     """Standard anchor generator for 2D anchor-based detectors.
 
@@ -166,6 +199,8 @@ class AnchorGenerator(object):
                 num_base_anchors is the number of anchors for that level.
         """
         assert self.num_levels == len(featmap_sizes)
+        if _is_static(featmap_sizes):
+            return [tf.constant(anchors) for anchors in self._static_grid_anchors(featmap_sizes)]
         multi_level_anchors = []
         for i in range(self.num_levels):
             anchors = self.single_level_grid_anchors(
@@ -175,6 +210,31 @@ class AnchorGenerator(object):
             multi_level_anchors.append(anchors)
         return multi_level_anchors
 
+    def _static_grid_anchors(self, featmap_sizes):
+        featmap_sizes = _static_sizes(featmap_sizes)
+        multi_level_anchors = []
+        for i in range(self.num_levels):
+            base_anchors = np.asarray(self.base_anchors[i], dtype=np.float32)
+            key = ('anchors', self.strides[i], base_anchors.tobytes(), featmap_sizes[i])
+            multi_level_anchors.append(cached_grid(key, lambda: _grid_anchors(
+                base_anchors, featmap_sizes[i], self.strides[i])))
+        return multi_level_anchors
+
+    def flat_anchors(self, featmap_sizes):
+        """Anchors of all levels concatenated, and the number of anchors of each level.
+
+        Grids are built once per process for each feature map sizes, e.g. for every
+        input resolution of multi-scale training.
+
+        Returns:
+            tuple: (anchors, num_level_bboxes), tf.Tensor of shape [N, 4] and list[int].
+        """
+        key = ('flat_anchors', tuple(self.strides),
+               tuple(np.asarray(b, dtype=np.float32).tobytes() for b in self.base_anchors),
+               _static_sizes(featmap_sizes))
+        anchors, num_level_bboxes = cached_grid(key, lambda: _flatten(self._static_grid_anchors(featmap_sizes)))
+        return tf.constant(anchors), list(num_level_bboxes)
+
     def single_level_grid_anchors(self,
                                   base_anchors,
                                   featmap_size,
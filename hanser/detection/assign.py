@@ -1,13 +1,41 @@
 import numpy as np
 import tensorflow as tf
 
-from hanser.detection.iou import bbox_iou
+from hanser.detection.iou import bbox_iou, bbox_iou2
 from hanser.detection.bbox import centerness_target
+from hanser.detection.anchor import cached_grid, _is_static, _static_sizes, _flatten
 from hanser.ops import index_put, get_shape, l2_norm, _pair, _meshgrid
 
 
+def _max_ious(gt_bboxes, bboxes, tile_size):
+    # Max IoUs (and their indices) over gts of each bbox and over bboxes of each gt,
+    # computed on tiles of `tile_size` bboxes instead of the whole (num_gts, num_bboxes) IoUs.
+    num_bboxes = get_shape(bboxes, 0)
+    if tile_size is None or not isinstance(num_bboxes, int) or num_bboxes <= tile_size:
+        ious = bbox_iou(gt_bboxes, bboxes)
+        return (tf.reduce_max(ious, axis=0), tf.argmax(ious, axis=0, output_type=tf.int32),
+                tf.reduce_max(ious, axis=1), tf.argmax(ious, axis=1, output_type=tf.int32))
+
+    max_ious, argmax_ious = [], []
+    gt_max_ious = gt_argmax_ious = None
+    for start in range(0, num_bboxes, tile_size):
+        ious = bbox_iou(gt_bboxes, bboxes[start:start + tile_size])
+        max_ious.append(tf.reduce_max(ious, axis=0))
+        argmax_ious.append(tf.argmax(ious, axis=0, output_type=tf.int32))
+        tile_max_ious = tf.reduce_max(ious, axis=1)
+        tile_argmax_ious = tf.argmax(ious, axis=1, output_type=tf.int32) + start
+        if gt_max_ious is None:
+            gt_max_ious, gt_argmax_ious = tile_max_ious, tile_argmax_ious
+        else:
+            # Strictly greater, so that the first max is kept like `tf.argmax`
+            update = tile_max_ious > gt_max_ious
+            gt_max_ious = tf.where(update, tile_max_ious, gt_max_ious)
+            gt_argmax_ious = tf.where(update, tile_argmax_ious, gt_argmax_ious)
+    return tf.concat(max_ious, 0), tf.concat(argmax_ious, 0), gt_max_ious, gt_argmax_ious
+
+
 def max_iou_assign(bboxes, gt_bboxes, pos_iou_thr, neg_iou_thr,
-                   min_pos_iou=.0, match_low_quality=True, gt_max_assign_all=False):
+                   min_pos_iou=.0, match_low_quality=True, gt_max_assign_all=False, tile_size=16384):
     """Assign a corresponding gt bbox or background to each bbox.
 
     This method assign a gt bbox to every bbox (proposal/anchor), each bbox
@@ -41,6 +69,8 @@ def max_iou_assign(bboxes, gt_bboxes, pos_iou_thr, neg_iou_thr,
             in the second stage. Details are demonstrated in Step 4.
         gt_max_assign_all (bool): Whether to assign all bboxes with the same
             highest overlap with some gt to that gt.
+        tile_size (int): IoUs are computed for `tile_size` bboxes at a time, memory
+            is (num_gts, tile_size) instead of (num_gts, n). None for all at once.
     """
     assert not gt_max_assign_all, "Not implemented."
     num_gts = get_shape(gt_bboxes, 0)
@@ -50,16 +80,14 @@ def max_iou_assign(bboxes, gt_bboxes, pos_iou_thr, neg_iou_thr,
         # No truth, assign everything to background
         return tf.fill((num_bboxes,), tf.constant(0, dtype=tf.int32))
 
-    ious = bbox_iou(gt_bboxes, bboxes)
+    # for each anchor, which gt best ious with it
+    # for each anchor, the max iou of all gts
+    # for each gt, the anchor best ious with it
+    max_ious, argmax_ious, gt_max_ious, gt_argmax_ious = _max_ious(gt_bboxes, bboxes, tile_size)
 
     # 1. assign -1 by default
     assigned_gt_inds = tf.fill((num_bboxes,), tf.constant(-1, dtype=tf.int32))
 
-    # for each anchor, which gt best ious with it
-    # for each anchor, the max iou of all gts
-    max_ious = tf.reduce_max(ious, axis=0)
-    argmax_ious = tf.argmax(ious, axis=0, output_type=tf.int32)
-
     # 2. assign negative: below
     # the negative inds are set to be 0
     mask = max_ious < neg_iou_thr
@@ -70,8 +98,6 @@ def max_iou_assign(bboxes, gt_bboxes, pos_iou_thr, neg_iou_thr,
     assigned_gt_inds = tf.where(pos_inds, argmax_ious + 1, assigned_gt_inds)
 
     if match_low_quality:
-        gt_max_ious = tf.reduce_max(ious, axis=1)
-        gt_argmax_ious = tf.argmax(ious, axis=1, output_type=tf.int32)
         assigned_gt_inds = index_put(
             assigned_gt_inds, gt_argmax_ious,
             tf.where(
@@ -84,9 +110,31 @@ def max_iou_assign(bboxes, gt_bboxes, pos_iou_thr, neg_iou_thr,
     return assigned_gt_inds
 
 
-def atss_assign(bboxes, num_level_bboxes, gt_bboxes, topk=9):
-
-    NINF = tf.constant(-100000000, dtype=tf.float32)
+def _topk_closest(gt_points, points, k, tile_size):
+    # Indices of the k points closest to each gt point, merged from the closest of each
+    # tile of `tile_size` points. Ties go to the lower index, like a single `tf.math.top_k`.
+    num_points = get_shape(points, 0)
+    if tile_size is None or not isinstance(num_points, int) or num_points <= tile_size:
+        distances = l2_norm(points[None, :, :] - gt_points[:, None, :], sqrt=True)
+        return tf.math.top_k(-distances, k, sorted=False)[1]
+
+    neg_distances, idxs = [], []
+    for start in range(0, num_points, tile_size):
+        distances = l2_norm(points[None, start:start + tile_size, :] - gt_points[:, None, :], sqrt=True)
+        values, idx = tf.math.top_k(-distances, min(k, get_shape(distances, 1)), sorted=True)
+        neg_distances.append(values)
+        idxs.append(idx + start)
+    idx = tf.math.top_k(tf.concat(neg_distances, 1), k, sorted=False)[1]
+    return tf.gather(tf.concat(idxs, 1), idx, batch_dims=1)
+
+
+def atss_assign(bboxes, num_level_bboxes, gt_bboxes, topk=9, tile_size=16384):
+    """Adaptive Training Sample Selection.
+
+    Only the IoUs of the `topk` candidates of each level are computed, and center
+    distances are computed for `tile_size` bboxes at a time, so memory does not grow
+    with (num_gts, num_bboxes).
+    """
     num_gts = get_shape(gt_bboxes, 0)
     num_bboxes = get_shape(bboxes, 0)
 
@@ -94,15 +142,9 @@ def atss_assign(bboxes, num_level_bboxes, gt_bboxes, topk=9):
         # No truth, assign everything to background
         return tf.fill((num_bboxes,), tf.constant(0, dtype=tf.int32))
 
-    # compute iou between all bbox and gt
-    # (num_gts, num_bboxes)
-    ious = bbox_iou(gt_bboxes, bboxes)
-
     # compute center distance between all bbox and gt
     gt_points = (gt_bboxes[:, :2] + gt_bboxes[:, 2:]) / 2.0
     bboxes_points = (bboxes[:, :2] + bboxes[:, 2:]) / 2.0
-    # (num_gts, num_bboxes) for topk
-    distances = l2_norm(bboxes_points[None, :, :] - gt_points[:, None, :], sqrt=True)
 
     # Selecting candidates based on the center distance
     candidate_idxs = []
@@ -111,28 +153,28 @@ def atss_assign(bboxes, num_level_bboxes, gt_bboxes, topk=9):
         # on each pyramid level, for each gt,
         # select k bbox whose center are closest to the gt center
         end_idx = start_idx + bboxes_per_level
-        distances_per_level = distances[:, start_idx:end_idx]
         selectable_k = min(topk, bboxes_per_level)
-        topk_idxs_per_level = tf.math.top_k(-distances_per_level, selectable_k, sorted=False)[1]
+        topk_idxs_per_level = _topk_closest(
+            gt_points, bboxes_points[start_idx:end_idx], selectable_k, tile_size)
         candidate_idxs.append(topk_idxs_per_level + start_idx)
         start_idx = end_idx
 
     # (num_gts, num_levels * topk)
     candidate_idxs = tf.concat(candidate_idxs, axis=1)
 
-    # get corresponding iou for the these candidates, and compute the
+    # compute iou between gts and their candidates, and compute the
     # mean and std, set mean + std as the iou threshold
     # (num_gts, num_levels * topk)
-    candidate_ious = tf.gather(ious, candidate_idxs, axis=1, batch_dims=1)
+    candidate_bboxes = tf.gather(bboxes, candidate_idxs, axis=0)
+    candidate_ious = bbox_iou2(gt_bboxes[:, None, :], candidate_bboxes, is_aligned=True)
     ious_mean_per_gt = tf.reduce_mean(candidate_ious, axis=1)
     ious_std_per_gt = tf.math.reduce_std(candidate_ious, axis=1)
     ious_thr_per_gt = ious_mean_per_gt + ious_std_per_gt
-    # tf.print(ious_thr_per_gt, summarize=-1)
     is_pos = candidate_ious >= ious_thr_per_gt[:, None]
 
     # limit the positive sample's center in gt
     # (num_gts, num_levels * topk, 2)
-    ep_bboxes_cycx = tf.gather(bboxes_points, candidate_idxs, axis=0, batch_dims=1)
+    ep_bboxes_cycx = tf.gather(bboxes_points, candidate_idxs, axis=0)
     # calculate the left, top, right, bottom distance between positive
     # bbox center and gt side
     t_ = ep_bboxes_cycx[..., 0] - gt_bboxes[:, None, 0]
@@ -142,23 +184,16 @@ def atss_assign(bboxes, num_level_bboxes, gt_bboxes, topk=9):
     is_in_gts = tf.reduce_min([t_, l_, b_, r_], axis=0) > 0.01
     is_pos = is_pos & is_in_gts
 
-    candidate_idxs = candidate_idxs + tf.range(num_gts)[:, None] * num_bboxes
-
     # if an anchor box is assigned to multiple gts,
-    # the one with the highest IoU will be selected.
-    ious_inf = tf.fill((num_gts * num_bboxes,), NINF)
-    index = candidate_idxs[is_pos]
-    # tf.print("final", tf.gather(tf.reshape(ious, (-1,)), index), summarize=-1)
-    ious_inf = index_put(ious_inf, index, tf.gather(tf.reshape(ious, (-1,)), index))
-    ious_inf = tf.transpose(tf.reshape(ious_inf, (num_gts, num_bboxes)))
-
-    argmax_ious = tf.argmax(ious_inf, axis=1, output_type=tf.int32)
-    max_ious = tf.gather(ious_inf, argmax_ious, axis=1, batch_dims=1)
-
-    assigned_gt_inds = tf.where(max_ious != NINF, argmax_ious + 1, 0)
-
-    # pos = assigned_gt_inds != 0
-    # pos_ious = tf.gather(ious_inf[pos], assigned_gt_inds[pos] - 1, axis=1, batch_dims=1)
+    # the one with the highest IoU (and the lowest index) will be selected.
+    pos_idxs = candidate_idxs[is_pos]
+    pos_ious = candidate_ious[is_pos]
+    pos_gts = tf.broadcast_to(tf.range(num_gts)[:, None], tf.shape(candidate_idxs))[is_pos]
+    max_ious = tf.math.unsorted_segment_max(pos_ious, pos_idxs, num_bboxes)
+    pos_gts = tf.where(pos_ious == tf.gather(max_ious, pos_idxs), pos_gts, num_gts)
+    assigned_gts = tf.math.unsorted_segment_min(pos_gts, pos_idxs, num_bboxes)
+
+    assigned_gt_inds = tf.where(assigned_gts < num_gts, assigned_gts + 1, 0)
     return assigned_gt_inds
 
 
@@ -172,9 +207,21 @@ def mlvl_concat(xs, reps, dtype=tf.float32):
     return tf.constant(xs, dtype)
 
 
+def _grid_points(featmap_size, stride):
+    point_y = np.arange(featmap_size[0], dtype=np.float32) * np.float32(stride[0])
+    point_x = np.arange(featmap_size[1], dtype=np.float32) * np.float32(stride[1])
+    point_yy, point_xx = [x.reshape(-1) for x in np.meshgrid(point_y, point_x, indexing='ij')]
+    return np.stack([point_yy, point_xx], axis=-1)
+
+
 def grid_points(featmap_sizes, strides):
     assert len(featmap_sizes) == len(strides)
     strides = [_pair(s) for s in strides]
+    if _is_static(featmap_sizes):
+        return [
+            tf.constant(cached_grid(('points', stride, featmap_size), lambda: _grid_points(featmap_size, stride)))
+            for featmap_size, stride in zip(_static_sizes(featmap_sizes), strides)
+        ]
     mlvl_points = []
     for featmap_size, stride in zip(featmap_sizes, strides):
         feat_h, feat_w = featmap_size[0], featmap_size[1]
@@ -186,6 +233,21 @@ def grid_points(featmap_sizes, strides):
         mlvl_points.append(points)
     return mlvl_points
 
+
+def flat_grid_points(featmap_sizes, strides):
+    """Points of all levels concatenated, and the number of points of each level,
+    built once per process for each feature map sizes."""
+    strides = tuple(_pair(s) for s in strides)
+    featmap_sizes = _static_sizes(featmap_sizes)
+
+    def build():
+        return _flatten([
+            cached_grid(('points', stride, featmap_size), lambda: _grid_points(featmap_size, stride))
+            for featmap_size, stride in zip(featmap_sizes, strides)
+        ])
+    points, num_level_points = cached_grid(('flat_points', strides, featmap_sizes), build)
+    return tf.constant(points), list(num_level_points)
+
 INF = 100000000
 
 
@@ -6,6 +6,11 @@ from toolz.curried import groupby
 
 from hanser.detection.bbox import BBox
 
+try:
+    from hanser._numpy import average_precision as _average_precision
+except ImportError:
+    _average_precision = None
+
 
 def iou_mn(boxes1, boxes2):
     boxes2 = boxes2.T
@@ -26,6 +31,54 @@ def iou_mn(boxes1, boxes2):
 
 
 def average_precision(detections: List[BBox], ground_truths: List[BBox], iou_threshold=.5, use_07_metric=True, ignore_difficult=True):
+    if _average_precision is not None:
+        return average_precision_arrays(
+            [d.image_id for d in detections], [d.category_id for d in detections],
+            [d.score for d in detections], np.array([d.bbox for d in detections]).reshape(-1, 4),
+            [d.image_id for d in ground_truths], [d.category_id for d in ground_truths],
+            np.array([d.bbox for d in ground_truths]).reshape(-1, 4),
+            [d.is_difficult for d in ground_truths], iou_threshold, use_07_metric, ignore_difficult)
+    return _average_precision_py(detections, ground_truths, iou_threshold, use_07_metric, ignore_difficult)
+
+
+def average_precision_arrays(dt_image_ids, dt_labels, dt_scores, dt_bboxes,
+                             gt_image_ids, gt_labels, gt_bboxes, gt_difficult=None,
+                             iou_threshold=.5, use_07_metric=True, ignore_difficult=True):
+    """`average_precision` of flat arrays of detections and ground truths.
+
+    It is computed by the compiled `hanser._numpy` extension if it is built, and by
+    `average_precision` in Python otherwise.
+
+    Returns:
+        dict: AP of each class of the ground truths.
+    """
+    if gt_difficult is None:
+        gt_difficult = np.zeros(len(gt_labels), dtype=bool)
+    if _average_precision is None:
+        detections = [
+            BBox(image_id=i, category_id=c, score=s, bbox=b)
+            for i, c, s, b in zip(dt_image_ids, dt_labels, dt_scores, dt_bboxes)
+        ]
+        ground_truths = [
+            BBox(image_id=i, category_id=c, bbox=b, is_difficult=d)
+            for i, c, b, d in zip(gt_image_ids, gt_labels, gt_bboxes, gt_difficult)
+        ]
+        return _average_precision_py(detections, ground_truths, iou_threshold, use_07_metric, ignore_difficult)
+
+    # Image ids of any type to integers
+    n_dts = len(dt_image_ids)
+    image_ids = np.concatenate([np.asarray(dt_image_ids), np.asarray(gt_image_ids)])
+    image_ids = np.unique(image_ids, return_inverse=True)[1].reshape(-1)
+    classes, aps = _average_precision(
+        image_ids[:n_dts], np.asarray(dt_labels, dtype=np.int64), np.asarray(dt_scores, dtype=np.float64),
+        np.asarray(dt_bboxes, dtype=np.float64).reshape(-1, 4),
+        image_ids[n_dts:], np.asarray(gt_labels, dtype=np.int64),
+        np.asarray(gt_bboxes, dtype=np.float64).reshape(-1, 4), np.asarray(gt_difficult, dtype=bool),
+        iou_threshold, use_07_metric, ignore_difficult)
+    return {c: round(ap, 6) for c, ap in zip(classes.tolist(), aps.tolist())}
+
+
+def _average_precision_py(detections: List[BBox], ground_truths: List[BBox], iou_threshold=.5, use_07_metric=True, ignore_difficult=True):
     c2dts = groupby(lambda b: b.category_id, detections)
     c2gts = groupby(lambda b: b.category_id, ground_truths)
     dts = {}
@@ -1,14 +1,16 @@
 import tensorflow as tf
-from hanser.detection.iou import bbox_iou
+from hanser.detection.iou import bbox_iou, bbox_iou2
 from hanser.ops import triu
 
-def nms(bboxes, scores,
-        iou_threshold=0.5,
-        score_threshold=0.05,
-        soft_nms_sigma=0.5,
-        max_per_class=100,
-        topk=200):
-    """Non-max suppression.
+def nms_per_class(bboxes, scores,
+                  iou_threshold=0.5,
+                  score_threshold=0.05,
+                  soft_nms_sigma=0.5,
+                  max_per_class=100,
+                  topk=200):
+    """Non-max suppression with one `NonMaxSuppressionV5` per class.
+
+    Reference for `nms`, the outputs are only sorted if there are more than `topk`.
 
     Args:
         bboxes (Tensor): shape (n, q, 4)
@@ -78,29 +80,222 @@ def nms(bboxes, scores,
     return bboxes, scores, labels, n_valids
 
 
+def _top_detections(bboxes, scores, valids, num_classes, topk):
+    # bboxes, scores and valids of shape (b * #class, m, ...) to the top `topk`
+    # detections of each image, padded with zeros
+    num_groups, m = valids.shape
+    batch_size = num_groups // num_classes
+
+    bboxes = tf.reshape(bboxes, (batch_size, num_classes * m, 4))
+    scores = tf.reshape(tf.where(valids, scores, scores.dtype.min), (batch_size, num_classes * m))
+    labels = tf.repeat(tf.range(num_classes, dtype=tf.int32), m)
+    n_valids = tf.reduce_sum(tf.cast(tf.reshape(valids, (batch_size, -1)), tf.int32), axis=1)
+    n_valids = tf.minimum(n_valids, topk)
+
+    k = min(topk, num_classes * m)
+    scores, idx = tf.math.top_k(scores, k=k, sorted=True)
+    bboxes = tf.gather(bboxes, idx, batch_dims=1)
+    labels = tf.gather(labels, idx)
+
+    valids = tf.range(k)[None, :] < n_valids[:, None]
+    p = topk - k
+    bboxes = tf.pad(tf.where(valids[..., None], bboxes, 0.), [[0, 0], [0, p], [0, 0]])
+    scores = tf.pad(tf.where(valids, scores, 0.), [[0, 0], [0, p]])
+    labels = tf.pad(tf.where(valids, labels, 0), [[0, 0], [0, p]])
+    return bboxes, scores, labels, n_valids
+
+
+def _batched_soft_nms(bboxes, scores, score_threshold, soft_nms_sigma, max_per_class, topk):
+    # Padded soft-NMS of every (image, class) in a single `tf.map_fn` loop instead of
+    # one op for each of them, followed by top-k of all classes of each image.
+    batch_size, num_bboxes, num_classes = scores.shape
+
+    if bboxes.shape[2] == 1:
+        bboxes = tf.tile(bboxes, (1, 1, num_classes, 1))
+    bboxes = tf.reshape(tf.transpose(bboxes, (0, 2, 1, 3)), (batch_size * num_classes, num_bboxes, 4))
+    scores = tf.reshape(tf.transpose(scores, (0, 2, 1)), (batch_size * num_classes, num_bboxes))
+
+    def single_nms(x):
+        idx, scores, n_valids = tf.raw_ops.NonMaxSuppressionV5(
+            boxes=x[0], scores=x[1], max_output_size=max_per_class,
+            iou_threshold=1.0, score_threshold=score_threshold,
+            soft_nms_sigma=soft_nms_sigma / 2, pad_to_max_output_size=True)
+        return idx, scores, n_valids
+
+    idx, scores, n_valids = tf.map_fn(
+        single_nms, (bboxes, scores), fn_output_signature=(tf.int32, tf.float32, tf.int32))
+    bboxes = tf.gather(bboxes, idx, batch_dims=1)
+    valids = tf.range(max_per_class)[None, :] < n_valids[:, None]
+    return _top_detections(bboxes, scores, valids, num_classes, topk)
+
+
 @tf.function
 def batched_nms_raw(
     bboxes, scores, iou_threshold, score_threshold, soft_nms_sigma, max_per_class, topk):
+    """Non-max suppression of all images and classes in a single op.
 
-    batch_size = bboxes.shape[0]
-    outputs = []
-    for i in range(batch_size):
-        outputs.append(
-            nms(bboxes[i], scores[i], iou_threshold, score_threshold, soft_nms_sigma,
-                max_per_class, topk))
-    return [tf.stack(y) for y in zip(*outputs)]
+    `max_per_class` and `topk` are Python ints, and soft-NMS is used if
+    `soft_nms_sigma` is a nonzero Python float.
+    """
+    if soft_nms_sigma != 0.0:
+        return _batched_soft_nms(bboxes, scores, score_threshold, soft_nms_sigma, max_per_class, topk)
+
+    bboxes, scores, labels, n_valids = tf.image.combined_non_max_suppression(
+        bboxes, scores, max_per_class, topk, iou_threshold, score_threshold,
+        pad_per_class=False, clip_boxes=False)
+    return bboxes, scores, tf.cast(labels, tf.int32), n_valids
 
 
 def batched_nms(bboxes, scores, iou_threshold=0.5, score_threshold=0.05,
                 soft_nms_sigma=0.5, max_per_class=100, topk=200):
+    """Batched version of `nms`.
+
+    Args:
+        bboxes (Tensor): shape (b, n, q, 4)
+        scores (Tensor): shape (b, n, #class)
+
+    Returns:
+        tuple: (bboxes, scores, labels, n_valids), tensors of shape (b, k, 4), (b, k), (b, k), (b,).
+    """
     iou_threshold = tf.constant(iou_threshold, tf.float32)
     score_threshold = tf.constant(score_threshold, tf.float32)
-    soft_nms_sigma = tf.constant(soft_nms_sigma, tf.float32)
-    max_per_class = tf.constant(max_per_class, tf.int32)
-    topk = tf.constant(topk, tf.int32)
     return batched_nms_raw(
         bboxes, scores, iou_threshold, score_threshold=score_threshold,
-        soft_nms_sigma=soft_nms_sigma, max_per_class=max_per_class, topk=topk)
+        soft_nms_sigma=float(soft_nms_sigma), max_per_class=int(max_per_class), topk=int(topk))
+
+
+def nms(bboxes, scores,
+        iou_threshold=0.5,
+        score_threshold=0.05,
+        soft_nms_sigma=0.5,
+        max_per_class=100,
+        topk=200):
+    """Non-max suppression.
+
+    All classes are suppressed at once, by `tf.image.combined_non_max_suppression`
+    for hard NMS and by padded soft-NMS in a `tf.map_fn` loop otherwise, which gives
+    the same detections as `nms_per_class` sorted by scores.
+
+    Args:
+        bboxes (Tensor): shape (n, q, 4)
+        scores (Tensor): shape (n, #class)
+        iou_threshold (float): IoU threshold to be considered as conflicted.
+        score_threshold (float): bbox threshold, bboxes with scores lower than it
+            will not be considered.
+        soft_nms_sigma (float): sigma of Soft NMS (c.f. https://arxiv.org/abs/1704.04503).
+            When `soft_nms_sigma=0.0`, we fall back to standard (hard) NMS.
+        max_per_class (int): at most `max_per_class` bboxes are kept for each class.
+        topk (int): at most `topk` bboxes are kept in total.
+
+    Returns:
+        tuple: (bboxes, scores, labels, n_valids), tensors of shape (k, 4), (k,), (k,), scalar.
+            Labels are 0-based.
+    """
+    outputs = batched_nms(
+        bboxes[None], scores[None], iou_threshold, score_threshold, soft_nms_sigma, max_per_class, topk)
+    return tuple(y[0] for y in outputs)
+
+
+def _candidates(bboxes, scores, pre_nms_size, tile_size):
+    # Top `pre_nms_size` bboxes of each (image, class) sorted by scores, of shape
+    # (b * #class, k, ...) with k padded to a multiple of `tile_size`
+    batch_size, num_bboxes, num_classes = scores.shape
+    k = min(pre_nms_size, num_bboxes)
+
+    scores, idx = tf.math.top_k(tf.transpose(scores, (0, 2, 1)), k=k, sorted=True)
+    if bboxes.shape[2] == 1:
+        bboxes = tf.gather(bboxes[:, :, 0], tf.reshape(idx, (batch_size, num_classes * k)), batch_dims=1)
+    else:
+        bboxes = tf.gather(tf.transpose(bboxes, (0, 2, 1, 3)), idx, batch_dims=2)
+    bboxes = tf.reshape(bboxes, (batch_size * num_classes, k, 4))
+    scores = tf.reshape(scores, (batch_size * num_classes, k))
+
+    p = -k % tile_size
+    bboxes = tf.pad(bboxes, [[0, 0], [0, p], [0, 0]])
+    scores = tf.pad(scores, [[0, 0], [0, p]], constant_values=scores.dtype.min)
+    return bboxes, scores
+
+
+def _self_suppression(overlaps, keep):
+    # Greedy NMS inside a tile: a bbox is kept if no kept bbox before it overlaps with it.
+    # Iterating from `keep` fixes one more bbox every step, so it stops within tile_size steps.
+    def body(keep_t, changed):
+        new_keep = keep & ~tf.reduce_any(overlaps & keep_t[..., :, None], axis=-2)
+        return new_keep, tf.reduce_any(new_keep != keep_t)
+
+    keep, _ = tf.while_loop(
+        lambda keep_t, changed: changed, body, (keep, tf.constant(True)),
+        maximum_iterations=overlaps.shape[-1])
+    return keep
+
+
+def _hard_suppression(bboxes, keep, iou_threshold, tile_size):
+    # Tiled greedy NMS of bboxes sorted by scores, only IoUs of a tile with the
+    # bboxes before it are computed.
+    tiles = []
+    for start in range(0, bboxes.shape[1], tile_size):
+        tile = bboxes[:, start:start + tile_size]
+        tile_keep = keep[:, start:start + tile_size]
+        if start > 0:
+            ious = bbox_iou2(tile, bboxes[:, :start])
+            kept = tf.concat(tiles, axis=1)
+            tile_keep = tile_keep & ~tf.reduce_any((ious > iou_threshold) & kept[:, None, :], axis=-1)
+        overlaps = triu(bbox_iou2(tile, tile), diag=False) > iou_threshold
+        tiles.append(_self_suppression(overlaps, tile_keep))
+    return tf.concat(tiles, axis=1)
+
+
+def _soft_suppression(bboxes, scores, score_threshold, soft_nms_sigma, max_per_class):
+    # Gaussian soft-NMS, selects the bbox with the highest decayed score `max_per_class` times
+    num_groups, k = scores.shape
+
+    def body(i, scores, selected_idx, selected_scores):
+        idx = tf.argmax(scores, axis=1, output_type=tf.int32)
+        best = tf.reduce_max(scores, axis=1)
+        ious = bbox_iou2(tf.gather(bboxes, idx[:, None], batch_dims=1), bboxes)[:, 0]
+        scores = scores * tf.exp(-tf.square(ious) / soft_nms_sigma)
+        scores = tf.where(tf.one_hot(idx, k, on_value=True, off_value=False), scores.dtype.min, scores)
+        slot = tf.one_hot(i, max_per_class, on_value=True, off_value=False)[None, :]
+        selected_idx = tf.where(slot, idx[:, None], selected_idx)
+        selected_scores = tf.where(slot, best[:, None], selected_scores)
+        return i + 1, scores, selected_idx, selected_scores
+
+    _, _, idx, selected_scores = tf.while_loop(
+        lambda i, *_: i < max_per_class, body,
+        (tf.constant(0), scores, tf.zeros((num_groups, max_per_class), tf.int32),
+         tf.fill((num_groups, max_per_class), scores.dtype.min)))
+    return tf.gather(bboxes, idx, batch_dims=1), selected_scores, selected_scores > score_threshold
+
+
+def padded_nms(bboxes, scores, iou_threshold=0.5, score_threshold=0.05, soft_nms_sigma=0.,
+               max_per_class=100, topk=200, pre_nms_size=400, tile_size=100):
+    """Batched non-max suppression with fixed shapes, compilable by XLA (e.g. on TPU).
+
+    The top `pre_nms_size` bboxes of each image and class are suppressed together,
+    by tiled greedy NMS or by soft-NMS if `soft_nms_sigma` is nonzero. Results equal
+    those of `batched_nms` unless kept bboxes are beyond the top `pre_nms_size`.
+
+    Args:
+        bboxes (Tensor): shape (b, n, q, 4)
+        scores (Tensor): shape (b, n, #class)
+        pre_nms_size (int): number of candidates of each class.
+        tile_size (int): number of candidates whose IoUs are computed at once.
+
+    Returns:
+        tuple: (bboxes, scores, labels, n_valids), tensors of shape (b, topk, 4), (b, topk),
+            (b, topk), (b,), sorted by scores and padded with zeros.
+    """
+    num_classes = scores.shape[2]
+    tile_size = min(tile_size, pre_nms_size, scores.shape[1])
+    bboxes, scores = _candidates(bboxes, scores, pre_nms_size, tile_size)
+    if soft_nms_sigma != 0.0:
+        bboxes, scores, valids = _soft_suppression(bboxes, scores, score_threshold, soft_nms_sigma, max_per_class)
+    else:
+        keep = _hard_suppression(bboxes, scores > score_threshold, iou_threshold, tile_size)
+        scores, idx = tf.math.top_k(tf.where(keep, scores, scores.dtype.min), k=min(max_per_class, scores.shape[1]))
+        bboxes = tf.gather(bboxes, idx, batch_dims=1)
+        valids = tf.gather(keep, idx, batch_dims=1)
+    return _top_detections(bboxes, scores, valids, num_classes, topk)
 
 
 def fast_nms(bboxes,
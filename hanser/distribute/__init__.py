@@ -3,10 +3,12 @@ from typing import Optional
 import tensorflow as tf
 
 from hanser.distribute.gpu import has_gpu, setup_gpu
-from hanser.distribute.tpu import has_tpu, setup_tpu, local_results
+from hanser.distribute.tpu import has_tpu, setup_tpu
+from hanser.distribute.multi_worker import has_multi_worker, setup_multi_worker, is_chief, worker_tmp_dir
 
 
-__all__ = ["setup_runtime", "distribute_datasets"]
+__all__ = ["setup_runtime", "distribute_datasets", "distribute_datasets_from_function",
+           "distribute_dataset_builder", "is_chief"]
 
 
 def discover_device():
@@ -18,10 +20,15 @@ def discover_device():
         return 'CPU'
 
 
-def setup_runtime(device='auto', fp16=True):
+def setup_runtime(device='auto', fp16=True, multi_worker='auto'):
     if device == 'auto':
         device = discover_device()
-    if device == 'TPU':
+    if multi_worker == 'auto':
+        multi_worker = device != 'TPU' and has_multi_worker()
+    if multi_worker:
+        # GPU or CPU workers from TF_CONFIG
+        setup_multi_worker(fp16)
+    elif device == 'TPU':
         setup_tpu(fp16)
     elif device == 'GPU':
         setup_gpu(fp16)
@@ -29,15 +36,70 @@ def setup_runtime(device='auto', fp16=True):
         pass
 
 
-def distribute_datasets(*datasets):
+def distribute_datasets(*datasets, shard_policy=tf.data.experimental.AutoShardPolicy.AUTO):
+    # With multiple workers, datasets are sharded by `shard_policy` (AUTO: by files if possible, otherwise by data)
     strategy = tf.distribute.get_strategy()
     if is_distribute_strategy(strategy):
+        if is_multi_worker_strategy(strategy):
+            datasets = [_with_shard_policy(ds, shard_policy)
+                        if not isinstance(ds, tf.distribute.DistributedDataset) else ds for ds in datasets]
         datasets = [(strategy.experimental_distribute_dataset(ds)
                      if not isinstance(ds, tf.distribute.DistributedDataset) else ds) for ds in datasets]
     datasets = tuple(datasets)
     return datasets
 
 
+def distribute_datasets_from_function(*dataset_fns):
+    # Each `dataset_fn(input_context)` builds the per-replica dataset of one input pipeline
+    strategy = tf.distribute.get_strategy()
+    datasets = []
+    for dataset_fn in dataset_fns:
+        if is_distribute_strategy(strategy):
+            distribute_fn = getattr(strategy, 'distribute_datasets_from_function', None) or \
+                            strategy.experimental_distribute_datasets_from_function
+            datasets.append(distribute_fn(dataset_fn))
+        else:
+            datasets.append(dataset_fn(tf.distribute.InputContext()))
+    return tuple(datasets)
+
+
+def distribute_dataset_builder(make_dataset, *args, **kwargs):
+    """Distribute the datasets returned by a dataset builder, one input pipeline per worker.
+
+    `make_dataset(*args, input_context=input_context, **kwargs)` is called once for
+    each input pipeline and must shard its input by `input_context`, as
+    `make_imagenet_dataset` or `make_numpy_dataset` do. Outputs that are not datasets
+    (e.g. steps) are returned unchanged.
+
+    Examples:
+        >>> ds_train, ds_eval, steps_per_epoch, eval_steps = distribute_dataset_builder(
+        ...     make_imagenet_dataset, batch_size, eval_batch_size, transform, data_dir=data_dir)
+    """
+    outputs = {}
+
+    def build(input_context):
+        key = (input_context.input_pipeline_id, input_context.num_input_pipelines,
+               input_context.num_replicas_in_sync)
+        if key not in outputs:
+            outputs[key] = make_dataset(*args, input_context=input_context, **kwargs)
+        return outputs[key]
+
+    results = build(tf.distribute.InputContext())
+    if not is_distribute_strategy(tf.distribute.get_strategy()):
+        return results
+    results = list(results)
+    for i, x in enumerate(results):
+        if isinstance(x, tf.data.Dataset):
+            results[i] = distribute_datasets_from_function(lambda ctx, i=i: build(ctx)[i])[0]
+    return tuple(results)
+
+
+def _with_shard_policy(ds, shard_policy):
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = shard_policy
+    return ds.with_options(options)
+
+
 def strategy_run(strategy, fn, args):
     if strategy is not None:
         return strategy.run(fn, args=args)
@@ -51,8 +113,31 @@ def is_tpu_strategy(strategy):
     return "TPUStrategy" in type(strategy).__name__
 
 
+def is_multi_worker_strategy(strategy):
+    # The class is named CollectiveAllReduceStrategy
+    return isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy)
+
+
 def is_distribute_strategy(strategy):
-    return is_tpu_strategy(strategy)
+    # Single-host MirroredStrategy is not handled and runs as without a strategy
+    return is_tpu_strategy(strategy) or is_multi_worker_strategy(strategy)
+
+
+def local_results(values, strategy='auto'):
+    if strategy == 'auto':
+        strategy = tf.distribute.get_strategy()
+    def func(x):
+        # Results of replicas on other workers are needed by host metrics of every
+        # worker, gather them with a collective. With one replica per worker they
+        # are plain tensors.
+        if is_multi_worker_strategy(strategy):
+            return strategy.gather(x, axis=0)
+        if "PerReplica" in type(x).__name__:
+            assert is_distribute_strategy(strategy)
+            x = strategy.experimental_local_results(x)
+            return tf.concat(x, axis=0)
+        return x
+    return tf.nest.map_structure(func, values)
 
 
 def parse_strategy(strategy='auto') -> Optional[tf.distribute.Strategy]:
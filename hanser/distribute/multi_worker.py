@@ -0,0 +1,57 @@
+import os
+import json
+
+import tensorflow as tf
+import tensorflow.keras.mixed_precision.experimental as mixed_precision
+
+
+def get_tf_config():
+    tf_config = os.environ.get("TF_CONFIG")
+    if not tf_config:
+        return None
+    return json.loads(tf_config)
+
+
+def has_multi_worker():
+    tf_config = get_tf_config()
+    if tf_config is None:
+        return False
+    cluster = tf_config.get('cluster', {})
+    return sum(len(cluster.get(k, [])) for k in ['chief', 'worker']) > 1
+
+
+def setup_multi_worker(fp16=True):
+    # Workers are discovered from TF_CONFIG, must be called before any other TF ops
+    assert has_multi_worker()
+    tf.keras.backend.clear_session()
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    tf.distribute.experimental_set_strategy(strategy)
+
+    if fp16 and len(tf.config.list_physical_devices('GPU')) > 0:
+        policy = mixed_precision.Policy('mixed_float16')
+        mixed_precision.set_policy(policy)
+
+
+def get_task():
+    tf_config = get_tf_config()
+    if tf_config is None or 'task' not in tf_config:
+        return None, None
+    task = tf_config['task']
+    return task['type'], int(task['index'])
+
+
+def is_chief():
+    task_type, task_id = get_task()
+    if task_type is None:
+        return True
+    if task_type == 'chief':
+        return True
+    cluster = get_tf_config().get('cluster', {})
+    return task_type == 'worker' and task_id == 0 and 'chief' not in cluster
+
+
+def worker_tmp_dir(work_dir):
+    # Non-chief workers must take part in saving, but write to a temporary dir
+    task_type, task_id = get_task()
+    return work_dir / (".tmp_%s_%d" % (task_type, task_id))
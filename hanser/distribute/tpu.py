@@ -36,15 +36,3 @@ def is_tpu_strategy(strategy):
     if strategy is None:
         return False
     return "TPUStrategy" in type(strategy).__name__
-
-
-def local_results(values, strategy='auto'):
-    if strategy == 'auto':
-        strategy = tf.distribute.get_strategy()
-    def func(x):
-        if "PerReplica" in type(x).__name__:
-            assert is_tpu_strategy(strategy)
-            x = strategy.experimental_local_results(x)
-            return tf.concat(x, axis=0)
-        return x
-    return tf.nest.map_structure(func, values)
\ No newline at end of file
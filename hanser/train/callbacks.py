@@ -1,15 +1,22 @@
+import time
 import warnings
 
 from toolz import curry
 import numpy as np
 from hhutil.io import time_now
+import tensorflow as tf
+from tensorflow.python.eager import context
 from tensorflow_addons.optimizers import MovingAverage
+from hanser.distribute import is_chief
+from hanser.train.metric_history import MetricHistory
 from hanser.models.modules import DropPath, DropBlock
 
 
 @curry
 def log_metrics(stage, metrics, epoch, writer=None, metric_history=None, stage_name=None, print_fn=print):
     stage_name = stage_name or stage
+    # Only the chief worker writes summaries
+    writer = writer if is_chief() else None
     end_at = time_now()
     log_str = "%s %s - " % (end_at, stage_name)
     metric_logs = []
@@ -25,6 +32,18 @@ def log_metrics(stage, metrics, epoch, writer=None, metric_history=None, stage_n
     print_fn(log_str)
 
 
+def block_until_ready(tensors):
+    """Wait until the device work producing `tensors` is done.
+
+    A scalar depending on every tensor is fetched to the host, which waits for
+    the pending kernels on the device.
+    """
+    context.async_wait()
+    tensors = [x for x in tf.nest.flatten(tensors) if isinstance(x, tf.Tensor) and x.dtype != tf.string]
+    if tensors:
+        tf.add_n([tf.reduce_sum(tf.cast(tf.reshape(x, [-1])[:1], tf.float32)) for x in tensors]).numpy()
+
+
 def config_callbacks(
     learner,
     callbacks=None,
@@ -51,15 +70,26 @@ def config_callbacks(
 class CallbackList(object):
     def __init__(self, learner, callbacks=None):
         self.learner = learner
-        self.callbacks = [c for c in callbacks]
+        self.callbacks = [c for c in callbacks or []]
         for c in self.callbacks:
             c.learner = learner
             c.init()
+        self._graph_split = None
+
+    def split_graph_safe(self):
+        # Cached, so that compiled steps taking the lists are not retraced
+        if self._graph_split is None:
+            graph_cbks, host_cbks = CallbackList(self.learner), CallbackList(self.learner)
+            graph_cbks.callbacks = [c for c in self.callbacks if c.graph_safe]
+            host_cbks.callbacks = [c for c in self.callbacks if not c.graph_safe]
+            self._graph_split = graph_cbks, host_cbks
+        return self._graph_split
 
     def append(self, callback):
         callback.learner = self.learner
         callback.init()
         self.callbacks.append(callback)
+        self._graph_split = None
 
     def __iter__(self):
         return iter(self.callbacks)
@@ -116,6 +146,9 @@ class CallbackList(object):
 class Callback(object):
 
     priority = 0
+    # `begin_batch` and `after_batch` of graph-safe callbacks only use TF ops,
+    # and are traced into compiled steps with `steps_per_execution`
+    graph_safe = False
 
     def __init__(self):
         self.learner = None
@@ -161,18 +194,28 @@ class Callback(object):
 
 class ModelCheckpoint(Callback):
 
-    def __init__(self, save_freq=1):
+    def __init__(self, save_freq=1, max_to_keep=1, keep_best=None, num_best=1, best_stage='eval'):
         super().__init__()
         self.save_freq = save_freq
+        self.max_to_keep = max_to_keep
+        self.keep_best = keep_best
+        self.num_best = num_best
+        self.best_stage = best_stage
+
+    def init(self):
+        self.learner._ckpt_manager.set_retention(
+            self.max_to_keep, self.keep_best, self.num_best, self.best_stage)
 
     def after_epoch(self, state):
         epoch = self.learner.epoch + 1
         if epoch % self.save_freq == 0:
             self.learner.save()
+            self.learner.record_checkpoint_metrics()
 
     def after_eval(self, state):
         epoch = self.learner.epoch + 1
         if epoch % self.save_freq == 0:
+            self.learner.record_checkpoint_metrics()
             self.learner.save_state()
 
 class TrainEvalLogger(Callback):
@@ -209,6 +252,8 @@ class EvalLogger(Callback):
 
 class EMA(Callback):
 
+    graph_safe = True
+
     def init(self):
         assert isinstance(self.learner.optimizers[0], MovingAverage)
         # if self.decay is not None:
@@ -230,6 +275,8 @@ class EMA(Callback):
 
 class DropPathRateSchedule(Callback):
 
+    graph_safe = True
+
     def __init__(self, drop_path):
         super().__init__()
         warnings.warn(
@@ -249,6 +296,8 @@ class DropPathRateSchedule(Callback):
 
 class DropPathRateScheduleV2(Callback):
 
+    graph_safe = True
+
     def __init__(self):
         super().__init__()
 
@@ -266,6 +315,8 @@ class DropPathRateScheduleV2(Callback):
 
 class DropBlockSchedule(Callback):
 
+    graph_safe = True
+
     def __init__(self):
         super().__init__()
 
@@ -324,7 +375,7 @@ class NNIReportIntermediateResult(Callback):
             nni.report_intermediate_result(val_metric)
 
     def after_eval(self, state):
-        final_metric = self.learner.metric_history.get_metric(self.metric, "eval")[-1]
+        final_metric = self.learner.metric_history.latest(self.metric, "eval")
         import nni
         nni.report_final_result(final_metric)
 
@@ -345,3 +396,130 @@ class OptunaReportIntermediateResult(Callback):
             self.learner._terminated = True
             import optuna
             raise optuna.TrialPruned()
+
+
+
+class Profiler(Callback):
+    """Record per-step timing of training and evaluation.
+
+    Wall time of a step is split into time blocked on `next(iterator)` (data),
+    time of copying the batch to the device (transfer) and the rest (compute).
+    The device is synchronized before the timer of a step is stopped, so compute
+    time covers the device work rather than only dispatching the step. Transfer
+    is timed by an explicit copy of the batch before the step when running on a
+    single device without a strategy, distributed iterators place batches on the
+    replicas themselves and their transfer is part of data time. Percentiles in
+    milliseconds are recorded to `history` of the profiler (kept apart from the
+    metrics of the learner) and under `profile/` of `learner._writer` after each
+    epoch. With `steps_per_execution` an execution is timed as one step, when the
+    whole epoch is compiled (`multiple_steps`) no step timing is available.
+
+    A `tf.profiler` trace of steps [start, end) in `trace_epoch` is captured if
+    `trace_steps=(start, end)` is given.
+    """
+
+    def __init__(self, percentiles=(50, 90, 99), trace_steps=None, trace_epoch=0, log_dir=None, print_fn=print):
+        super().__init__()
+        self.percentiles = percentiles
+        self.trace_steps = trace_steps
+        self.trace_epoch = trace_epoch
+        self.log_dir = log_dir
+        self.print_fn = print_fn
+
+        # stage -> epoch -> timing percentiles
+        self.history = MetricHistory(["train", "eval"])
+        self._mode = None
+        self._tracing = False
+        self._step_start = None
+        self._times = {}
+
+    def _reset(self, mode):
+        self._mode = mode
+        self._times = {
+            'step_time': [],
+            'data_time': [],
+            'transfer_time': [],
+            'compute_time': [],
+        }
+
+    def begin_epoch(self, state):
+        self._reset('train')
+        state['profile_transfer'] = True
+
+    def begin_eval(self, state):
+        self._reset('eval')
+        state['profile_transfer'] = True
+
+    def _sync(self):
+        # Steps return before the device finishes, wait for the metric updates at
+        # the end of the step
+        metrics = getattr(self.learner, self._mode + "_metrics")
+        block_until_ready([
+            v.value() for m in metrics.values() if isinstance(m, tf.keras.metrics.Metric)
+            for v in m.variables
+        ])
+
+    def _should_trace(self, step):
+        if self.trace_steps is None or self._mode != 'train' or self.learner.epoch != self.trace_epoch:
+            return False
+        start, end = self.trace_steps
+        return start <= step < end
+
+    def begin_batch(self, state):
+        if not tf.executing_eagerly():
+            return
+        if self.trace_steps is not None and not self._tracing and self._should_trace(int(state['step'])):
+            log_dir = self.log_dir or str(self.learner._log_dir / "profile")
+            tf.profiler.experimental.start(log_dir)
+            self._tracing = True
+        state.pop('data_time', None)
+        state.pop('transfer_time', None)
+        self._step_start = time.perf_counter()
+
+    def after_batch(self, state):
+        if not tf.executing_eagerly():
+            return
+        self._sync()
+        step_time = time.perf_counter() - self._step_start
+        self._times['step_time'].append(step_time)
+        data_time = state.get('data_time')
+        transfer_time = state.get('transfer_time')
+        if data_time is not None:
+            self._times['data_time'].append(data_time)
+            compute_time = step_time - data_time
+            if transfer_time is not None:
+                self._times['transfer_time'].append(transfer_time)
+                compute_time -= transfer_time
+            self._times['compute_time'].append(compute_time)
+        if self._tracing and not self._should_trace(int(state['step']) + 1):
+            tf.profiler.experimental.stop()
+            self._tracing = False
+
+    def _report(self, stage):
+        learner = self.learner
+        writer = learner._writer if is_chief() else None
+        epoch = learner.epoch
+        metric_logs = []
+        for k, times in self._times.items():
+            if not times:
+                continue
+            values = np.percentile(np.array(times) * 1000, self.percentiles)
+            for p, v in zip(self.percentiles, values):
+                name = "%s_p%d" % (k, p)
+                metric_logs.append("%s: %.1fms" % (name, v))
+                if writer:
+                    writer.add_scalar("profile/%s/%s" % (name, stage), v, epoch)
+                self.history.record(stage, epoch, name, v)
+        if metric_logs:
+            self.print_fn("%s %s profile - %s" % (time_now(), stage, ", ".join(metric_logs)))
+
+    def after_epoch(self, state):
+        if self._tracing:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+        state.pop('profile_transfer', None)
+        self._report('train')
+
+    def after_eval(self, state):
+        state.pop('profile_transfer', None)
+        self._report('eval')
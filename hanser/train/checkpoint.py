@@ -0,0 +1,239 @@
+import os
+import json
+import queue
+import itertools
+import threading
+from typing import Optional
+
+import tensorflow as tf
+
+from hhutil.io import fmt_path, eglob, rm
+
+
+def remove_file(f):
+    # Truncate before removing, so deleted checkpoints don't occupy the trash of synced drives
+    f.write_bytes(b'')
+    rm(f)
+
+
+def write_bytes_atomic(fp, data):
+    fp = fmt_path(fp)
+    tmp_fp = fp.parent / ("_%s_tmp" % fp.name)
+    tmp_fp.write_bytes(data)
+    os.replace(tmp_fp, fp)
+
+
+def tmp_prefix(save_path):
+    save_path = fmt_path(save_path)
+    return save_path.parent / ("_%s_tmp" % save_path.name)
+
+
+def publish_checkpoint(src_prefix, save_path):
+    """Rename checkpoint files of `src_prefix` to `save_path` in the same directory.
+
+    Data shards are renamed before the index file and every rename replaces the old
+    file atomically, so a checkpoint always exists at `save_path`. Stale shards of
+    the old checkpoint are removed afterwards.
+    """
+    src_prefix, save_path = fmt_path(src_prefix), fmt_path(save_path)
+    save_dir = save_path.parent
+    index_name = src_prefix.name + ".index"
+    files = sorted(eglob(save_dir, src_prefix.name + ".*"), key=lambda f: f.name == index_name)
+    published = set()
+    for f in files:
+        target = save_dir / (save_path.name + f.name[len(src_prefix.name):])
+        os.replace(f, target)
+        published.add(target.name)
+    for f in list(eglob(save_dir, save_path.name + ".*")):
+        if f.name not in published:
+            remove_file(f)
+
+
+def write_checkpoint(ckpt, save_path, options=None):
+    src_prefix = tmp_prefix(save_path)
+    ckpt.write(str(src_prefix), options)
+    publish_checkpoint(src_prefix, save_path)
+    return str(save_path)
+
+
+class AsyncCheckpointWriter:
+    """Write checkpoints on a background thread.
+
+    `write` snapshots the checkpoint to host memory (`ram://`) and returns, the
+    snapshot is copied to disk and published by a worker thread. Jobs run in
+    submission order. At most `max_pending` snapshots are kept in memory, `write`
+    blocks until one of them is published.
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, max_pending=1):
+        self._slots = threading.Semaphore(max_pending)
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            fn, args, on_done = self._queue.get()
+            try:
+                if self._error is None:
+                    fn(*args)
+            except Exception as e:
+                self._error = e
+            finally:
+                if on_done is not None:
+                    on_done()
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise RuntimeError("Background checkpoint writing failed") from e
+
+    def submit(self, fn, *args):
+        self._raise_error()
+        self._queue.put((fn, args, None))
+
+    def write(self, ckpt, save_path, options=None):
+        self._raise_error()
+        self._slots.acquire()
+        snapshot = "ram://hanser_ckpt/%d/ckpt" % next(self._ids)
+        try:
+            ckpt.write(snapshot, options)
+        except Exception:
+            self._slots.release()
+            raise
+
+        def on_done():
+            for f in tf.io.gfile.glob(snapshot + "*"):
+                tf.io.gfile.remove(f)
+            self._slots.release()
+
+        self._queue.put((self._commit, (snapshot, fmt_path(save_path)), on_done))
+        return str(save_path)
+
+    @staticmethod
+    def _commit(snapshot, save_path):
+        src_prefix = tmp_prefix(save_path)
+        for f in tf.io.gfile.glob(snapshot + ".*"):
+            tf.io.gfile.copy(f, str(src_prefix) + f[len(snapshot):], overwrite=True)
+        publish_checkpoint(src_prefix, save_path)
+
+    def wait(self):
+        self._queue.join()
+        self._raise_error()
+
+
+class CheckpointManager:
+    """Keep versioned checkpoints `{prefix}-{epoch}` in `directory`.
+
+    The last `max_to_keep` checkpoints are kept, plus the best `num_best` ones for
+    each metric of `best_stage` in `keep_best` (metric -> 'max' or 'min'). All
+    checkpoints are listed in an index file, so the latest or the best one can be
+    found without scanning the directory. The index is only updated after the
+    checkpoint has been written, and pruned checkpoints are removed after that.
+    """
+
+    def __init__(self, directory, max_to_keep=1, keep_best=None, num_best=1, best_stage='eval',
+                 prefix='ckpt', writer: Optional[AsyncCheckpointWriter] = None):
+        self.directory = fmt_path(directory)
+        self.prefix = prefix
+        self.writer = writer
+        self.set_retention(max_to_keep, keep_best, num_best, best_stage)
+        self._index_file = self.directory / ("%s_index.json" % prefix)
+        self._checkpoints = self._read_index()
+
+    def set_retention(self, max_to_keep=1, keep_best=None, num_best=1, best_stage='eval'):
+        keep_best = dict(keep_best or {})
+        assert all(mode in ['max', 'min'] for mode in keep_best.values())
+        assert max_to_keep is None or max_to_keep >= 1
+        self.max_to_keep = max_to_keep
+        self.keep_best = keep_best
+        self.num_best = num_best
+        self.best_stage = best_stage
+
+    def _read_index(self):
+        if not self._index_file.exists():
+            return []
+        return json.loads(self._index_file.read_text())['checkpoints']
+
+    def _run(self, fn, *args):
+        if self.writer is not None:
+            self.writer.submit(fn, *args)
+        else:
+            fn(*args)
+
+    @property
+    def checkpoints(self):
+        return [c['name'] for c in self._checkpoints]
+
+    def _path(self, c):
+        return str(self.directory / c['name'])
+
+    @property
+    def latest_checkpoint(self):
+        if not self._checkpoints:
+            return None
+        return self._path(max(self._checkpoints, key=lambda c: c['epoch']))
+
+    @property
+    def latest_epoch(self):
+        if not self._checkpoints:
+            return None
+        return max(c['epoch'] for c in self._checkpoints)
+
+    def best_checkpoint(self, metric):
+        mode = self.keep_best[metric]
+        cands = [c for c in self._checkpoints if metric in c['metrics']]
+        if not cands:
+            return None
+        select = max if mode == 'max' else min
+        return self._path(select(cands, key=lambda c: c['metrics'][metric]))
+
+    def save(self, ckpt, epoch, options=None):
+        name = "%s-%d" % (self.prefix, epoch + 1)
+        save_path = self.directory / name
+        if self.writer is not None:
+            path = self.writer.write(ckpt, save_path, options)
+        else:
+            path = write_checkpoint(ckpt, save_path, options)
+        self._checkpoints = [c for c in self._checkpoints if c['name'] != name]
+        self._checkpoints.append({'name': name, 'epoch': epoch, 'metrics': {}})
+        self._update()
+        return path
+
+    def record(self, epoch, metrics):
+        for c in self._checkpoints:
+            if c['epoch'] == epoch:
+                c['metrics'].update({
+                    k: float(v) for k, v in metrics.items()
+                    if k in self.keep_best and v is not None
+                })
+                self._update()
+                return
+
+    def _update(self):
+        removed = self._sweep()
+        data = json.dumps({'checkpoints': self._checkpoints}, indent=2).encode()
+        self._run(write_bytes_atomic, self._index_file, data)
+        for c in removed:
+            self._run(self._remove, c['name'])
+
+    def _sweep(self):
+        ckpts = sorted(self._checkpoints, key=lambda c: c['epoch'])
+        if self.max_to_keep is None:
+            keep = set(c['name'] for c in ckpts)
+        else:
+            keep = set(c['name'] for c in ckpts[-self.max_to_keep:])
+        for metric, mode in self.keep_best.items():
+            cands = [c for c in ckpts if metric in c['metrics']]
+            cands = sorted(cands, key=lambda c: c['metrics'][metric], reverse=mode == 'max')
+            keep.update(c['name'] for c in cands[:self.num_best])
+        self._checkpoints = [c for c in ckpts if c['name'] in keep]
+        return [c for c in ckpts if c['name'] not in keep]
+
+    def _remove(self, name):
+        for f in list(eglob(self.directory, name + ".*")):
+            remove_file(f)
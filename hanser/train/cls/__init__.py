@@ -1,3 +1,5 @@
+from contextlib import nullcontext
+
 import tensorflow as tf
 
 from hanser.train.learner import Learner, cast
@@ -10,6 +12,10 @@ class SuperLearner(Learner):
         self.grad_clip_norm = grad_clip_norm
         self.batch_transform = batch_transform
         super().__init__(model, criterion, optimizer, **kwargs)
+        self._grad_accumulators = None
+
+        if self.xla_compile:
+            self._micro_batch_grads = tf.function(self._micro_batch_grads, experimental_compile=True)
 
     def train_batch(self, batch):
         model = self.model
@@ -29,9 +35,80 @@ class SuperLearner(Learner):
         self.minimize(tape, optimizer, loss, model.trainable_variables, self.grad_clip_norm)
         self.update_metrics(self.train_metrics, target, preds, per_example_loss)
 
+    def _micro_batch_grads(self, batch, n_batches):
+        model = self.model
+        optimizer = self.optimizers[0]
+
+        inputs, target = batch
+        if self.batch_transform is not None:
+            inputs, target = self.batch_transform(inputs, target)
+        with tf.GradientTape() as tape:
+            inputs = cast(inputs, self.dtype)
+            preds = model(inputs, training=True)
+            preds = cast(preds, tf.float32)
+            per_example_loss = self.criterion(target, preds)
+            loss = self.reduce_loss(per_example_loss) / n_batches
+            if self.dtype == tf.float16:
+                loss = optimizer.get_scaled_loss(loss)
+        grads = tape.gradient(loss, model.trainable_variables)
+        self.update_metrics(self.train_metrics, target, preds, per_example_loss)
+        return grads
+
+    def init_state(self, mode, epochs=None):
+        super().init_state(mode, epochs)
+        if mode == 'train' and self.n_batches_per_step is not None:
+            self._build_grad_accumulators()
+
+    def _build_grad_accumulators(self):
+        # Replica-local accumulators of gradients, created outside of the compiled
+        # step, the model must be built before training
+        if self._grad_accumulators is not None:
+            return
+        strategy = self._strategy
+        with strategy.scope() if strategy is not None else nullcontext():
+            self._grad_accumulators = [
+                tf.Variable(tf.zeros_like(v), trainable=False,
+                            synchronization=tf.VariableSynchronization.ON_READ,
+                            aggregation=tf.VariableAggregation.SUM)
+                for v in self.model.trainable_variables
+            ]
+
     def train_batches(self, *batches):
-        batch = tuple(tf.concat(xs, axis=0) for xs in zip(*batches))
-        return self.train_batch(batch)
+        # Gradient accumulation. Micro-batches are stacked and run one at a time in
+        # a graph loop, so that only activations of one micro-batch are alive and
+        # the graph doesn't grow with `n_batches_per_step`.
+        optimizer = self.optimizers[0]
+        accumulators = self._grad_accumulators
+        n_batches = len(batches)
+        batches = tf.nest.map_structure(lambda *xs: tf.stack(xs), *batches)
+        for acc in accumulators:
+            acc.assign(tf.zeros_like(acc))
+        # Variables with gradients, found when tracing
+        connected = []
+        for i in tf.range(n_batches):
+            tf.autograph.experimental.set_loop_options(parallel_iterations=1)
+            batch = tf.nest.map_structure(lambda x: x[i], batches)
+            self._accumulate_grads(batch, n_batches, connected)
+        grads = [
+            acc.read_value() if c else None
+            for acc, c in zip(accumulators, connected)
+        ]
+        # Gradients are scaled by the same loss scale, unscale once after accumulation
+        if self.dtype == tf.float16:
+            grads = optimizer.get_unscaled_gradients(grads)
+        self.apply_gradients(optimizer, grads, self.model.trainable_variables, self.grad_clip_norm)
+
+    def _accumulate_grads(self, batch, n_batches, connected):
+        micro_grads = self._micro_batch_grads(batch, n_batches)
+        for acc, g in zip(self._grad_accumulators, micro_grads):
+            if g is None:
+                continue
+            # Sparse gradients (`tf.IndexedSlices` of embeddings or gathers)
+            if isinstance(g, tf.IndexedSlices):
+                acc.scatter_add(g)
+            else:
+                acc.assign_add(g)
+        connected[:] = [g is not None for g in micro_grads]
 
     def _eval_batch(self, batch):
         inputs, target = batch
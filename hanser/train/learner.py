@@ -2,17 +2,23 @@ from abc import ABCMeta
 from bisect import bisect_right
 from typing import Sequence, Mapping, Optional
 
+import time
+import json
 import pickle
 
+import numpy as np
+
 import tensorflow as tf
 import tensorflow.keras.mixed_precision.experimental as mixed_precision
 from tensorflow.keras.metrics import Metric, Mean
 
-from hhutil.io import fmt_path, eglob, rm, time_now
+from hhutil.io import fmt_path, time_now, rm
 
-from hanser.distribute import parse_strategy, strategy_run, is_distribute_strategy, local_results, discover_device
-from hanser.train.metric_history import MetricHistory
-from hanser.train.callbacks import config_callbacks, log_metrics
+from hanser.distribute import parse_strategy, strategy_run, is_distribute_strategy, is_tpu_strategy, local_results, \
+    discover_device, is_chief, worker_tmp_dir, is_multi_worker_strategy
+from hanser.train.metric_history import MetricHistory, append_log, read_log
+from hanser.train.checkpoint import AsyncCheckpointWriter, CheckpointManager, write_checkpoint, write_bytes_atomic
+from hanser.train.callbacks import config_callbacks, log_metrics, block_until_ready
 
 
 def validate_freq(freqs):
@@ -57,6 +63,24 @@ def default_metric_transform(x):
         return x[0]
     return x
 
+def _make_metric_results_fn(metrics):
+    # Results are flattened and concatenated per dtype, so they are fetched in a few
+    # transfers without casting (e.g. int64 counts above 2^24 are exact)
+    specs = []
+
+    @tf.function
+    def fn():
+        specs.clear()
+        groups = {}
+        for m in metrics:
+            r = m.result()
+            specs.append((tuple(r.shape), r.dtype.name))
+            groups.setdefault(r.dtype.name, []).append(tf.reshape(r, [-1]))
+        return {dtype: tf.concat(values, axis=0) for dtype, values in groups.items()}
+
+    return fn, specs
+
+
 def is_global_bfloat16():
     return mixed_precision.global_policy().compute_dtype == 'bfloat16'
 
@@ -74,12 +98,19 @@ def cast(xs, dtype, whiltelist=(tf.int32, tf.int64, tf.bool)):
 
 
 class Learner(metaclass=ABCMeta):
+    """
+    With `steps_per_execution`, that many steps are compiled into one graph on any
+    device. `begin_batch` and `after_batch` of callbacks with `graph_safe` are traced
+    into the graph and called every step. Those of other (host) callbacks are called
+    once per execution, before its first step and after its last one.
+    """
 
     def __init__(self, model, criterion, optimizers,
                  train_metrics: Mapping[str, Metric], eval_metrics: Mapping[str, Metric],
                  work_dir: str, output_transform=default_metric_transform,
                  n_batches_per_step: Optional[int] = None, multiple_steps: Optional[bool] = None,
-                 xla_compile: bool = True):
+                 xla_compile: bool = True, steps_per_execution: Optional[int] = None,
+                 async_save: bool = False, max_pending_saves: int = 1):
         if not isinstance(optimizers, Sequence):
             optimizers = [optimizers]
         optimizers = list(optimizers)
@@ -103,15 +134,23 @@ class Learner(metaclass=ABCMeta):
         self.output_transform = output_transform
 
         device = discover_device()
+        self._device = device
         if multiple_steps is None:
-            multiple_steps = device == 'TPU'
+            multiple_steps = device == 'TPU' and steps_per_execution is None
         self.multiple_steps = multiple_steps
+        # Compile `steps_per_execution` steps into one graph on any device,
+        # batch hooks of host callbacks are called once per execution
+        self.steps_per_execution = steps_per_execution
         self.xla_compile = xla_compile
 
         self._log_dir = self.work_dir / "runs"
         self._writer = None
+        # Checkpoints are snapshotted to host memory and written by a background thread
+        self._ckpt_writer = AsyncCheckpointWriter(max_pending_saves) if async_save else None
+        self._ckpt_manager = CheckpointManager(self.work_dir, writer=self._ckpt_writer)
 
-        self._verbose = True
+        # Only the chief worker prints logs and writes checkpoints
+        self._verbose = is_chief()
         self._state = {
             "train": {},
             "eval": {},
@@ -125,17 +164,23 @@ class Learner(metaclass=ABCMeta):
         self._max_epochs = None
 
         self._terminated = False
+        # (step checkpoint, step) to resume in the middle of an epoch
+        self._resume_step = None
         self.set_global_state("epoch", -1)
         self._epoch_var = tf.Variable(self.epoch, dtype=tf.int64) # TODO: no need to use var
 
         if self.xla_compile:
             self.train_batch = tf.function(self.train_batch, experimental_compile=True)
 
-        if multiple_steps:
+        if multiple_steps or steps_per_execution:
             self._run_steps = tf.function(self._run_steps)
 
         self.n_batches_per_step = n_batches_per_step
 
+        # Compiled functions for metrics, keyed by metrics
+        self._metric_result_fns = {}
+        self._local_eval_step_fns = {}
+
     def _make_ckpt(self, model_only=False):
         optimizers = self.optimizers
         # if len(optimizers) == 1 and hasattr(self, "original_optimizer"):
@@ -149,9 +194,23 @@ class Learner(metaclass=ABCMeta):
                 model=self.model, optimizers=optimizers,
                 epoch=self._epoch_var,
             )
-        ckpt_options = tf.train.CheckpointOptions(
-            experimental_io_device="/job:localhost") if self._strategy else None
-        return ckpt, ckpt_options
+        return ckpt, self._ckpt_options()
+
+    def _ckpt_options(self):
+        return tf.train.CheckpointOptions(
+            experimental_io_device="/job:localhost") if is_tpu_strategy(self._strategy) else None
+
+    def _make_step_ckpt(self, iterator=None):
+        # Mid-epoch checkpoint, with the input iterator, the step and train metrics
+        self._epoch_var.assign(self.epoch)
+        ckpt = tf.train.Checkpoint(
+            model=self.model, optimizers=self.optimizers,
+            epoch=self._epoch_var, step=self._state['train']['step'],
+            metrics=[m for m in self.train_metrics.values() if isinstance(m, Metric)],
+        )
+        if iterator is not None:
+            ckpt.iterator = iterator
+        return ckpt
 
     def train_batch(self, batch):
         pass
@@ -207,7 +266,8 @@ class Learner(metaclass=ABCMeta):
 
     def fit(self, ds_train, max_epochs, ds_val=None, val_freq=1,
             steps_per_epoch=None, val_steps=None, save_freq=None, callbacks=None,
-            reuse_train_iterator=True, local_eval_metrics=None, local_eval_freq=None):
+            reuse_train_iterator=True, local_eval_metrics=None, local_eval_freq=None,
+            step_save_freq=None):
         # It seems that reuse_train_iterator speed up the first epoch significantly
         self._max_epochs = max_epochs
 
@@ -244,7 +304,16 @@ class Learner(metaclass=ABCMeta):
             if not reuse_train_iterator:
                 self._train_it = iter(ds_train)
 
-            self._run_epoch(self._train_it, steps_per_epoch, cbks, 'train')
+            start_step = 0
+            if self._resume_step is not None:
+                fp, start_step = self._resume_step
+                self._resume_step = None
+                tf.train.Checkpoint(iterator=self._train_it).read(
+                    fp, self._ckpt_options()).expect_partial()
+                self._print("Resume epoch %d at step %d" % (epoch + 1, start_step))
+
+            self._run_epoch(self._train_it, steps_per_epoch, cbks, 'train',
+                            start_step=start_step, step_save_freq=step_save_freq)
             cbks.after_epoch(state)
 
             do_local_eval = local_eval_metrics and parse_freq(epoch, local_eval_freq)
@@ -264,6 +333,7 @@ class Learner(metaclass=ABCMeta):
                 self._print("Terminated at epoch %d" % (epoch + 1))
                 break
         cbks.after_train(self._state['train'])
+        self.wait_for_save()
 
     def evaluate(self, ds_val, val_steps=None, callbacks=None):
         self.init_state('eval')
@@ -280,16 +350,63 @@ class Learner(metaclass=ABCMeta):
     def evaluate_local(self, iterator, steps, metrics):
         for m in metrics.values():
             m.reset_states()
+        # Keras metrics are updated in the compiled step, others (e.g. mAP) on the host
+        host_metrics = {k: m for k, m in metrics.items() if not isinstance(m, Metric)}
+        graph_metrics = {k: m for k, m in metrics.items() if isinstance(m, Metric)}
+        # Outputs are gathered from all workers, but Keras metrics are created as
+        # sync-on-read variables under the global strategy and can't be updated
+        # in cross-replica context
+        if graph_metrics and is_multi_worker_strategy(self._strategy):
+            raise ValueError("Keras metrics (%s) are not supported by `evaluate_local` with "
+                             "MultiWorkerMirroredStrategy, use host metrics or `eval_metrics`"
+                             % ", ".join(graph_metrics.keys()))
+        step_fn = self._get_local_eval_step_fn(graph_metrics, return_outputs=bool(host_metrics))
         for step in range(steps):
-            y_true, y_pred = self._local_eval_step(next(iterator))
-            for m in metrics.values():
-                m.update_state(y_true, y_pred, None)
-        metric_results = {}
-        for k, m in metrics.items():
-            metric_results[k] = m.result().numpy()
+            outputs = step_fn(next(iterator))
+            if host_metrics:
+                y_true, y_pred = outputs
+                for m in host_metrics.values():
+                    m.update_state(y_true, y_pred, None)
+        metric_results = self._compute_metric_results(metrics)
         log_metrics('eval', metric_results, self.epoch, stage_name='valid',
                     metric_history=self.metric_history, print_fn=self._print)
 
+    def _get_local_eval_step_fn(self, metrics, return_outputs):
+        key = (tuple(id(m) for m in metrics.values()), return_outputs)
+        if key not in self._local_eval_step_fns:
+            @tf.function
+            def step_fn(batch):
+                y_true, y_pred = local_results(
+                    strategy_run(self._strategy, self.local_eval_batch, (batch,)), self._strategy)
+                for m in metrics.values():
+                    m.update_state(y_true, y_pred, None)
+                if return_outputs:
+                    return y_true, y_pred
+            self._local_eval_step_fns[key] = step_fn
+        return self._local_eval_step_fns[key]
+
+    def _compute_metric_results(self, metrics):
+        # Results of Keras metrics are computed in one function and fetched in one transfer per dtype
+        graph_metrics = {k: m for k, m in metrics.items() if isinstance(m, Metric)}
+        results = {}
+        if graph_metrics:
+            key = tuple(id(m) for m in graph_metrics.values())
+            if key not in self._metric_result_fns:
+                self._metric_result_fns[key] = _make_metric_results_fn(list(graph_metrics.values()))
+            fn, specs = self._metric_result_fns[key]
+            flats = {dtype: x.numpy() for dtype, x in fn().items()}
+            offsets = {dtype: 0 for dtype in flats}
+            for name, (shape, dtype) in zip(graph_metrics.keys(), specs):
+                size = int(np.prod(shape, dtype=np.int64))
+                offset = offsets[dtype]
+                value = flats[dtype][offset:offset + size].reshape(shape)
+                results[name] = value[()] if value.ndim == 0 else value
+                offsets[dtype] = offset + size
+        for name, metric in metrics.items():
+            if name not in graph_metrics:
+                results[name] = metric.result().numpy()
+        return {name: results[name] for name in metrics.keys()}
+
     @tf.function
     def _train_step(self, batch):
         strategy_run(self._strategy, self.train_batch, (batch,))
@@ -307,20 +424,57 @@ class Learner(metaclass=ABCMeta):
         return local_results(
             strategy_run(self._strategy, self.local_eval_batch, (batch,)), self._strategy)
 
+    def _copy_to_device(self, batch):
+        # Explicit host-to-device copy of the batch, only on a single device, batches
+        # of distributed iterators are already on the replicas
+        if self._strategy is None and self._device != 'CPU':
+            with tf.device("/%s:0" % self._device):
+                batch = tf.nest.map_structure(tf.identity, batch)
+            block_until_ready(batch)
+        return batch
+
+    def _next_batch(self, iterator, n_batches_per_step, state):
+        # Time blocked on the iterator and of copying the batch to the device (requested
+        # by `Profiler`), only available when steps run eagerly. Kept out of the loop of
+        # `_run_steps`, where autograph would treat the timings as loop variables
+        eager = tf.executing_eagerly()
+        if eager:
+            data_start = time.perf_counter()
+        if n_batches_per_step is not None:
+            batch = tuple(next(iterator) for bi in range(n_batches_per_step))
+        else:
+            batch = next(iterator)
+        if eager:
+            state['data_time'] = time.perf_counter() - data_start
+            if state.get('profile_transfer'):
+                transfer_start = time.perf_counter()
+                batch = self._copy_to_device(batch)
+                state['transfer_time'] = time.perf_counter() - transfer_start
+        return batch
+
     def _run_steps(self, step_fn, iterator, n_batches_per_step, n_steps, callbacks, state):
-        state['step'].assign(-1)
         for i in tf.range(n_steps):
             state['step'].assign_add(1)
             callbacks.begin_batch(state)
-            if n_batches_per_step is not None:
-                batches = tuple(next(iterator) for bi in range(n_batches_per_step))
-                step_fn(batches)
-            else:
-                batch = next(iterator)
-                step_fn(batch)
+            batch = self._next_batch(iterator, n_batches_per_step, state)
+            step_fn(batch)
             callbacks.after_batch(state)
 
-    def _run_epoch(self, iterator, steps, callbacks, mode):
+    def _run_executions(self, step_fn, iterator, n_batches_per_step, steps, callbacks, state):
+        graph_cbks, host_cbks = callbacks.split_graph_safe()
+        run_state = {
+            k: state[k] for k in ["step", "steps", "epochs"]
+        }
+        steps = int(steps)
+        for start in range(0, steps, self.steps_per_execution):
+            n_steps = min(self.steps_per_execution, steps - start)
+            host_cbks.begin_batch(state)
+            self._run_steps(
+                step_fn, iterator, n_batches_per_step, tf.constant(n_steps, dtype=tf.int32),
+                graph_cbks, run_state)
+            host_cbks.after_batch(state)
+
+    def _run_epoch(self, iterator, steps, callbacks, mode, start_step=0, step_save_freq=None):
         state = self._state[mode]
         metrics = getattr(self, mode + "_metrics")
         step_fn = getattr(self, f"_{mode}_step")
@@ -329,27 +483,47 @@ class Learner(metaclass=ABCMeta):
             'steps': steps,
         })
 
-        for metric in metrics.values():
-            metric.reset_states()
-
-        if self.multiple_steps:
-            run_state = {
-                k: state[k] for k in ["step", "steps", "epochs"]
-            }
-        else:
-            run_state = state
+        # Metrics are restored with the step checkpoint when resuming
+        if start_step == 0:
+            for metric in metrics.values():
+                metric.reset_states()
 
         if mode == 'train' and self.n_batches_per_step is not None:
             step_fn = self._train_step_on_batches
-            self._run_steps(
-                step_fn, iterator, self.n_batches_per_step, steps, callbacks, run_state)
+            n_batches_per_step = self.n_batches_per_step
         else:
-            self._run_steps(
-                step_fn, iterator, None, steps, callbacks, run_state)
+            n_batches_per_step = None
 
+        state['step'].assign(start_step - 1)
+        if step_save_freq:
+            steps = int(steps)
+            ends = list(range(start_step - start_step % step_save_freq + step_save_freq, steps, step_save_freq))
+            ends.append(steps)
+        else:
+            ends = [None]
+        seg_start = start_step
+        for seg_end in ends:
+            if seg_end is None:
+                n_steps = steps if start_step == 0 else steps - start_step
+            else:
+                n_steps = tf.convert_to_tensor(seg_end - seg_start, dtype=tf.int32)
+            if self.steps_per_execution:
+                self._run_executions(
+                    step_fn, iterator, n_batches_per_step, n_steps, callbacks, state)
+            else:
+                if self.multiple_steps:
+                    run_state = {
+                        k: state[k] for k in ["step", "steps", "epochs"]
+                    }
+                else:
+                    run_state = state
+                self._run_steps(
+                    step_fn, iterator, n_batches_per_step, n_steps, callbacks, run_state)
+            if seg_end is not None and seg_end < steps:
+                self.save_step(iterator)
+            seg_start = seg_end
 
-        for name, metric in metrics.items():
-            state['metrics'][name] = metric.result().numpy()
+        state['metrics'].update(self._compute_metric_results(metrics))
 
     def update_metrics(self, metrics, y_true, y_pred, per_example_loss=None):
         y_pred = self.output_transform(y_pred)
@@ -388,18 +562,38 @@ class Learner(metaclass=ABCMeta):
 
 
     def save_state(self, save_dir=None):
+        # Metric records are appended to the log, other states are small
+        if not is_chief():
+            return
         save_dir = save_dir or self.work_dir
-        with open(save_dir / "learner_state.pickle", "wb") as f:
-            pickle.dump({
-                "metric_history": self.metric_history._history,
-                "train_start": self._train_start,
-                "epoch": self.epoch,
-                "max_epochs": self._max_epochs,
-            }, f)
-
+        data = json.dumps({
+            "train_start": self._train_start,
+            "epoch": self.epoch,
+            "max_epochs": self._max_epochs,
+        }).encode()
+        state_file = save_dir / "learner_state.json"
+        log_file = save_dir / "metric_log.jsonl"
+        if save_dir == self.work_dir:
+            fns = [(append_log, log_file, self.metric_history.pop_log_lines())]
+        else:
+            fns = [(write_bytes_atomic, log_file, self.metric_history.dump_log_lines().encode())]
+        fns.append((write_bytes_atomic, state_file, data))
+        for fn, *args in fns:
+            if self._ckpt_writer is not None:
+                # Keep the order with pending checkpoints
+                self._ckpt_writer.submit(fn, *args)
+            else:
+                fn(*args)
 
     def load_state(self, save_dir=None):
         save_dir = save_dir or self.work_dir
+        state_file = save_dir / "learner_state.json"
+        if state_file.exists():
+            d = json.loads(state_file.read_text())
+            log_file = save_dir / "metric_log.jsonl"
+            d['metric_history'] = read_log(log_file, d['epoch']) if log_file.exists() else {}
+            return d
+        # Saved before the metric log
         state_file = save_dir / "learner_state.pickle"
         if state_file.exists():
             with open(state_file, "rb") as f:
@@ -408,29 +602,94 @@ class Learner(metaclass=ABCMeta):
         else:
             return None
 
+    def _load_metric_history(self, history, save_dir):
+        # Write the whole history to the log if it is not in the log of work_dir
+        pending = save_dir != self.work_dir or not (self.work_dir / "metric_log.jsonl").exists()
+        self.metric_history.load(history, pending=pending)
 
     def save(self, save_dir=None, model_only=False, state=True):
         if save_dir is None:
             save_dir = self.work_dir
         else:
             save_dir = fmt_path(save_dir)
-        files = list(eglob(save_dir, "ckpt.*"))
-        if len(files) != 0:
-            for f in files:
-                f.write_bytes(b'')
-                rm(f)
 
-        save_path = str(save_dir / "ckpt")
         ckpt, ckpt_options = self._make_ckpt(model_only=model_only)
-        path = ckpt.write(save_path, ckpt_options)
+        if not is_chief():
+            self._write_discarded(ckpt, save_dir)
+            return
+        if save_dir == self.work_dir:
+            manager = self._ckpt_manager
+        else:
+            manager = CheckpointManager(save_dir, writer=self._ckpt_writer)
+        path = manager.save(ckpt, self.epoch, ckpt_options)
 
         if state:
             self.save_state(save_dir)
 
         self._print('Save learner to %s' % path)
 
+    def _write_discarded(self, ckpt, save_dir):
+        # Non-chief workers take part in saving, as reading variables may need
+        # collectives across workers, but write to a temporary dir
+        tmp_dir = worker_tmp_dir(save_dir)
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        write_checkpoint(ckpt, tmp_dir / "ckpt", self._ckpt_options())
+        rm(tmp_dir)
+
+    def save_step(self, iterator):
+        save_path = self.work_dir / "step_ckpt"
+        ckpt = self._make_step_ckpt(iterator)
+        if not is_chief():
+            self._write_discarded(ckpt, self.work_dir)
+            return
+        meta = json.dumps({
+            "epoch": self.epoch,
+            "step": int(self._state['train']['step'].numpy()) + 1,
+        }).encode()
+        meta_file = self.work_dir / "step_ckpt.json"
+        if self._ckpt_writer is not None:
+            self._ckpt_writer.write(ckpt, save_path, self._ckpt_options())
+            self._ckpt_writer.submit(write_bytes_atomic, meta_file, meta)
+        else:
+            write_checkpoint(ckpt, save_path, self._ckpt_options())
+            write_bytes_atomic(meta_file, meta)
+
+    def _find_step_checkpoint(self):
+        # Step checkpoint of an epoch after the latest epoch checkpoint
+        meta_file = self.work_dir / "step_ckpt.json"
+        if not meta_file.exists():
+            return None
+        meta = json.loads(meta_file.read_text())
+        latest_epoch = self._ckpt_manager.latest_epoch
+        if latest_epoch is not None and meta['epoch'] <= latest_epoch:
+            return None
+        return str(self.work_dir / "step_ckpt"), meta['epoch'], meta['step']
+
+    def record_checkpoint_metrics(self):
+        manager = self._ckpt_manager
+        if not manager.keep_best:
+            return
+        epoch = self.epoch
+        metrics = {
+            k: self.metric_history.get_metric(k, manager.best_stage, epoch, epoch)
+            for k in manager.keep_best
+        }
+        manager.record(epoch, metrics)
+
+    def wait_for_save(self):
+        if self._ckpt_writer is not None:
+            self._ckpt_writer.wait()
+
     def load(self, fp=None, miss_ok=False, model_only=False, state=True):
+        self.wait_for_save()
+        if fp is None and not model_only:
+            step_ckpt = self._find_step_checkpoint()
+            if step_ckpt is not None:
+                return self._load_step(*step_ckpt, state=state)
+        if fp is None:
+            fp = self._ckpt_manager.latest_checkpoint
         if fp is None:
+            # Checkpoints saved before versioned names
             fp = find_most_recent(self.work_dir, "ckpt.index")
             if fp is None:
                 if miss_ok:
@@ -447,7 +706,7 @@ class Learner(metaclass=ABCMeta):
             save_dir = fmt_path(fp).parent
             d = self.load_state(save_dir)
             if d is not None:
-                self.metric_history._history = d['metric_history']
+                self._load_metric_history(d['metric_history'], save_dir)
                 self._train_start = d['train_start']
                 epoch = d['epoch']
                 self._max_epochs = d['max_epochs']
@@ -456,6 +715,25 @@ class Learner(metaclass=ABCMeta):
         self._print("Load learner at epoch %d from %s" % (self.epoch + 1, fp))
         return True
 
+    def _load_step(self, fp, epoch, step, state=True):
+        if 'step' not in self._state['train']:
+            self.set_global_state("step", tf.Variable(0, dtype=tf.int32))
+        ckpt = self._make_step_ckpt()
+        ckpt.read(fp, self._ckpt_options()).expect_partial()
+
+        if state:
+            d = self.load_state(self.work_dir)
+            if d is not None:
+                self._load_metric_history(d['metric_history'], self.work_dir)
+                self._train_start = d['train_start']
+                self._max_epochs = d['max_epochs']
+
+        # The iterator is restored in `fit`
+        self._resume_step = (fp, step)
+        self.set_global_state('epoch', epoch - 1)
+        self._print("Load learner at epoch %d step %d from %s" % (epoch + 1, step, fp))
+        return True
+
     def recover_log(self):
         train_start = self._train_start
         self._print(f"{train_start} Start training")
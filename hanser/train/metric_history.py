@@ -1,18 +1,137 @@
+import json
+
+import numpy as np
+
+
+def _to_json(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    return v
+
+
+def append_log(fp, lines):
+    if lines:
+        with open(fp, "a+b") as f:
+            # Terminate a partially written last line, so that it is skipped alone
+            # instead of corrupting the first appended record
+            if f.tell() > 0:
+                f.seek(-1, 2)
+                if f.read(1) != b"\n":
+                    lines = "\n" + lines
+            f.write(lines.encode())
+
+
+def read_log(fp, max_epoch=None):
+    # Records of later lines override earlier ones
+    # stage -> epoch -> metric -> value
+    history = {}
+    with open(fp) as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written last line
+                continue
+            if max_epoch is not None and r['epoch'] > max_epoch:
+                continue
+            h = history.setdefault(r['stage'], {})
+            h.setdefault(r['epoch'], {}).update(r['metrics'])
+    return history
+
+
+def _is_numeric(v):
+    return isinstance(v, (int, float, np.number)) and not isinstance(v, bool) or \
+        isinstance(v, np.ndarray) and v.ndim == 0 and np.issubdtype(v.dtype, np.number)
+
+
+class _StageHistory:
+    # Columns of values indexed by `epoch - offset`, numeric metrics are stored in
+    # float64 arrays and others (e.g. end time) in object arrays
+
+    def __init__(self):
+        self.offset = 0
+        self.size = 0
+        self.epochs = np.zeros(0, dtype=bool)
+        self.values = {}
+        self.masks = {}
+        self.latest = {}
+
+    def _reserve(self, epoch):
+        if self.size == 0:
+            self.offset = epoch
+        if epoch < self.offset:
+            pad = self.offset - epoch
+            self.epochs = np.concatenate([np.zeros(pad, dtype=bool), self.epochs])
+            for k in self.values:
+                v = self.values[k]
+                self.values[k] = np.concatenate([self._empty(v.dtype, pad), v])
+                self.masks[k] = np.concatenate([np.zeros(pad, dtype=bool), self.masks[k]])
+            self.offset = epoch
+            self.size += pad
+        i = epoch - self.offset
+        if i >= len(self.epochs):
+            capacity = max(2 * len(self.epochs), i + 1, 16)
+            pad = capacity - len(self.epochs)
+            self.epochs = np.concatenate([self.epochs, np.zeros(pad, dtype=bool)])
+            for k in self.values:
+                self.values[k] = np.concatenate([self.values[k], self._empty(self.values[k].dtype, pad)])
+                self.masks[k] = np.concatenate([self.masks[k], np.zeros(pad, dtype=bool)])
+        self.size = max(self.size, i + 1)
+        return i
+
+    @staticmethod
+    def _empty(dtype, n):
+        if dtype == object:
+            return np.full(n, None, dtype=object)
+        return np.full(n, np.nan, dtype=dtype)
+
+    def record(self, epoch, metric, value):
+        i = self._reserve(epoch)
+        self.epochs[i] = True
+        numeric = _is_numeric(value)
+        if metric not in self.values:
+            dtype = np.float64 if numeric else object
+            self.values[metric] = self._empty(dtype, len(self.epochs))
+            self.masks[metric] = np.zeros(len(self.epochs), dtype=bool)
+        elif not numeric and self.values[metric].dtype != object:
+            self.values[metric] = self.values[metric].astype(object)
+        self.values[metric][i] = value
+        self.masks[metric][i] = True
+        self.latest[metric] = max(self.latest.get(metric, epoch), epoch)
+
+    def get(self, epoch, metric):
+        i = epoch - self.offset
+        if metric not in self.values or not (0 <= i < self.size) or not self.masks[metric][i]:
+            return None
+        return self.values[metric][i]
+
+    def epoch_range(self, start=None, end=None):
+        # Indices of recorded epochs in [start, end]
+        recorded = np.flatnonzero(self.epochs[:self.size])
+        if len(recorded) == 0:
+            return recorded
+        lo = 0 if start is None else max(start - self.offset, 0)
+        hi = self.size - 1 if end is None else end - self.offset
+        return recorded[(recorded >= lo) & (recorded <= hi)]
+
+
 class MetricHistory:
 
     def __init__(self, stages):
         self.stages = stages
-        # stage -> epoch -> metric -> value
-        self._history = {
-            stage: {}
+        # stage -> columns of metrics indexed by epoch
+        self._stages = {
+            stage: _StageHistory()
             for stage in stages
         }
+        # (stage, epoch) -> metrics recorded but not appended to the log
+        self._pending = {}
 
     def record(self, stage, epoch, metric, value):
-        h = self._history[stage]
-        if epoch not in h:
-            h[epoch] = {}
-        h[epoch][metric] = value
+        self._stages[stage].record(epoch, metric, value)
+        self._pending.setdefault((stage, epoch), set()).add(metric)
 
     def get_metric(self, metric, stage=None, start=None, end=None):
         # Epochs is 0-based
@@ -23,22 +142,17 @@ class MetricHistory:
                 for stage in self.stages
             }
         else:
-            h = self._history[stage]
-            epochs = list(h.keys())
-            if len(epochs) == 0:
-                return None
-            min_epoch, max_epochs = min(epochs), max(epochs)
-            if start is None:
-                start = min_epoch
-            if end is None:
-                end = max_epochs
-            values = []
-            for e in range(start, end + 1):
-                if e in h:
-                    values.append(h[e].get(metric))
-            if all(v is None for v in values):
+            h = self._stages[stage]
+            idx = h.epoch_range(start, end)
+            if metric not in h.values or not h.masks[metric][idx].any():
                 return None
-            elif len(values) == 1:
+            mask = h.masks[metric][idx]
+            values = h.values[metric][idx]
+            if mask.all():
+                values = values.tolist()
+            else:
+                values = [v if m else None for v, m in zip(values.tolist(), mask)]
+            if len(values) == 1:
                 return values[0]
             else:
                 return values
@@ -49,19 +163,117 @@ class MetricHistory:
                 stage: self.get_epochs(start, end, stage)
                 for stage in self.stages
             }
-            for k in h.keys():
-                if h[k] is None:
-                    del h[k]
             return h
         else:
-            h = self._history[stage]
-            metrics = set()
-            for e in range(start, end + 1):
-                if e not in h:
-                    continue
-                for m in h[e].keys():
-                    metrics.add(m)
+            h = self._stages[stage]
+            idx = h.epoch_range(start, end)
             return {
                 m: self.get_metric(m, stage, start, end)
-                for m in metrics
-            }
\ No newline at end of file
+                for m in h.values
+                if h.masks[m][idx].any()
+            }
+
+    def get_array(self, metric, stage, start=None, end=None):
+        # Epochs and values of `metric` in [start, end] as arrays
+        h = self._stages[stage]
+        if metric not in h.values:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        idx = h.epoch_range(start, end)
+        idx = idx[h.masks[metric][idx]]
+        return idx + h.offset, h.values[metric][idx]
+
+    def latest(self, metric, stage):
+        h = self._stages[stage]
+        if metric not in h.latest:
+            return None
+        return h.get(h.latest[metric], metric)
+
+    def best(self, metric, stage, mode='max'):
+        # (epoch, value) of the best value
+        epochs, values = self.get_array(metric, stage)
+        if len(values) == 0:
+            return None
+        i = np.argmax(values) if mode == 'max' else np.argmin(values)
+        return int(epochs[i]), values[i]
+
+    def best_so_far(self, metric, stage, mode='max'):
+        epochs, values = self.get_array(metric, stage)
+        accumulate = np.maximum.accumulate if mode == 'max' else np.minimum.accumulate
+        return epochs, accumulate(values.astype(np.float64))
+
+    def moving_average(self, metric, stage, window):
+        # Average of the last `window` recorded values, the first ones use fewer values
+        epochs, values = self.get_array(metric, stage)
+        cumsum = np.cumsum(np.concatenate([[0.], values.astype(np.float64)]))
+        n = np.arange(1, len(values) + 1)
+        counts = np.minimum(n, window)
+        return epochs, (cumsum[n] - cumsum[n - counts]) / counts
+
+    def to_pandas(self, stage=None):
+        import pandas as pd
+        if stage is None:
+            return pd.concat({
+                stage: self.to_pandas(stage)
+                for stage in self.stages
+            }, axis=1)
+        h = self._stages[stage]
+        idx = h.epoch_range()
+        return pd.DataFrame({
+            m: pd.Series(h.values[m][idx], index=idx + h.offset).where(h.masks[m][idx])
+            for m in h.values
+        }).rename_axis('epoch')
+
+    def to_dict(self):
+        # stage -> epoch -> metric -> value
+        return {
+            stage: {
+                int(i) + h.offset: {
+                    m: h.values[m][i] for m in h.values if h.masks[m][i]
+                }
+                for i in h.epoch_range()
+            }
+            for stage, h in self._stages.items()
+        }
+
+    def load(self, history, pending=False):
+        self._stages = {
+            stage: _StageHistory()
+            for stage in self.stages
+        }
+        for stage, h in history.items():
+            if stage not in self._stages:
+                continue
+            for epoch in sorted(h.keys()):
+                for metric, value in h[epoch].items():
+                    self._stages[stage].record(epoch, metric, value)
+        self._pending = {}
+        if pending:
+            for stage, h in history.items():
+                if stage not in self._stages:
+                    continue
+                for epoch, metrics in h.items():
+                    self._pending[(stage, epoch)] = set(metrics.keys())
+
+    def _log_lines(self, records):
+        lines = []
+        for (stage, epoch), metrics in records.items():
+            h = self._stages[stage]
+            lines.append(json.dumps({
+                "stage": stage,
+                "epoch": epoch,
+                "metrics": {m: _to_json(h.get(epoch, m)) for m in sorted(metrics)},
+            }) + "\n")
+        return "".join(lines)
+
+    def pop_log_lines(self):
+        # JSON lines of records since the last call, to append to the log
+        lines = self._log_lines(self._pending)
+        self._pending = {}
+        return lines
+
+    def dump_log_lines(self):
+        return self._log_lines({
+            (stage, epoch): metrics.keys()
+            for stage, h in self.to_dict().items()
+            for epoch, metrics in h.items()
+        })
@@ -4,8 +4,7 @@ import numpy as np
 
 import tensorflow as tf
 
-from hanser.detection.bbox import BBox
-from hanser.detection.eval import average_precision
+from hanser.detection.eval import average_precision_arrays
 
 
 class MeanAveragePrecision:
@@ -35,34 +34,33 @@ class MeanAveragePrecision:
         if 'is_difficult' in y_true:
             all_is_difficults = y_true['is_difficult'].numpy()
         else:
-            all_is_difficults = np.full_like(all_gt_labels, False, dtype=np.bool)
+            all_is_difficults = np.full_like(all_gt_labels, False, dtype=bool)
 
         all_gt_n_valids = np.sum(all_gt_labels != 0, axis=1)
         all_gt_labels -= 1
         batch_size, num_dets = all_dt_bboxes.shape[:2]
-        for i in range(batch_size):
-            image_id = image_ids[i]
-            for j in range(all_dt_n_valids[i]):
-                self.dts.append({
-                    'image_id': image_id,
-                    'bbox': all_dt_bboxes[i, j],
-                    'category_id': all_dt_classes[i, j],
-                    'score': all_dt_scores[i, j],
-                })
-
-            for j in range(all_gt_n_valids[i]):
-                self.gts.append({
-                    'image_id': image_id,
-                    'bbox': all_gt_bboxes[i, j],
-                    'category_id': all_gt_labels[i, j],
-                    'is_difficult': all_is_difficults[i, j]
-                })
+        num_gts = all_gt_bboxes.shape[1]
+
+        # Flat arrays of valid detections and ground truths of the batch
+        dt_mask = np.arange(num_dets)[None, :] < all_dt_n_valids[:, None]
+        self.dts.append((
+            np.broadcast_to(image_ids[:, None], dt_mask.shape)[dt_mask],
+            all_dt_classes[dt_mask], all_dt_scores[dt_mask], all_dt_bboxes[dt_mask],
+        ))
+        gt_mask = np.arange(num_gts)[None, :] < all_gt_n_valids[:, None]
+        self.gts.append((
+            np.broadcast_to(image_ids[:, None], gt_mask.shape)[gt_mask],
+            all_gt_labels[gt_mask], all_gt_bboxes[gt_mask], all_is_difficults[gt_mask],
+        ))
 
     def result(self):
-        dts = [BBox(**ann) for ann in self.dts]
-        gts = [BBox(**ann) for ann in self.gts]
-
-        aps = average_precision(dts, gts, self.iou_threshold, self.interpolation == '11point', self.ignore_difficult)
+        if self.gts:
+            dts = [np.concatenate(xs) for xs in zip(*self.dts)]
+            gts = [np.concatenate(xs) for xs in zip(*self.gts)]
+            aps = average_precision_arrays(
+                *dts, *gts, self.iou_threshold, self.interpolation == '11point', self.ignore_difficult)
+        else:
+            aps = {}
         mAP = np.mean(list(aps.values()))
         if self.class_names:
             num_classes = len(self.class_names)
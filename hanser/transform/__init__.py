@@ -132,6 +132,20 @@ def random_resized_crop(image, size, scale=(0.05, 1.0), ratio=(0.75, 1.33)):
     return image
 
 
+def center_crop_jpeg(image, size, crop_padding=32):
+    # Decode only the central crop of an encoded JPEG, which approximates resizing
+    # the shorter side to `size + crop_padding` and center cropping `size`.
+    shape = tf.image.extract_jpeg_shape(image)
+    height, width = shape[0], shape[1]
+    shorter = tf.cast(tf.minimum(height, width), tf.float32)
+    crop_size = tf.cast(size / (size + crop_padding) * shorter, tf.int32)
+    offset_y = (height - crop_size + 1) // 2
+    offset_x = (width - crop_size + 1) // 2
+    crop_window = tf.stack([offset_y, offset_x, crop_size, crop_size])
+    image = tf.image.decode_and_crop_jpeg(image, crop_window, channels=3)
+    return resize(image, (size, size))
+
+
 def pad(image, padding, fill=0):
     if isinstance(padding, int):
         padding = (padding, padding)
@@ -770,3 +784,101 @@ def resize_longer(img, size, method='bilinear'):
     if img.dtype != dtype:
         img = tf.cast(img, dtype)
     return img
+
+
+# Batched versions of the common train transforms. They take a [N, H, W, C] batch
+# and sample random parameters for every image, `cutout` already works on batches.
+
+def random_crop_batch(images, size, padding, fill=0):
+    height, width = size
+    images = pad(images, padding, fill)
+    n, h, w, c = image_dimensions(images, 4)
+    oy = tf.random.uniform((n, 1), 0, h - height + 1, dtype=tf.int32)
+    ox = tf.random.uniform((n, 1), 0, w - width + 1, dtype=tf.int32)
+    images = tf.gather(images, oy + tf.range(height)[None], axis=1, batch_dims=1)
+    images = tf.gather(images, ox + tf.range(width)[None], axis=2, batch_dims=1)
+    return images
+
+
+def random_flip_left_right_batch(images):
+    n = tf.shape(images)[0]
+    flip = tf.random.uniform((n, 1, 1, 1)) < 0.5
+    return tf.where(flip, tf.reverse(images, axis=[2]), images)
+
+
+def random_resized_crop_batch(images, size, scale=(0.05, 1.0), ratio=(0.75, 1.33), max_attempts=100):
+    # Each image tries `max_attempts` (area, aspect ratio) samples and takes the first
+    # one that fits, falling back to the whole image like `random_resized_crop`, which
+    # also makes 100 attempts (`tf.image.sample_distorted_bounding_box`).
+    n, h, w, c = image_dimensions(images, 4)
+    if not isinstance(size, (tuple, list)):
+        size = (size, size)
+    fh, fw = tf.cast(h, tf.float32), tf.cast(w, tf.float32)
+    area = tf.random.uniform((n, max_attempts), scale[0], scale[1]) * fh * fw
+    aspect_ratio = tf.random.uniform((n, max_attempts), ratio[0], ratio[1])
+    ch = tf.round(tf.sqrt(area / aspect_ratio))
+    cw = tf.round(tf.sqrt(area * aspect_ratio))
+    valid = (ch > 0) & (ch <= fh) & (cw > 0) & (cw <= fw)
+    first = tf.argmax(tf.cast(valid, tf.int32), axis=1, output_type=tf.int32)
+    found = tf.reduce_any(valid, axis=1)
+    ch = tf.where(found, tf.gather(ch, first, batch_dims=1), fh)
+    cw = tf.where(found, tf.gather(cw, first, batch_dims=1), fw)
+    oy = tf.floor(tf.random.uniform((n,)) * (fh - ch + 1))
+    ox = tf.floor(tf.random.uniform((n,)) * (fw - cw + 1))
+    boxes = tf.stack([
+        oy / (fh - 1), ox / (fw - 1), (oy + ch - 1) / (fh - 1), (ox + cw - 1) / (fw - 1)], axis=1)
+
+    dtype = images.dtype
+    images = tf.image.crop_and_resize(images, boxes, tf.range(n), size)
+    if images.dtype != dtype:
+        images = tf.cast(images, dtype)
+    return images
+
+
+def _random_apply_batch(func, images, p=0.5):
+    n = tf.shape(images)[0]
+    mask = tf.random.uniform((n, 1, 1, 1)) < p
+    return tf.where(mask, func(images, n), images)
+
+
+def color_jitter_batch(images, brightness, contrast, saturation, hue):
+    # The order of the four ops is sampled once per batch, their factors per image.
+    dtype = images.dtype
+    images = tf.cast(images, tf.float32) / 255
+
+    def adjust_brightness(x, n):
+        delta = tf.random.uniform((n, 1, 1, 1), -brightness, brightness)
+        return tf.clip_by_value(x + delta, 0, 1)
+
+    def adjust_contrast(x, n):
+        factor = tf.random.uniform((n, 1, 1, 1), 1 - contrast, 1 + contrast)
+        mean = tf.reduce_mean(x, axis=[1, 2], keepdims=True)
+        return tf.clip_by_value((x - mean) * factor + mean, 0, 1)
+
+    def adjust_saturation(x, n):
+        factor = tf.random.uniform((n, 1, 1), 1 - saturation, 1 + saturation)
+        x = tf.image.rgb_to_hsv(x)
+        h, s, v = tf.unstack(x, axis=-1)
+        s = tf.clip_by_value(s * factor, 0, 1)
+        return tf.clip_by_value(tf.image.hsv_to_rgb(tf.stack([h, s, v], axis=-1)), 0, 1)
+
+    def adjust_hue(x, n):
+        delta = tf.random.uniform((n, 1, 1), -hue, hue)
+        x = tf.image.rgb_to_hsv(x)
+        h, s, v = tf.unstack(x, axis=-1)
+        h = tf.math.floormod(h + delta, 1.0)
+        return tf.clip_by_value(tf.image.hsv_to_rgb(tf.stack([h, s, v], axis=-1)), 0, 1)
+
+    ops = [(brightness, adjust_brightness), (contrast, adjust_contrast),
+           (saturation, adjust_saturation), (hue, adjust_hue)]
+    order = tf.random.shuffle(tf.range(4))
+    for i in range(4):
+        for j, (factor, op) in enumerate(ops):
+            if factor != 0:
+                images = tf.cond(
+                    tf.equal(order[i], j),
+                    lambda: _random_apply_batch(op, images),
+                    lambda: images)
+
+    images = tf.cast(images * 255, dtype)
+    return images
@@ -0,0 +1,139 @@
+"""NumPy counterparts of `hanser.transform` for host-side input pipelines.
+
+Transforms take HWC `np.ndarray` images and random ones take a `np.random.Generator`.
+Deterministic transforms match the TensorFlow versions (up to float rounding),
+random ones sample from the same distributions.
+"""
+import io
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+
+def decode_image(data, channels=3):
+    if isinstance(data, np.ndarray) and data.dtype == np.uint8:
+        # Decoded images keep their channels, grayscale ones (e.g. MNIST) may have
+        # no channel axis
+        if data.ndim == 2:
+            data = data[..., None]
+        return data
+    if isinstance(data, (str, os.PathLike)):
+        image = Image.open(data)
+    else:
+        image = Image.open(io.BytesIO(bytes(data)))
+    image = image.convert('RGB' if channels == 3 else 'L')
+    image = np.asarray(image)
+    if channels == 1:
+        image = image[..., None]
+    return image
+
+
+def _resize_coords(in_size, out_size):
+    # Half pixel centers, same as `tf.image.resize` with antialias=False
+    scale = in_size / out_size
+    x = (np.arange(out_size, dtype=np.float32) + 0.5) * np.float32(scale) - 0.5
+    x0 = np.floor(x)
+    lerp = x - x0
+    lo = np.clip(x0, 0, in_size - 1).astype(np.int64)
+    hi = np.clip(x0 + 1, 0, in_size - 1).astype(np.int64)
+    return lo, hi, lerp
+
+
+def resize(img, size):
+    """Bilinear resize like `hanser.transform.resize`.
+
+    If `size` is an int, the shorter side is resized to `size`.
+    """
+    h, w = img.shape[:2]
+    if not isinstance(size, (tuple, list)):
+        scale = size / min(h, w)
+        size = (math.ceil(h * scale), math.ceil(w * scale))
+    oh, ow = size
+    dtype = img.dtype
+    y0, y1, y_lerp = _resize_coords(h, oh)
+    x0, x1, x_lerp = _resize_coords(w, ow)
+    img = img.astype(np.float32)
+    x_lerp = x_lerp[:, None]
+    top = img[y0]
+    bottom = img[y1]
+    top = top[:, x0] + (top[:, x1] - top[:, x0]) * x_lerp
+    bottom = bottom[:, x0] + (bottom[:, x1] - bottom[:, x0]) * x_lerp
+    img = top + (bottom - top) * y_lerp[:, None, None]
+    if dtype != np.float32:
+        img = img.astype(dtype)
+    return img
+
+
+def pad(image, padding, fill=0):
+    if isinstance(padding, int):
+        padding = (padding, padding)
+    ph, pw = padding
+    return np.pad(image, [(ph, ph), (pw, pw), (0, 0)], constant_values=fill)
+
+
+def random_crop(image, size, padding, rng, fill=0):
+    height, width = size
+    image = pad(image, padding, fill)
+    h, w = image.shape[:2]
+    y = rng.integers(0, h - height + 1)
+    x = rng.integers(0, w - width + 1)
+    return image[y:y + height, x:x + width]
+
+
+def center_crop(image, size):
+    if not isinstance(size, (tuple, list)):
+        size = (size, size)
+    crop_height, crop_width = size
+    height, width = image.shape[:2]
+    crop_top = (height - crop_height) // 2
+    crop_left = (width - crop_width) // 2
+    return image[crop_top:crop_top + crop_height, crop_left:crop_left + crop_width]
+
+
+def random_flip_left_right(image, rng):
+    if rng.random() < 0.5:
+        image = image[:, ::-1]
+    return image
+
+
+def random_resized_crop(image, size, rng, scale=(0.05, 1.0), ratio=(0.75, 1.33), max_attempts=100):
+    # Same sampling as `tf.image.sample_distorted_bounding_box`, falls back to the whole image
+    height, width = image.shape[:2]
+    area = height * width
+    crop = (0, 0, height, width)
+    for _ in range(max_attempts):
+        target_area = rng.uniform(*scale) * area
+        aspect_ratio = rng.uniform(*ratio)
+        h = int(round(math.sqrt(target_area / aspect_ratio)))
+        w = int(round(math.sqrt(target_area * aspect_ratio)))
+        if 0 < h <= height and 0 < w <= width:
+            y = rng.integers(0, height - h + 1)
+            x = rng.integers(0, width - w + 1)
+            crop = (y, x, h, w)
+            break
+    y, x, h, w = crop
+    image = image[y:y + h, x:x + w]
+
+    if not isinstance(size, (tuple, list)):
+        size = (size, size)
+    return resize(image, size)
+
+
+def normalize(x, mean, std):
+    mean = np.asarray(mean, x.dtype)
+    std = np.asarray(std, x.dtype)
+    return (x - mean) / std
+
+
+def to_tensor(image, label, dtype=np.float32, vmax=255, label_offset=None):
+    image = image.astype(dtype) / np.asarray(vmax, dtype)
+    label = np.int32(np.reshape(label, ()))
+    if label_offset:
+        label -= label_offset
+    return image, label
+
+
+def one_hot(label, num_classes, dtype=np.float32):
+    return np.eye(num_classes, dtype=dtype)[label]
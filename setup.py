@@ -62,6 +62,13 @@ def get_pybind_include(user=False):
 
 
 def get_numpy_extensions():
+    # The extension is optional, `hanser.detection.eval` falls back to Python without it
+    try:
+        import pybind11
+    except ImportError:
+        print("pybind11 is not installed, skip building %s._numpy" % IMPORT_NAME)
+        return []
+
     extensions_dir = os.path.join(here, IMPORT_NAME, 'csrc', 'numpy')
 
     main_file = glob.glob(os.path.join(extensions_dir, '*.cpp'))
@@ -83,6 +90,8 @@ def get_numpy_extensions():
             main_file,
             include_dirs=include_dirs,
             extra_compile_args=extra_compile_args,
+            # A failed build (e.g. without a C++ compiler) is a warning
+            optional=True,
         )
     ]
 
@@ -104,5 +113,5 @@ setup(
     dependency_links=DEPENDENCY_LINKS,
     # include_package_data=True,
     license='MIT',
-    # ext_modules=get_numpy_extensions(),
+    ext_modules=get_numpy_extensions(),
 )
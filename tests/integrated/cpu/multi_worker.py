@@ -0,0 +1,159 @@
+# Multi-worker training with CPU workers on one machine.
+# Run `python multi_worker.py`, it launches the workers with TF_CONFIG.
+# Every worker has its own work dir to check that only the chief writes, and
+# results of local evaluation are gathered from all workers.
+import os
+import sys
+import json
+import shutil
+import socket
+import subprocess
+from pathlib import Path
+
+N_WORKERS = 2
+WORK_DIR = Path("./MNIST-MultiWorker")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def launch(n_workers):
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    workers = ["localhost:%d" % free_port() for _ in range(n_workers)]
+    procs = []
+    for i in range(n_workers):
+        env = {**os.environ, "TF_CONFIG": json.dumps({
+            "cluster": {"worker": workers},
+            "task": {"type": "worker", "index": i},
+        })}
+        procs.append(subprocess.Popen([sys.executable, __file__], env=env))
+    return [p.wait() for p in procs]
+
+
+def check(n_workers):
+    chief_dir = WORK_DIR / "worker_0"
+    assert (chief_dir / "metric_log.jsonl").exists()
+    assert (chief_dir / "learner_state.json").exists()
+    assert list(chief_dir.glob("*.index"))
+    for i in range(1, n_workers):
+        files = list((WORK_DIR / ("worker_%d" % i)).iterdir())
+        assert not files, "Non-chief worker %d wrote %s" % (i, files)
+    results = [
+        json.loads((WORK_DIR / ("local_eval_%d.json" % i)).read_text())
+        for i in range(n_workers)
+    ]
+    assert all(r == results[0] for r in results), results
+    assert results[0]['total'] == results[0]['expected_total'], results
+
+
+def main():
+    from toolz import curry
+
+    import tensorflow as tf
+    from tensorflow.keras.metrics import CategoricalAccuracy, Mean, CategoricalCrossentropy
+
+    from hanser.distribute import setup_runtime, distribute_datasets
+    from hanser.distribute.multi_worker import get_task
+    from hanser.datasets.mnist import make_mnist_dataset
+    from hanser.transform import pad, to_tensor, normalize
+    from hanser.models.mnist import LeNet5
+    from hanser.train.optimizers import SGD
+    from hanser.train.cls import SuperLearner
+    from hanser.train.lr_schedule import CosineLR
+    from hanser.losses import CrossEntropy
+
+    setup_runtime(fp16=False)
+
+    class HostAccuracy:
+        # Updated on the host with outputs gathered from all workers
+
+        def __init__(self):
+            self.correct = 0
+            self.total = 0
+
+        def update_state(self, y_true, y_pred, sample_weight=None):
+            y_true, y_pred = y_true.numpy(), y_pred.numpy()
+            self.correct += int((y_true.argmax(-1) == y_pred.argmax(-1)).sum())
+            self.total += len(y_true)
+
+        def result(self):
+            return tf.constant(self.correct / max(self.total, 1))
+
+        def reset_states(self):
+            self.correct = 0
+            self.total = 0
+
+    @curry
+    def transform(image, label, training):
+        image = pad(image, 2)
+        image, label = to_tensor(image, label)
+        image = normalize(image, [0.1307], [0.3081])
+
+        label = tf.one_hot(label, 10)
+
+        return image, label
+
+    batch_size = 128
+    eval_batch_size = 256
+    sub_ratio = 0.01
+    ds_train, ds_test, steps_per_epoch, test_steps = \
+        make_mnist_dataset(batch_size, eval_batch_size, transform, sub_ratio=sub_ratio)
+    ds_train, ds_test = distribute_datasets(ds_train, ds_test)
+
+    strategy = tf.distribute.get_strategy()
+    with strategy.scope():
+        model = LeNet5()
+        model.build((None, 32, 32, 1))
+
+        criterion = CrossEntropy()
+
+        epochs = 4
+
+        lr_schedule = CosineLR(0.05, steps_per_epoch, epochs=epochs)
+        optimizer = SGD(lr_schedule, momentum=0.9, weight_decay=1e-4, nesterov=False)
+
+        train_metrics = {
+            'loss': Mean(),
+            'acc': CategoricalAccuracy(),
+        }
+        eval_metrics = {
+            'loss': CategoricalCrossentropy(from_logits=True),
+            'acc': CategoricalAccuracy(),
+        }
+
+    local_eval_metrics = {
+        'acc': HostAccuracy(),
+    }
+
+    _, task_id = get_task()
+    learner = SuperLearner(
+        model, criterion, optimizer, xla_compile=False, multiple_steps=False,
+        train_metrics=train_metrics, eval_metrics=eval_metrics,
+        work_dir=WORK_DIR / ("worker_%d" % task_id))
+
+    learner.fit(ds_train, epochs, ds_test, val_freq=2, save_freq=1,
+                steps_per_epoch=steps_per_epoch, val_steps=test_steps,
+                local_eval_metrics=local_eval_metrics, local_eval_freq=epochs)
+
+    # Gathered from all workers, the same on every worker
+    results = {
+        'acc': learner.metric_history.get_metric('acc', 'eval', epochs - 1, epochs - 1),
+        'total': local_eval_metrics['acc'].total,
+        # All of the 10000 test images, not the shard of this worker
+        'expected_total': round(10000 * sub_ratio),
+    }
+    WORK_DIR.mkdir(exist_ok=True)
+    (WORK_DIR / ("local_eval_%d.json" % task_id)).write_text(json.dumps(results))
+
+
+if __name__ == '__main__':
+    if "TF_CONFIG" in os.environ:
+        main()
+    else:
+        code = max(launch(N_WORKERS))
+        if code == 0:
+            check(N_WORKERS)
+        sys.exit(code)
@@ -0,0 +1,27 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.detection.anchor import AnchorGenerator
+from hanser.detection.assign import grid_points, flat_grid_points
+
+
+def test_cached_grids():
+    anchor_gen = AnchorGenerator(
+        octave_base_scale=4, scales_per_octave=3, ratios=[0.5, 1.0, 2.0], strides=[8, 16, 32])
+    featmap_sizes = [(20, 15), (10, 8), (5, 4)]
+    anchors = anchor_gen.grid_anchors(featmap_sizes)
+    for i, featmap_size in enumerate(featmap_sizes):
+        expected = anchor_gen.single_level_grid_anchors(
+            anchor_gen.base_anchors[i], featmap_size, anchor_gen.strides[i])
+        np.testing.assert_array_equal(anchors[i], expected)
+
+    flat_anchors, num_level_bboxes = anchor_gen.flat_anchors(featmap_sizes)
+    np.testing.assert_array_equal(flat_anchors, tf.concat(anchors, 0))
+    assert num_level_bboxes == [20 * 15 * 9, 10 * 8 * 9, 5 * 4 * 9]
+
+    strides = [8, 16, 32]
+    dynamic_sizes = [(tf.constant(h), tf.constant(w)) for h, w in featmap_sizes]
+    points, num_level_points = flat_grid_points(featmap_sizes, strides)
+    np.testing.assert_array_equal(points, tf.concat(grid_points(dynamic_sizes, strides), 0))
+    assert num_level_points == [300, 80, 20]
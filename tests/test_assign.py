@@ -0,0 +1,35 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.detection.assign import max_iou_assign, atss_assign
+
+
+def grid_anchors(sizes=(32, 16, 8), strides=(8, 16, 32)):
+    anchors = []
+    for size, stride in zip(sizes, strides):
+        c = (np.arange(size) + 0.5) * stride
+        ys, xs = np.meshgrid(c, c, indexing='ij')
+        centers = np.stack([ys, xs], -1).reshape(-1, 2)
+        anchors.append(np.concatenate([centers - 2 * stride, centers + 2 * stride], -1))
+    return tf.constant(np.concatenate(anchors), tf.float32), [len(a) for a in anchors]
+
+
+def test_tiled_assign():
+    anchors, num_level_bboxes = grid_anchors()
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        yx = np.round(rng.uniform(0, 200, (20, 2)) / 8) * 8
+        hw = rng.uniform(8, 120, (20, 2))
+        gt_bboxes = tf.constant(np.concatenate([yx, yx + hw], -1), tf.float32)
+
+        expected = max_iou_assign(anchors, gt_bboxes, 0.5, 0.4, tile_size=None)
+        for tile_size in [100, 777]:
+            np.testing.assert_array_equal(
+                max_iou_assign(anchors, gt_bboxes, 0.5, 0.4, tile_size=tile_size), expected)
+
+        expected = atss_assign(anchors, num_level_bboxes, gt_bboxes, tile_size=None)
+        assert np.sum(expected.numpy() > 0) > 0
+        for tile_size in [100, 777]:
+            np.testing.assert_array_equal(
+                atss_assign(anchors, num_level_bboxes, gt_bboxes, tile_size=tile_size), expected)
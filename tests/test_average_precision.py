@@ -0,0 +1,46 @@
+import numpy as np
+
+import pytest
+
+from hanser.detection.bbox import BBox
+from hanser.detection.eval import average_precision_arrays, _average_precision_py
+
+
+def test_average_precision():
+    # Compares the compiled evaluator with the Python one, skipped if not built
+    pytest.importorskip("hanser._numpy")
+    rng = np.random.default_rng(0)
+    n_gts, n_dts = 300, 1000
+    gt_image_ids = rng.integers(0, 100, n_gts)
+    gt_labels = rng.integers(0, 5, n_gts)
+    yx = rng.uniform(0, 0.7, (n_gts, 2))
+    gt_bboxes = np.concatenate([yx, yx + rng.uniform(0.05, 0.3, (n_gts, 2))], 1)
+    gt_difficult = rng.random(n_gts) < 0.1
+
+    # Half of the detections are jittered gts, scores are rounded to have ties
+    idx = rng.integers(0, n_gts, n_dts // 2)
+    dt_image_ids = np.concatenate([gt_image_ids[idx], rng.integers(0, 100, n_dts // 2)])
+    dt_labels = np.concatenate([gt_labels[idx], rng.integers(0, 5, n_dts // 2)])
+    yx = rng.uniform(0, 0.7, (n_dts // 2, 2))
+    dt_bboxes = np.concatenate([
+        gt_bboxes[idx] + rng.normal(0, 0.03, (n_dts // 2, 4)),
+        np.concatenate([yx, yx + rng.uniform(0.05, 0.3, (n_dts // 2, 2))], 1),
+    ])
+    dt_scores = np.round(rng.random(n_dts), 2)
+
+    detections = [
+        BBox(image_id=i, category_id=c, score=s, bbox=b)
+        for i, c, s, b in zip(dt_image_ids, dt_labels, dt_scores, dt_bboxes)
+    ]
+    ground_truths = [
+        BBox(image_id=i, category_id=c, bbox=b, is_difficult=d)
+        for i, c, b, d in zip(gt_image_ids, gt_labels, gt_bboxes, gt_difficult)
+    ]
+    for use_07_metric in [True, False]:
+        aps = average_precision_arrays(
+            dt_image_ids, dt_labels, dt_scores, dt_bboxes,
+            gt_image_ids, gt_labels, gt_bboxes, gt_difficult, use_07_metric=use_07_metric)
+        expected = _average_precision_py(detections, ground_truths, use_07_metric=use_07_metric)
+        assert aps.keys() == expected.keys()
+        for c in aps:
+            np.testing.assert_allclose(aps[c], expected[c], atol=1e-6)
@@ -0,0 +1,60 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.transform import random_resized_crop_batch, color_jitter_batch
+from hanser.datasets.utils import prepare
+
+
+def _same_images(n, h=32, w=40):
+    # Every pixel differs, so different crops give different outputs
+    image = np.arange(h * w * 3).reshape(h, w, 3) % 251
+    return tf.convert_to_tensor(np.broadcast_to(image, (n, h, w, 3)).astype(np.uint8))
+
+
+def _n_distinct(images):
+    return len(np.unique(images.numpy().reshape(len(images), -1), axis=0))
+
+
+def test_random_resized_crop_batch():
+    tf.random.set_seed(0)
+    images = _same_images(16)
+    outputs = random_resized_crop_batch(images, (16, 24))
+    assert outputs.shape == (16, 16, 24, 3)
+    assert outputs.dtype == tf.uint8
+    # Parameters are sampled per image
+    assert _n_distinct(outputs) == 16
+
+    # No crop fits, the whole image is taken
+    outputs = random_resized_crop_batch(images, (32, 40), scale=(2.0, 2.0))
+    np.testing.assert_array_equal(outputs.numpy(), images.numpy())
+
+
+def test_color_jitter_batch():
+    tf.random.set_seed(0)
+    images = _same_images(16)
+    outputs = color_jitter_batch(images, 0.4, 0.4, 0.4, 0.1)
+    assert outputs.shape == images.shape
+    assert outputs.dtype == tf.uint8
+    assert _n_distinct(outputs) > 1
+
+    outputs = color_jitter_batch(tf.cast(images, tf.float32), 0.4, 0.4, 0.4, 0.1)
+    assert outputs.dtype == tf.float32
+    assert 0 <= outputs.numpy().min() and outputs.numpy().max() <= 255
+
+
+def test_prepare_batched_transform():
+    tf.random.set_seed(0)
+    images = _same_images(32)
+    labels = tf.range(32)
+
+    def batched_transform(images, labels):
+        images = random_resized_crop_batch(images, 16)
+        return color_jitter_batch(images, 0.4, 0.4, 0.4, 0.1), labels
+
+    ds = prepare(tf.data.Dataset.from_tensor_slices((images, labels)), 8,
+                 training=True, batched_transform=batched_transform, seed=0)
+    for x, y in ds.take(4):
+        assert x.shape == (8, 16, 16, 3)
+        assert x.dtype == tf.uint8
+        assert _n_distinct(x) == 8
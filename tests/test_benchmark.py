@@ -0,0 +1,46 @@
+import time
+
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.datasets.benchmark import sweep
+
+
+def test_sweep():
+    calls = []
+
+    def make_dataset(delay_ms=0, prefetch=True):
+        calls.append({'delay_ms': delay_ms, 'prefetch': prefetch})
+
+        def slow(x):
+            time.sleep(delay_ms / 1000)
+            return x
+
+        ds = tf.data.Dataset.from_tensors(np.zeros((4, 2), np.float32)).repeat()
+        ds = ds.map(lambda x: tf.numpy_function(slow, [x], tf.float32))
+        if prefetch:
+            ds = ds.prefetch(2)
+        return ds, 10
+
+    best, results = sweep(make_dataset, {
+        'delay_ms': [20, 0],
+        'prefetch': [False, True],
+        # Not accepted by `make_dataset`
+        'cycle_length': [8, 16],
+        # Set on the returned dataset
+        'threadpool_size': [None, 2],
+    }, num_batches=10, warmup=2, print_fn=None)
+
+    # The first config runs once, then each other candidate of each option
+    assert [config for config, _ in results] == [
+        {'delay_ms': 20, 'prefetch': False, 'threadpool_size': None},
+        {'delay_ms': 0, 'prefetch': False, 'threadpool_size': None},
+        {'delay_ms': 0, 'prefetch': True, 'threadpool_size': None},
+        {'delay_ms': 0, 'prefetch': best['prefetch'], 'threadpool_size': 2},
+    ]
+    assert calls == [{k: v for k, v in config.items() if k != 'threadpool_size'} for config, _ in results]
+    assert best['delay_ms'] == 0
+    best_result = max((r for _, r in results), key=lambda r: r['examples_per_sec'])
+    assert [r for c, r in results if c == best] == [best_result]
+    assert all(r['examples_per_sec'] > 0 for _, r in results)
@@ -0,0 +1,53 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.train.checkpoint import AsyncCheckpointWriter, CheckpointManager, write_checkpoint
+
+
+def test_write_checkpoint(tmp_path):
+    v = tf.Variable(tf.ones([3]))
+    ckpt = tf.train.Checkpoint(v=v)
+    write_checkpoint(ckpt, tmp_path / "ckpt")
+    v.assign(tf.fill([3], 2.))
+    write_checkpoint(ckpt, tmp_path / "ckpt")
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['ckpt.data-00000-of-00001', 'ckpt.index']
+
+    v.assign(tf.zeros([3]))
+    ckpt.restore(str(tmp_path / "ckpt"))
+    np.testing.assert_allclose(v.numpy(), 2.)
+
+
+def test_async_checkpoint_writer(tmp_path):
+    v = tf.Variable(tf.ones([3]))
+    ckpt = tf.train.Checkpoint(v=v)
+    writer = AsyncCheckpointWriter(max_pending=2)
+    for i in range(5):
+        v.assign(tf.fill([3], float(i)))
+        writer.write(ckpt, tmp_path / "ckpt")
+    # Modified after snapshot
+    v.assign(tf.fill([3], -1.))
+    writer.wait()
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['ckpt.data-00000-of-00001', 'ckpt.index']
+
+    ckpt.restore(str(tmp_path / "ckpt"))
+    np.testing.assert_allclose(v.numpy(), 4.)
+
+
+def test_checkpoint_manager(tmp_path):
+    v = tf.Variable(tf.ones([3]))
+    ckpt = tf.train.Checkpoint(v=v)
+    manager = CheckpointManager(tmp_path, max_to_keep=2, keep_best={'acc': 'max'})
+    accs = [0.5, 0.9, 0.6, 0.7, 0.8]
+    for epoch, acc in enumerate(accs):
+        v.assign(tf.fill([3], float(epoch)))
+        manager.save(ckpt, epoch)
+        manager.record(epoch, {'acc': acc, 'end': '00:00:00'})
+    assert manager.checkpoints == ['ckpt-2', 'ckpt-4', 'ckpt-5']
+    assert manager.best_checkpoint('acc') == str(tmp_path / 'ckpt-2')
+    assert len(list(tmp_path.glob("ckpt-*.index"))) == 3
+
+    manager = CheckpointManager(tmp_path)
+    assert manager.latest_checkpoint == str(tmp_path / 'ckpt-5')
+    ckpt.restore(manager.latest_checkpoint)
+    np.testing.assert_allclose(v.numpy(), 4.)
@@ -0,0 +1,22 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.distribute import is_distribute_strategy, parse_strategy, local_results
+
+
+def test_parse_strategy():
+    assert parse_strategy() is None
+
+    # Single-host mirrored strategies run as without a strategy
+    strategy = tf.distribute.MirroredStrategy(['/cpu:0'])
+    assert not is_distribute_strategy(strategy)
+    with strategy.scope():
+        assert parse_strategy() is None
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    assert is_distribute_strategy(strategy)
+    with strategy.scope():
+        assert parse_strategy() is strategy
+        values = strategy.run(lambda: tf.ones([2]))
+        np.testing.assert_array_equal(local_results(values), [1., 1.])
@@ -0,0 +1,75 @@
+import numpy as np
+
+import tensorflow as tf
+import tensorflow.keras.mixed_precision.experimental as mixed_precision
+from tensorflow.keras.metrics import Mean
+
+from hanser.train.cls import SuperLearner
+
+
+def _train_step(tmp_path, weights, ds, n_batches_per_step):
+    # Embeddings have sparse gradients
+    model = tf.keras.Sequential([
+        tf.keras.layers.Embedding(10, 4, input_length=2),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(3),
+    ])
+    model.build((None, 2))
+    model.set_weights(weights)
+    criterion = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    learner = SuperLearner(
+        model, criterion, tf.keras.optimizers.SGD(0.5), xla_compile=False,
+        train_metrics={'loss': Mean()}, eval_metrics={},
+        work_dir=tmp_path, n_batches_per_step=n_batches_per_step)
+    learner.fit(ds, 1, steps_per_epoch=1)
+    return model.get_weights()
+
+
+def test_grad_accumulation(tmp_path):
+    x = np.random.randint(0, 10, (8, 2)).astype(np.int32)
+    y = np.random.randint(0, 3, (8,))
+    ds = tf.data.Dataset.from_tensor_slices((x, y))
+
+    for policy, atol in [('float32', 1e-6), ('mixed_float16', 1e-3)]:
+        mixed_precision.set_policy(policy)
+        try:
+            model = tf.keras.Sequential([
+                tf.keras.layers.Embedding(10, 4, input_length=2),
+                tf.keras.layers.Flatten(),
+                tf.keras.layers.Dense(3),
+            ])
+            model.build((None, 2))
+            weights = model.get_weights()
+
+            full = _train_step(tmp_path / policy / "full", weights, ds.batch(8), None)
+            accum = _train_step(tmp_path / policy / "accum", weights, ds.batch(2), 4)
+        finally:
+            mixed_precision.set_policy('float32')
+        for w0, w1, w2 in zip(weights, full, accum):
+            assert not np.allclose(w0, w1)
+            np.testing.assert_allclose(w1, w2, atol=atol)
+
+
+def test_grad_accumulation_graph_size(tmp_path):
+    model = tf.keras.Sequential([
+        tf.keras.layers.Embedding(10, 4, input_length=2),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(3),
+    ])
+    model.build((None, 2))
+    criterion = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    learner = SuperLearner(
+        model, criterion, tf.keras.optimizers.SGD(0.5), xla_compile=False,
+        train_metrics={'loss': Mean()}, eval_metrics={},
+        work_dir=tmp_path, n_batches_per_step=2)
+    learner.init_state('train', epochs=1)
+
+    batch = (tf.zeros((2, 2), dtype=tf.int32), tf.zeros((2,), dtype=tf.int64))
+    n_ops = []
+    for n_batches in [2, 8]:
+        graph = tf.function(learner.train_batches).get_concrete_function(*[batch] * n_batches).graph
+        n_ops.append(len([op for op in graph.get_operations() if op.type != 'Placeholder']))
+    # Micro-batches run in a graph loop instead of being unrolled
+    assert n_ops[0] == n_ops[1]
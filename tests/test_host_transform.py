@@ -0,0 +1,51 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.transform import resize, center_crop
+from hanser.transform.host import resize as host_resize, center_crop as host_center_crop, to_tensor, \
+    decode_image
+from hanser.datasets.host import make_host_dataset
+
+
+def test_resize():
+    image = np.random.randint(0, 256, (37, 53, 3)).astype(np.uint8)
+    for size in [(20, 30), (80, 90), 24]:
+        np.testing.assert_array_equal(host_resize(image, size), resize(tf.convert_to_tensor(image), size).numpy())
+    np.testing.assert_array_equal(host_center_crop(image, 20), center_crop(image, 20).numpy())
+
+
+def test_decode_grayscale():
+    image = np.random.randint(0, 256, (8, 10)).astype(np.uint8)
+    np.testing.assert_array_equal(decode_image(image, channels=1), image[..., None])
+
+    # Same as decoding a grayscale PNG
+    data = tf.io.encode_png(image[..., None]).numpy()
+    np.testing.assert_array_equal(decode_image(data, channels=1), image[..., None])
+
+    x = np.random.randint(0, 256, (32, 8, 8)).astype(np.uint8)
+    y = np.random.randint(0, 10, (32,))
+
+    def transform(image, label, rng):
+        return to_tensor(image, label)
+
+    ds = make_host_dataset(x, y, 16, transform, training=False, repeat=False, num_workers=2)
+    for image, label in ds:
+        assert image.shape == (16, 8, 8, 1)
+
+
+def test_host_dataset():
+    x = np.random.randint(0, 256, (100, 8, 8, 3)).astype(np.uint8)
+    y = np.random.randint(0, 10, (100,))
+
+    def transform(image, label, rng):
+        return to_tensor(image, label)
+
+    ds = make_host_dataset(x, y, 16, transform, training=False, repeat=False, num_workers=3)
+    xs, ys = zip(*[(image.numpy(), label.numpy()) for image, label in ds])
+    np.testing.assert_allclose(np.concatenate(xs), x / 255, atol=1e-6)
+    np.testing.assert_array_equal(np.concatenate(ys), y)
+
+    ds = make_host_dataset(x, y, 16, transform, training=True, num_workers=3, seed=0)
+    for image, label in ds.take(10):
+        assert image.shape == (16, 8, 8, 3)
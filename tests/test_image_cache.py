@@ -0,0 +1,88 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.datasets.cache import write_image_cache, read_image_cache, image_cache
+
+
+def _make_dataset(images):
+    def gen():
+        for i, image in enumerate(images):
+            yield image, i
+
+    return tf.data.Dataset.from_generator(
+        gen, output_signature=(tf.TensorSpec([None, None, 3], tf.uint8), tf.TensorSpec([], tf.int32)))
+
+
+def test_image_cache(tmp_path):
+    images = [np.random.randint(0, 256, (h, w, 3)).astype(np.uint8) for h, w in [(40, 60), (20, 10), (64, 64)]]
+    ds = _make_dataset(images)
+    write_image_cache(ds, tmp_path / "cache", short_side=32, shard_bytes=4096)
+
+    ds, load = read_image_cache(tmp_path / "cache")
+    outputs = [load(i) for i in ds]
+    assert [tuple(image.shape) for image, _ in outputs] == [(32, 48, 3), (20, 10, 3), (32, 32, 3)]
+    np.testing.assert_array_equal(outputs[1][0].numpy(), images[1])
+    assert [int(label) for _, label in outputs] == [0, 1, 2]
+
+
+def test_concurrent_writers(tmp_path):
+    images = [np.random.randint(0, 256, (32, 32, 3)).astype(np.uint8) for _ in range(50)]
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [
+            pool.submit(image_cache, _make_dataset(images), tmp_path, "key")
+            for _ in range(2)
+        ]
+        results = [f.result() for f in futures]
+
+    for ds, load in results:
+        outputs = [load(i) for i in ds]
+        assert len(outputs) == len(images)
+        for (image, label), expected in zip(outputs, images):
+            np.testing.assert_array_equal(image.numpy(), expected)
+
+    # A finished cache is kept by later writers
+    index = tmp_path / "key" / "index.npy"
+    inode = index.stat().st_ino
+    write_image_cache(_make_dataset(images), tmp_path / "key")
+    assert index.stat().st_ino == inode
+    assert [p.name for p in tmp_path.iterdir()] == ["key"]
+
+
+def test_wait_for_writer(tmp_path):
+    images = [np.random.randint(0, 256, (32, 32, 3)).astype(np.uint8) for _ in range(5)]
+
+    def gen():
+        raise AssertionError("The cache is written by the process holding the lock")
+        yield
+
+    unused = tf.data.Dataset.from_generator(
+        gen, output_signature=(tf.TensorSpec([None, None, 3], tf.uint8), tf.TensorSpec([], tf.int32)))
+
+    lock = tmp_path / "key.lock"
+    lock.touch()
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(image_cache, unused, tmp_path, "key", poll_interval=0.05)
+        write_image_cache(_make_dataset(images), tmp_path / "key")
+        lock.unlink()
+        ds, load = future.result()
+    assert len([load(i) for i in ds]) == len(images)
+
+
+def test_stale_lock(tmp_path, capsys):
+    images = [np.random.randint(0, 256, (32, 32, 3)).astype(np.uint8) for _ in range(5)]
+
+    lock = tmp_path / "key.lock"
+    lock.touch()
+    os.utime(lock, (time.time() - 3600, time.time() - 3600))
+    ds, load = image_cache(_make_dataset(images), tmp_path, "key", poll_interval=0.05)
+    assert len([load(i) for i in ds]) == len(images)
+    assert not lock.exists()
+
+    write_image_cache(_make_dataset(images), tmp_path / "progress", log_interval=0)
+    assert ">> Cached 5 images" in capsys.readouterr().out
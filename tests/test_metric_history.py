@@ -0,0 +1,69 @@
+import numpy as np
+
+from hanser.train.metric_history import MetricHistory, append_log, read_log
+
+
+def test_metric_log(tmp_path):
+    fp = tmp_path / "metric_log.jsonl"
+    h = MetricHistory(["train", "eval"])
+    for epoch in range(3):
+        h.record("train", epoch, "loss", np.float32(1. / (epoch + 1)))
+        h.record("train", epoch, "end", "00:00:0%d" % epoch)
+        append_log(fp, h.pop_log_lines())
+        h.record("eval", epoch, "acc", np.float32(epoch / 10))
+        append_log(fp, h.pop_log_lines())
+    assert h.pop_log_lines() == ""
+    assert len(fp.read_text().splitlines()) == 6
+
+    # Partially written record
+    with open(fp, "a") as f:
+        f.write('{"stage": "train", "epo')
+
+    h2 = MetricHistory(["train", "eval"])
+    h2.load(read_log(fp))
+    np.testing.assert_allclose(h2.get_metric("loss", "train"), [1., 0.5, 1. / 3], rtol=1e-6)
+    assert h2.get_metric("end", "train", 1, 1) == "00:00:01"
+
+    h2.load(read_log(fp, max_epoch=1))
+    np.testing.assert_allclose(h2.get_metric("acc", "eval"), [0., 0.1], rtol=1e-6)
+
+
+def test_append_after_partial_line(tmp_path):
+    fp = tmp_path / "metric_log.jsonl"
+    h = MetricHistory(["train"])
+    h.record("train", 0, "loss", 1.)
+    append_log(fp, h.pop_log_lines())
+    # Crashed while writing the record of epoch 1
+    with open(fp, "a") as f:
+        f.write('{"stage": "train", "epoch": 1, "met')
+
+    # Resumed from epoch 1
+    h.record("train", 1, "loss", 0.5)
+    h.record("train", 2, "loss", 0.25)
+    append_log(fp, h.pop_log_lines())
+
+    h2 = MetricHistory(["train"])
+    h2.load(read_log(fp))
+    assert h2.get_metric("loss", "train") == [1., 0.5, 0.25]
+
+
+def test_metric_queries():
+    h = MetricHistory(["train", "eval"])
+    accs = [0.3, 0.5, 0.4, 0.7]
+    for epoch, acc in enumerate(accs):
+        h.record("train", epoch, "loss", 1. - acc)
+        if epoch % 2 == 1:
+            h.record("eval", epoch, "acc", acc)
+
+    assert h.get_metric("acc", "eval") == [0.5, 0.7]
+    assert h.get_metric("acc", "eval", 1, 1) == 0.5
+    assert h.get_metric("acc", "eval", 2, 2) is None
+    assert h.latest("acc", "eval") == 0.7
+    assert h.best("loss", "train", mode='min') == (3, 1. - 0.7)
+
+    epochs, values = h.best_so_far("loss", "train", mode='min')
+    np.testing.assert_array_equal(epochs, [0, 1, 2, 3])
+    np.testing.assert_allclose(values, [0.7, 0.5, 0.5, 0.3])
+
+    epochs, values = h.moving_average("loss", "train", 2)
+    np.testing.assert_allclose(values, [0.7, 0.6, 0.55, 0.45])
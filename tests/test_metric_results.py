@@ -0,0 +1,85 @@
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras.metrics import Metric, Mean, SparseCategoricalAccuracy
+
+from hanser.train.cls import SuperLearner
+
+
+class Count(Metric):
+
+    def __init__(self, name='count'):
+        super().__init__(name=name)
+        self.count = self.add_weight('count', shape=(), dtype=tf.int64, initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        self.count.assign_add(tf.size(y_true, out_type=tf.int64))
+
+    def result(self):
+        return self.count
+
+
+class HostCount:
+    # Metric updated on the host with outputs of the eval step
+
+    def __init__(self):
+        self.n = 0
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        self.n += len(y_true)
+
+    def result(self):
+        return tf.constant(self.n)
+
+    def reset_states(self):
+        self.n = 0
+
+
+def _make_learner(tmp_path):
+    model = tf.keras.Sequential([tf.keras.layers.Dense(3, input_shape=(8,))])
+    criterion = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    return SuperLearner(
+        model, criterion, tf.keras.optimizers.SGD(0.1), xla_compile=False,
+        train_metrics={'loss': Mean()}, eval_metrics={'acc': SparseCategoricalAccuracy()},
+        work_dir=tmp_path)
+
+
+def test_metric_results(tmp_path):
+    learner = _make_learner(tmp_path)
+    metrics = {'loss': Mean(), 'acc': SparseCategoricalAccuracy(), 'count': Count(), 'host': HostCount()}
+    metrics['loss'].update_state([0.5, 1.0, 2.0])
+    metrics['acc'].update_state([0, 1, 2], [[1., 0., 0.], [1., 0., 0.], [0., 0., 1.]])
+    # Not exact in float32
+    metrics['count'].count.assign(2 ** 40 + 3)
+    metrics['host'].update_state([1, 2], None)
+
+    for _ in range(2):
+        results = learner._compute_metric_results(metrics)
+        assert list(results.keys()) == list(metrics.keys())
+        for name, m in metrics.items():
+            assert results[name] == m.result().numpy()
+        assert results['count'] == 2 ** 40 + 3 and results['count'].dtype == np.int64
+    assert len(learner._metric_result_fns) == 1
+
+
+def test_evaluate_local(tmp_path):
+    learner = _make_learner(tmp_path)
+    x = np.random.normal(size=(40, 8)).astype(np.float32)
+    y = np.random.randint(0, 3, (40,))
+    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(8)
+    expected_acc = np.mean(np.argmax(learner.model(x).numpy(), -1) == y)
+
+    metrics = {'acc': SparseCategoricalAccuracy(), 'count': Count()}
+    for _ in range(2):
+        learner.evaluate_local(iter(ds), 5, metrics)
+        np.testing.assert_allclose(learner.metric_history.get_metric('acc', 'eval'), expected_acc, rtol=1e-6)
+        assert learner.metric_history.get_metric('count', 'eval') == 40
+    # Step functions are cached by metrics
+    assert len(learner._local_eval_step_fns) == 1
+
+    metrics = {'acc': SparseCategoricalAccuracy(), 'host': HostCount()}
+    learner.evaluate_local(iter(ds), 5, metrics)
+    assert learner.metric_history.get_metric('host', 'eval') == 40
+    np.testing.assert_allclose(learner.metric_history.get_metric('acc', 'eval'), expected_acc, rtol=1e-6)
+    assert len(learner._local_eval_step_fns) == 2
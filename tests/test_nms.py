@@ -0,0 +1,82 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.detection import postprocess
+from hanser.detection.bbox import BBoxCoder
+from hanser.detection.nms import nms, nms_per_class, batched_nms, padded_nms
+
+
+def random_bboxes(n, q=1):
+    yx = np.random.uniform(0, 0.8, (n, q, 2))
+    hw = np.random.uniform(0.05, 0.3, (n, q, 2))
+    return tf.constant(np.concatenate([yx, yx + hw], -1), tf.float32)
+
+
+def sort_detections(bboxes, scores, labels, n_valids):
+    n = int(n_valids)
+    bboxes, scores, labels = bboxes[:n].numpy(), scores[:n].numpy(), labels[:n].numpy()
+    order = np.lexsort((labels, -scores))
+    return bboxes[order], scores[order], labels[order]
+
+
+def test_nms():
+    np.random.seed(0)
+    for soft_nms_sigma in [0.0, 0.5]:
+        for q in [1, 5]:
+            for max_per_class, topk in [(100, 200), (3, 10), (20, 10)]:
+                bboxes = random_bboxes(300, q)
+                scores = tf.constant(np.random.uniform(0, 0.3, (300, 5)), tf.float32)
+                expected = nms_per_class(bboxes, scores, 0.5, 0.05, soft_nms_sigma, max_per_class, topk)
+                outputs = nms(bboxes, scores, 0.5, 0.05, soft_nms_sigma, max_per_class, topk)
+                assert int(outputs[3]) == int(expected[3])
+                for x, y in zip(sort_detections(*outputs), sort_detections(*expected)):
+                    np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5)
+
+
+def test_batched_nms():
+    np.random.seed(1)
+    bboxes = tf.stack([random_bboxes(200) for _ in range(3)])
+    scores = tf.constant(np.random.uniform(0, 0.3, (3, 200, 4)), tf.float32)
+    for soft_nms_sigma in [0.0, 0.5]:
+        outputs = batched_nms(bboxes, scores, soft_nms_sigma=soft_nms_sigma, max_per_class=30, topk=50)
+        assert outputs[0].shape == (3, 50, 4)
+        for i in range(3):
+            expected = nms_per_class(bboxes[i], scores[i], 0.5, 0.05, soft_nms_sigma, 30, 50)
+            for x, y in zip(sort_detections(*[o[i] for o in outputs]), sort_detections(*expected)):
+                np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5)
+
+
+def test_padded_nms():
+    np.random.seed(2)
+    bboxes = tf.stack([random_bboxes(200) for _ in range(3)])
+    scores = tf.constant(np.random.uniform(0, 0.3, (3, 200, 4)), tf.float32)
+    for soft_nms_sigma in [0.0, 0.5]:
+        fn = tf.function(lambda b, s: padded_nms(
+            b, s, 0.5, 0.05, soft_nms_sigma, max_per_class=30, topk=50, pre_nms_size=200, tile_size=64),
+            jit_compile=True)
+        outputs = fn(bboxes, scores)
+        expected = batched_nms(bboxes, scores, soft_nms_sigma=soft_nms_sigma, max_per_class=30, topk=50)
+        for i in range(3):
+            for x, y in zip(sort_detections(*[o[i] for o in outputs]), sort_detections(*[o[i] for o in expected])):
+                np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5)
+
+
+def test_postprocess_padded_nms():
+    np.random.seed(3)
+    bbox_coder = BBoxCoder(random_bboxes(500)[:, 0].numpy())
+    bbox_preds = tf.constant(np.random.normal(0, 0.1, (2, 500, 4)), tf.float32)
+    cls_scores = tf.constant(np.random.normal(-2, 1, (2, 500, 4)), tf.float32)
+    for soft_nms_sigma in [0.0, 0.5]:
+        kwargs = dict(nms_pre=300, topk=50, soft_nms_sigma=soft_nms_sigma, use_sigmoid=True)
+        # Top-k candidates, decoding and NMS compiled in one XLA function
+        fn = tf.function(lambda p, s: postprocess(p, s, bbox_coder, use_padded_nms=True, **kwargs),
+                         jit_compile=True)
+        outputs = fn(bbox_preds, cls_scores)
+        expected = postprocess(bbox_preds, cls_scores, bbox_coder, **kwargs)
+        keys = ['bbox', 'score', 'label', 'n_valid']
+        assert int(tf.reduce_min(expected['n_valid'])) > 0
+        for i in range(2):
+            for x, y in zip(sort_detections(*[outputs[k][i] for k in keys]),
+                            sort_detections(*[expected[k][i] for k in keys])):
+                np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import tensorflow as tf
+
+from hanser.datasets.classification.numpy import make_numpy_dataset
+
+
+def _transform(training):
+    def fn(image, label):
+        return tf.cast(image, tf.float32) / 255, label
+    return fn
+
+
+def _make_datasets(backend, sub_ratio=None, input_context=None, **kwargs):
+    # The image of example i is filled with i, so images can be checked by labels
+    labels = np.arange(100, dtype=np.int32)
+    images = np.broadcast_to(labels[:, None, None, None], (100, 4, 4, 3)).astype(np.uint8)
+    return make_numpy_dataset(
+        images[:80], labels[:80], images[80:], labels[80:], 8, 6, _transform,
+        sub_ratio=sub_ratio, backend=backend, input_context=input_context, **kwargs)
+
+
+def _eval_batches(ds_test, steps):
+    return [(x.numpy(), y.numpy()) for x, y in ds_test.take(steps)]
+
+
+def test_memmap_backend(tmp_path):
+    for sub_ratio in [None, 0.5]:
+        for input_context in [None, tf.distribute.InputContext(2, 1, 2)]:
+            ds_train, ds_test, steps, test_steps = _make_datasets(
+                'tf', sub_ratio, input_context, seed=0)
+            ds_train_m, ds_test_m, steps_m, test_steps_m = _make_datasets(
+                'memmap', sub_ratio, input_context, seed=0, memmap_dir=str(tmp_path))
+            assert (steps, test_steps) == (steps_m, test_steps_m)
+
+            for (x, y), (xm, ym) in zip(_eval_batches(ds_test, test_steps), _eval_batches(ds_test_m, test_steps)):
+                np.testing.assert_array_equal(y, ym)
+                np.testing.assert_array_equal(x, xm)
+
+            # Same examples of the shard, in a different shuffled order
+            batch_size = 8 // (input_context.num_input_pipelines if input_context else 1)
+            xm, ym = [np.concatenate(b) for b in zip(*_eval_batches(ds_train_m, steps))]
+            assert xm.shape == (steps * batch_size, 4, 4, 3)
+            np.testing.assert_allclose(xm, np.broadcast_to(ym[:, None, None, None] / 255, xm.shape), rtol=1e-6)
+            assert len(np.unique(ym)) == len(ym)
+            labels = np.unique([y for _, y in _eval_batches(ds_train, steps * 4)])
+            labels_m = np.unique([y for _, y in _eval_batches(ds_train_m, steps * 4)])
+            np.testing.assert_array_equal(labels, labels_m)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['x_test.npy', 'x_train.npy', 'y_test.npy', 'y_train.npy']
+
+
+def test_unsupported_kwargs():
+    _make_datasets('tf', cache=False, num_parallel_calls=2)
+    for backend, kwargs in [
+        ('memmap', {'cache': False}),
+        ('memmap', {'num_parallel_calls': 2}),
+        ('host', {'zip_transform': lambda a, b: a}),
+        ('host', {'batched_transform': lambda x, y: (x, y)}),
+    ]:
+        with pytest.raises(ValueError, match=list(kwargs)[0]):
+            _make_datasets(backend, **kwargs)
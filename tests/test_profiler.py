@@ -0,0 +1,33 @@
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras.metrics import Mean, SparseCategoricalAccuracy
+
+from hanser.train.cls import SuperLearner
+from hanser.train.callbacks import Profiler
+
+
+def test_profiler(tmp_path):
+    x = np.random.normal(size=(64, 8)).astype(np.float32)
+    y = np.random.randint(0, 3, (64,))
+    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(16).repeat()
+
+    model = tf.keras.Sequential([tf.keras.layers.Dense(3, input_shape=(8,))])
+    criterion = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    learner = SuperLearner(
+        model, criterion, tf.keras.optimizers.SGD(0.1), xla_compile=False,
+        train_metrics={'loss': Mean(), 'acc': SparseCategoricalAccuracy()},
+        eval_metrics={'acc': SparseCategoricalAccuracy()},
+        work_dir=tmp_path)
+    profiler = Profiler(print_fn=lambda *args: None)
+    learner.fit(ds, 2, ds_val=ds, steps_per_epoch=4, val_steps=4, callbacks=[profiler])
+
+    for stage in ['train', 'eval']:
+        for name in ['step_time', 'data_time', 'transfer_time', 'compute_time']:
+            values = profiler.history.get_metric("%s_p50" % name, stage)
+            assert len(values) == 2 and all(v >= 0 for v in values)
+        step_time = profiler.history.get_metric("step_time_p50", stage)
+        data_time = profiler.history.get_metric("data_time_p50", stage)
+        assert all(s >= d for s, d in zip(step_time, data_time))
+        assert learner.metric_history.get_metric("step_time_p50", stage) is None
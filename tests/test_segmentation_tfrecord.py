@@ -0,0 +1,101 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import tensorflow as tf
+
+from hanser.datasets.tfrecord import IndexedTFRecordWriter
+from hanser.datasets.segmentation.tfrecord import make_tfrecord_dataset, process_example, \
+    _center_crop_box, _resized_size
+from hanser.datasets.segmentation.cityscapes import LABEL_MAP
+
+
+def _write_shards(tmp_path, split, sizes):
+    filenames = []
+    k = 0
+    for shard, size in enumerate(sizes):
+        fp = str(tmp_path / ("%s-%d" % (split, shard)))
+        with IndexedTFRecordWriter(fp) as writer:
+            for i in range(size):
+                writer.write(b"%d" % k)
+                k += 1
+        filenames.append(fp)
+    return filenames
+
+
+def _transform(training):
+    def fn(example):
+        return tf.strings.to_number(example, tf.int32)
+    return fn
+
+
+def test_make_tfrecord_dataset(tmp_path):
+    train_files = _write_shards(tmp_path, "train", [10, 10, 12, 8])
+    val_files = _write_shards(tmp_path, "val", [7])
+
+    examples = []
+    for i in range(2):
+        input_context = tf.distribute.InputContext(2, i, 2)
+        ds_train, ds_val, steps_per_epoch, val_steps = make_tfrecord_dataset(
+            train_files, val_files, 8, 4, _transform, input_context=input_context, buffer_size=4)
+        assert (steps_per_epoch, val_steps) == (5, 2)
+        batches = [x.numpy() for x in ds_train.take(40)]
+        assert all(len(b) == 4 for b in batches)
+        examples.append(np.unique(np.concatenate(batches)))
+        # Fewer files than input pipelines, examples are sharded
+        np.testing.assert_array_equal(np.concatenate([x.numpy() for x in ds_val]), np.arange(i, 7, 2))
+
+    np.testing.assert_array_equal(examples[0], np.concatenate([np.arange(10), np.arange(20, 32)]))
+    np.testing.assert_array_equal(examples[1], np.concatenate([np.arange(10, 20), np.arange(32, 40)]))
+
+
+def test_resized_size_and_crop_box():
+    assert _resized_size(60, 40, 20) == (30, 20)
+    assert _resized_size(40, 60, 20) == (20, 30)
+    # (height, width)
+    assert _resized_size(60, 40, (10, 12)) == (12, 10)
+
+    assert _center_crop_box(30, 20, 16) == (7, 2, 23, 18)
+    assert _center_crop_box(30, 20, (10, 40)) == (0, 5, 30, 15)
+
+
+def _write_pair(tmp_path):
+    image = np.random.randint(0, 256, (40, 60, 3)).astype(np.uint8)
+    # Cityscapes ids, with `unlabeled` (0) mapped to ignore (255)
+    label = np.random.choice([0, 7, 8, 26], (40, 60)).astype(np.uint8)
+    image_fp, label_fp = tmp_path / "image.jpg", tmp_path / "label.png"
+    Image.fromarray(image).save(image_fp)
+    Image.fromarray(label).save(label_fp)
+    return image_fp, label_fp, label
+
+
+def _decode(data):
+    return np.array(Image.open(io.BytesIO(data)))
+
+
+def test_process_example(tmp_path):
+    image_fp, label_fp, label = _write_pair(tmp_path)
+
+    # Not re-encoded
+    (image_data, shape), label_data = process_example(image_fp, label_fp)
+    assert image_data == image_fp.read_bytes()
+    assert shape == (60, 40, 3)
+    np.testing.assert_array_equal(_decode(label_data), label)
+
+    (image_data, shape), label_data = process_example(
+        image_fp, label_fp, size=20, crop_size=16, label_map=LABEL_MAP)
+    assert shape == (16, 16, 3)
+    assert _decode(image_data).shape == (16, 16, 3)
+
+    # Nearest neighbours of the resized label, center cropped and remapped
+    expected = np.array(Image.fromarray(label).resize((30, 20), Image.NEAREST))[2:18, 7:23]
+    expected = LABEL_MAP[expected]
+    label = _decode(label_data)
+    np.testing.assert_array_equal(label, expected)
+    assert set(np.unique(label)) <= {255, 0, 1, 13}
+    assert LABEL_MAP[0] == 255 and LABEL_MAP[7] == 0 and LABEL_MAP[26] == 13
+
+    with pytest.raises(ValueError):
+        process_example(image_fp, label_fp, label_map=np.where(LABEL_MAP == 255, -1, LABEL_MAP))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import tensorflow as tf
+from tensorflow.keras.metrics import Mean, SparseCategoricalAccuracy
+
+from hanser.train.cls import SuperLearner
+from hanser.train.callbacks import Callback
+
+
+class Interrupt(Exception):
+    pass
+
+
+class StepRecorder(Callback):
+
+    def __init__(self, interrupt_at=None):
+        super().__init__()
+        self.interrupt_at = interrupt_at
+        self.steps = []
+
+    def begin_batch(self, state):
+        if int(state['step']) == self.interrupt_at:
+            raise Interrupt()
+
+    def after_batch(self, state):
+        self.steps.append(int(state['step']))
+
+
+def _make_learner(work_dir, weights):
+    model = tf.keras.Sequential([tf.keras.layers.Dense(3, input_shape=(8,))])
+    model.set_weights(weights)
+    criterion = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    return SuperLearner(
+        model, criterion, tf.keras.optimizers.SGD(0.1, momentum=0.9), xla_compile=False,
+        train_metrics={'loss': Mean(), 'acc': SparseCategoricalAccuracy()},
+        eval_metrics={'acc': SparseCategoricalAccuracy()},
+        work_dir=work_dir)
+
+
+def test_resume_in_epoch(tmp_path):
+    x = np.random.normal(size=(64, 8)).astype(np.float32)
+    y = np.random.randint(0, 3, (64,))
+
+    def make_ds():
+        # Datasets of the same seed shuffle in the same order
+        return tf.data.Dataset.from_tensor_slices((x, y)).shuffle(64, seed=0).batch(8).repeat()
+    weights = tf.keras.Sequential([tf.keras.layers.Dense(3, input_shape=(8,))]).get_weights()
+    kwargs = dict(steps_per_epoch=8, step_save_freq=3)
+
+    full = _make_learner(tmp_path / "full", weights)
+    full.fit(make_ds(), 1, **kwargs)
+
+    # Step checkpoint is saved after step 3, the second one is not reached
+    interrupted = _make_learner(tmp_path / "resume", weights)
+    with pytest.raises(Interrupt):
+        interrupted.fit(make_ds(), 1, callbacks=[StepRecorder(interrupt_at=4)], **kwargs)
+
+    resumed = _make_learner(tmp_path / "resume", weights)
+    assert resumed.load()
+    assert resumed._resume_step[1] == 3
+    recorder = StepRecorder()
+    resumed.fit(make_ds(), 1, callbacks=[recorder], **kwargs)
+
+    assert recorder.steps == [3, 4, 5, 6, 7]
+    assert int(resumed.optimizers[0].iterations) == int(full.optimizers[0].iterations) == 8
+    for w1, w2 in zip(full.model.get_weights(), resumed.model.get_weights()):
+        np.testing.assert_allclose(w1, w2, rtol=1e-5, atol=1e-6)
+    for name in ['loss', 'acc']:
+        np.testing.assert_allclose(
+            resumed.metric_history.get_metric(name, "train", 0, 0),
+            full.metric_history.get_metric(name, "train", 0, 0), rtol=1e-5)
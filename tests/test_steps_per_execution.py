@@ -0,0 +1,63 @@
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras.metrics import Mean
+
+from hanser.train.cls import SuperLearner
+from hanser.train.callbacks import Callback
+
+
+class GraphCounter(Callback):
+    graph_safe = True
+
+    def __init__(self):
+        super().__init__()
+        self.begin = tf.Variable(0, dtype=tf.int32)
+        self.after = tf.Variable(0, dtype=tf.int32)
+        self.steps = tf.Variable(0, dtype=tf.int32)
+
+    def begin_batch(self, state):
+        self.begin.assign_add(1)
+
+    def after_batch(self, state):
+        self.after.assign_add(1)
+        self.steps.assign(state['step'])
+
+
+class HostCounter(Callback):
+
+    def __init__(self):
+        super().__init__()
+        self.begin = 0
+        self.steps = []
+
+    def begin_batch(self, state):
+        self.begin += 1
+
+    def after_batch(self, state):
+        self.steps.append(int(state['step']))
+
+
+def test_steps_per_execution(tmp_path):
+    x = np.random.normal(size=(64, 8)).astype(np.float32)
+    y = np.random.randint(0, 3, (64,))
+    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(8).repeat()
+
+    model = tf.keras.Sequential([tf.keras.layers.Dense(3, input_shape=(8,))])
+    criterion = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    learner = SuperLearner(
+        model, criterion, tf.keras.optimizers.SGD(0.1), xla_compile=False,
+        train_metrics={'loss': Mean()}, eval_metrics={},
+        work_dir=tmp_path, steps_per_execution=4)
+
+    graph_cbk, host_cbk = GraphCounter(), HostCounter()
+    learner.fit(ds, 2, steps_per_epoch=6, callbacks=[graph_cbk, host_cbk])
+
+    # 2 epochs of 6 steps, executions of 4 and 2 steps
+    assert int(learner.optimizers[0].iterations) == 12
+    assert int(learner._state['train']['step']) == 5
+    assert int(graph_cbk.begin) == int(graph_cbk.after) == 12
+    assert int(graph_cbk.steps) == 5
+    assert host_cbk.begin == 4
+    assert host_cbk.steps == [3, 5, 3, 5]
@@ -0,0 +1,27 @@
+import numpy as np
+
+import tensorflow as tf
+
+from hanser.datasets.tfrecord import IndexedTFRecordWriter, read_tfrecord_index, scan_tfrecord, \
+    count_records, sample_records
+
+
+def test_tfrecord_index(tmp_path):
+    filenames = []
+    k = 0
+    for shard in range(3):
+        fp = str(tmp_path / ("data-%d" % shard))
+        with IndexedTFRecordWriter(fp) as writer:
+            for i in range(5 + shard):
+                writer.write(b"record%d" % k * (k + 1))
+                k += 1
+        filenames.append(fp)
+
+    assert count_records(filenames) == k
+    np.testing.assert_array_equal(read_tfrecord_index(filenames[1]), scan_tfrecord(filenames[1]))
+
+    records = [r.numpy() for r in tf.data.TFRecordDataset(filenames)]
+    indices = [0, 17, 6, 3]
+    sampled = [r.numpy() for r in sample_records(filenames, indices=indices)]
+    assert sampled == [records[i] for i in sorted(indices)]
+    assert len(list(sample_records(filenames, 7, seed=0))) == 7
@@ -0,0 +1,72 @@
+"""Compare `batched_nms` with one `NonMaxSuppressionV5` per image and class.
+
+    python tools/benchmark_nms.py --batch-size 8 --num-bboxes 1000 --num-classes 80
+"""
+import time
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from hanser.detection.nms import batched_nms, nms_per_class
+
+
+def make_inputs(batch_size, num_bboxes, num_classes, seed=0):
+    rng = np.random.default_rng(seed)
+    yx = rng.uniform(0, 0.8, (batch_size, num_bboxes, 1, 2))
+    hw = rng.uniform(0.02, 0.3, (batch_size, num_bboxes, 1, 2))
+    bboxes = tf.constant(np.concatenate([yx, yx + hw], -1), tf.float32)
+    # Sigmoid-like scores, most of them below the score threshold
+    scores = tf.constant(rng.beta(0.3, 4, (batch_size, num_bboxes, num_classes)), tf.float32)
+    return bboxes, scores
+
+
+def per_class_fn(soft_nms_sigma, max_per_class, topk):
+    @tf.function
+    def fn(bboxes, scores):
+        outputs = [
+            nms_per_class(bboxes[i], scores[i], 0.5, 0.05, soft_nms_sigma, max_per_class, topk)
+            for i in range(bboxes.shape[0])
+        ]
+        return [tf.stack(y) for y in zip(*outputs)]
+    return fn
+
+
+def vectorized_fn(soft_nms_sigma, max_per_class, topk):
+    def fn(bboxes, scores):
+        return batched_nms(bboxes, scores, 0.5, 0.05, soft_nms_sigma, max_per_class, topk)
+    return fn
+
+
+def run(fn, bboxes, scores, repeats):
+    start = time.perf_counter()
+    fn(bboxes, scores)
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeats):
+        outputs = fn(bboxes, scores)
+    outputs[0].numpy()
+    return first, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--num-bboxes', type=int, default=1000)
+    parser.add_argument('--num-classes', type=int, default=80)
+    parser.add_argument('--max-per-class', type=int, default=100)
+    parser.add_argument('--topk', type=int, default=200)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    bboxes, scores = make_inputs(args.batch_size, args.num_bboxes, args.num_classes)
+    for soft_nms_sigma in [0.0, 0.5]:
+        for name, make_fn in [('per class', per_class_fn), ('vectorized', vectorized_fn)]:
+            fn = make_fn(soft_nms_sigma, args.max_per_class, args.topk)
+            first, elapsed = run(fn, bboxes, scores, args.repeats)
+            print("soft_nms_sigma=%.1f %-10s: first call (trace) %.2f s, %.2f ms/batch" % (
+                soft_nms_sigma, name, first, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,19 +36,33 @@ run the following command:
 python3 imagenet_to_gcs.py \
   --project="TEST_PROJECT" \
   --gcs_output_path="gs://TEST_BUCKET/IMAGENET_DIR" \
-  --raw_data_dir="path/to/imagenet"
+  --raw_data_dir="path/to/imagenet" \
+  --local_scratch_dir="path/to/tfrecords"
 ```
 
+Shards are converted in parallel by `num_workers` processes and written to
+`local_scratch_dir` with an index file (`{split}-index.json`) holding the number
+of examples, size and SHA-256 of every shard, and a sidecar index (`.idx`) of
+record offsets for each shard. Images can be downscaled so that the
+longer side is at most `max_size`. Conversion and upload are separate steps,
+converted shards can be uploaded later with `--upload_only`.
+
 """
 
+import io
+import json
 import math
 import os
 import random
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Iterable, List, Mapping, Union, Tuple
 from absl import app
 from absl import flags
 from absl import logging
 
+from PIL import Image
+
 import tensorflow.compat.v1 as tf
 
 from google.cloud import storage
@@ -64,6 +78,14 @@ flags.DEFINE_string(
                           'Should have train and validation subdirectories inside it.')
 flags.DEFINE_boolean(
     'gcs_upload', True, 'Set to false to not upload to gcs.')
+flags.DEFINE_boolean(
+    'upload_only', False, 'Upload shards already converted in local_scratch_dir.')
+flags.DEFINE_integer(
+    'num_workers', os.cpu_count(), 'Number of processes converting shards.')
+flags.DEFINE_integer(
+    'max_size', None, 'Downscale images so that the longer side is at most max_size.')
+flags.DEFINE_integer(
+    'jpeg_quality', 95, 'JPEG quality of re-encoded (fixed or resized) images.')
 
 FLAGS = flags.FLAGS
 
@@ -173,112 +195,113 @@ def _is_cmyk(filename: str) -> bool:
     return os.path.basename(filename) in blacklist
 
 
-class ImageCoder(object):
-    """Helper class that provides TensorFlow image coding utilities."""
-
-    def __init__(self):
-        # Create a single Session to run all image coding calls.
-        self._sess = tf.Session()
-
-        # Initializes function that converts PNG to JPEG data.
-        self._png_data = tf.placeholder(dtype=tf.string)
-        image = tf.image.decode_png(self._png_data, channels=3)
-        self._png_to_jpeg = tf.image.encode_jpeg(image, format='rgb', quality=100)
-
-        # Initializes function that converts CMYK JPEG data to RGB JPEG data.
-        self._cmyk_data = tf.placeholder(dtype=tf.string)
-        image = tf.image.decode_jpeg(self._cmyk_data, channels=0)
-        self._cmyk_to_rgb = tf.image.encode_jpeg(image, format='rgb', quality=100)
-
-        # Initializes function that decodes RGB JPEG data.
-        self._decode_jpeg_data = tf.placeholder(dtype=tf.string)
-        self._decode_jpeg = tf.image.decode_jpeg(self._decode_jpeg_data, channels=3)
-
-    def png_to_jpeg(self, image_data: bytes) -> tf.Tensor:
-        """Converts a PNG compressed image to a JPEG Tensor."""
-        return self._sess.run(self._png_to_jpeg,
-                              feed_dict={self._png_data: image_data})
-
-    def cmyk_to_rgb(self, image_data: bytes) -> tf.Tensor:
-        """Converts a CMYK image to RGB Tensor."""
-        return self._sess.run(self._cmyk_to_rgb,
-                              feed_dict={self._cmyk_data: image_data})
-
-    def decode_jpeg(self, image_data: bytes) -> tf.Tensor:
-        """Decodes a JPEG image."""
-        image = self._sess.run(self._decode_jpeg,
-                               feed_dict={self._decode_jpeg_data: image_data})
-        assert len(image.shape) == 3
-        assert image.shape[2] == 3
-        return image
+def _encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=quality)
+    return buf.getvalue()
 
 
 def _process_image(
-    filename: str, coder: ImageCoder) -> Tuple[str, int, int]:
+    filename: str, max_size: int = None, jpeg_quality: int = 95) -> Tuple[bytes, int, int]:
     """Processes a single image file.
 
     Args:
       filename: string, path to an image file e.g., '/path/to/example.JPG'.
-      coder: instance of ImageCoder to provide TensorFlow image coding utils.
+      max_size: integer, downscale the image if its longer side is larger.
+      jpeg_quality: integer, quality of re-encoded images.
 
     Returns:
-      image_buffer: string, JPEG encoding of RGB image.
+      image_buffer: bytes, JPEG encoding of RGB image.
       height: integer, image height in pixels.
       width: integer, image width in pixels.
 
     """
     # Read the image file.
-    with tf.gfile.FastGFile(filename, 'rb') as f:
+    with tf.gfile.GFile(filename, 'rb') as f:
         image_data = f.read()
 
+    # Only the header is read unless the image is converted.
+    image = Image.open(io.BytesIO(image_data))
+    reencode = False
+
     # Clean the dirty data.
     if _is_png(filename):
         # 1 image is a PNG.
         logging.info('Converting PNG to JPEG for %s', filename)
-        image_data = coder.png_to_jpeg(image_data)
-    elif _is_cmyk(filename):
+        image = image.convert('RGB')
+        reencode = True
+    elif _is_cmyk(filename) or image.mode == 'CMYK':
         # 22 JPEG images are in CMYK colorspace.
         logging.info('Converting CMYK to RGB for %s', filename)
-        image_data = coder.cmyk_to_rgb(image_data)
+        image = image.convert('RGB')
+        reencode = True
 
-    # Decode the RGB JPEG.
-    image = coder.decode_jpeg(image_data)
+    width, height = image.size
+    if max_size is not None and max(width, height) > max_size:
+        scale = max_size / max(width, height)
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        image = image.convert('RGB').resize((width, height), Image.BICUBIC, reducing_gap=3.0)
+        reencode = True
 
-    # Check that image converted to RGB
-    assert len(image.shape) == 3
-    height = image.shape[0]
-    width = image.shape[1]
-    assert image.shape[2] == 3
+    if reencode:
+        image_data = _encode_jpeg(image, jpeg_quality)
 
     return image_data, height, width
 
 
 def _process_image_files_batch(
-    coder: ImageCoder,
     output_file: str,
     filenames: Iterable[str],
     synsets: Iterable[Union[str, bytes]],
-    labels: Mapping[str, int]):
+    labels: Mapping[str, int],
+    max_size: int = None,
+    jpeg_quality: int = 95) -> Mapping[str, Union[str, int]]:
     """Processes and saves a list of images as TFRecords.
 
+    The shard is written to a temporary file and renamed when complete.
+
     Args:
-      coder: instance of ImageCoder to provide TensorFlow image coding utils.
       output_file: string, unique identifier specifying the data set.
       filenames: list of strings; each string is a path to an image file.
       synsets: list of strings; each string is a unique WordNet ID.
       labels: map of string to integer; id for all synset labels.
+      max_size: integer, downscale images if their longer side is larger.
+      jpeg_quality: integer, quality of re-encoded images.
 
-    """
-    writer = tf.python_io.TFRecordWriter(output_file)
-
-    for filename, synset in zip(filenames, synsets):
-        image_buffer, height, width = _process_image(filename, coder)
-        label = labels[synset]
-        example = _convert_to_example(filename, image_buffer, label,
-                                      synset, height, width)
-        writer.write(example.SerializeToString())
+    Returns:
+      Index entry of the shard with its name, number of examples, size and SHA-256.
 
-    writer.close()
+    """
+    tmp_file = output_file + '.tmp'
+    # Record offsets for the sidecar index (`hanser.datasets.tfrecord`), each record
+    # has a 12 bytes header and a 4 bytes footer.
+    entries = []
+    offset = 0
+    with tf.io.TFRecordWriter(tmp_file) as writer:
+        for filename, synset in zip(filenames, synsets):
+            image_buffer, height, width = _process_image(filename, max_size, jpeg_quality)
+            label = labels[synset]
+            example = _convert_to_example(filename, image_buffer, label,
+                                          synset, height, width)
+            record = example.SerializeToString()
+            writer.write(record)
+            entries.append((offset, len(record) + 16))
+            offset += len(record) + 16
+    num_examples = len(entries)
+    with open(output_file + '.idx', 'w') as f:
+        f.write(''.join('%d %d\n' % e for e in entries))
+
+    sha256 = hashlib.sha256()
+    with open(tmp_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    os.replace(tmp_file, output_file)
+    return {
+        'file': os.path.basename(output_file),
+        'num_examples': num_examples,
+        'bytes': os.path.getsize(output_file),
+        'sha256': sha256.hexdigest(),
+    }
 
 
 def _process_dataset(
@@ -287,9 +310,15 @@ def _process_dataset(
     labels: Mapping[str, int],
     output_directory: str,
     prefix: str,
-    num_shards: int) -> List[str]:
+    num_shards: int,
+    num_workers: int = 1,
+    max_size: int = None,
+    jpeg_quality: int = 95) -> List[str]:
     """Processes and saves list of images as TFRecords.
 
+    Shards are converted in parallel by `num_workers` processes, and an index file
+    `{prefix}-index.json` is written after all of them.
+
     Args:
       filenames: iterable of strings; each string is a path to an image file.
       synsets: iterable of strings; each string is a unique WordNet ID.
@@ -297,6 +326,9 @@ def _process_dataset(
       output_directory: path where output files should be created.
       prefix: string; prefix for each file.
       num_shards: number of chunks to split the filenames into.
+      num_workers: number of processes.
+      max_size: integer, downscale images if their longer side is larger.
+      jpeg_quality: integer, quality of re-encoded images.
 
     Returns:
       files: list of tf-record filepaths created from processing the dataset.
@@ -304,25 +336,56 @@ def _process_dataset(
     """
     _check_or_create_dir(output_directory)
     chunksize = int(math.ceil(len(filenames) / num_shards))
-    coder = ImageCoder()
 
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = []
+        for shard in range(num_shards):
+            chunk_files = filenames[shard * chunksize: (shard + 1) * chunksize]
+            chunk_synsets = synsets[shard * chunksize: (shard + 1) * chunksize]
+            output_file = os.path.join(
+                output_directory, '%s-%.5d-of-%.5d' % (prefix, shard, num_shards))
+            futures.append(executor.submit(
+                _process_image_files_batch, output_file, chunk_files, chunk_synsets, labels,
+                max_size, jpeg_quality))
+
+        shards = []
+        for future in futures:
+            shards.append(future.result())
+            logging.info('Finished writing file: %s', shards[-1]['file'])
+
+    index = {
+        'num_examples': sum(s['num_examples'] for s in shards),
+        'max_size': max_size,
+        'shards': shards,
+    }
+    index_file = os.path.join(output_directory, '%s-index.json' % prefix)
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=2)
+    return [os.path.join(output_directory, s['file']) for s in shards]
+
+
+def read_index(directory: str, prefix: str) -> List[str]:
+    """Reads the index written by `_process_dataset` and verifies shard sizes."""
+    with open(os.path.join(directory, '%s-index.json' % prefix)) as f:
+        index = json.load(f)
     files = []
-
-    for shard in range(num_shards):
-        chunk_files = filenames[shard * chunksize: (shard + 1) * chunksize]
-        chunk_synsets = synsets[shard * chunksize: (shard + 1) * chunksize]
-        output_file = os.path.join(
-            output_directory, '%s-%.5d-of-%.5d' % (prefix, shard, num_shards))
-        _process_image_files_batch(coder, output_file, chunk_files,
-                                   chunk_synsets, labels)
-        logging.info('Finished writing file: %s', output_file)
-        files.append(output_file)
+    for shard in index['shards']:
+        filename = os.path.join(directory, shard['file'])
+        if os.path.getsize(filename) != shard['bytes']:
+            raise ValueError('Shard %s is incomplete or corrupted.' % filename)
+        files.append(filename)
+        if os.path.exists(filename + '.idx'):
+            files.append(filename + '.idx')
+    files.append(os.path.join(directory, '%s-index.json' % prefix))
     return files
 
 
 def convert_to_tf_records(
     raw_data_dir: str,
-    local_scratch_dir: str) -> Tuple[List[str], List[str]]:
+    local_scratch_dir: str,
+    num_workers: int = 1,
+    max_size: int = None,
+    jpeg_quality: int = 95) -> Tuple[List[str], List[str]]:
     """Converts the Imagenet dataset into TF-Record dumps."""
 
     # Shuffle training records to ensure we are distributing classes
@@ -365,7 +428,7 @@ def convert_to_tf_records(
     training_records = _process_dataset(
         training_files, training_synsets, labels,
         os.path.join(local_scratch_dir, TRAINING_DIRECTORY),
-        TRAINING_DIRECTORY, TRAINING_SHARDS)
+        TRAINING_DIRECTORY, TRAINING_SHARDS, num_workers, max_size, jpeg_quality)
 
     # Create validation data
     # logging.info('Processing the validation data.')
@@ -397,13 +460,17 @@ def upload_to_gcs(training_records: Iterable[str],
     client = client if client else storage.Client(project=gcs_project)
     bucket = client.get_bucket(bucket_name)
 
+    def _upload_file(filename: str):
+        blob = bucket.blob(key_prefix + os.path.basename(filename))
+        blob.upload_from_filename(filename)
+        return filename
+
     def _upload_files(filenames: Iterable[str]):
         """Uploads a list of files into a specifc subdirectory."""
-        for i, filename in enumerate(sorted(filenames)):
-            blob = bucket.blob(key_prefix + os.path.basename(filename))
-            blob.upload_from_filename(filename)
-            if not i % 20:
-                logging.info('Finished uploading file: %s', filename)
+        with ThreadPoolExecutor(16) as executor:
+            for i, filename in enumerate(executor.map(_upload_file, sorted(filenames))):
+                if not i % 20:
+                    logging.info('Finished uploading file: %s', filename)
 
     # Upload training dataset
     logging.info('Uploading the training data.')
@@ -419,7 +486,11 @@ def run(raw_data_dir: str,
         gcs_project: str,
         gcs_output_path: str,
         local_scratch_dir: str,
-        client: storage.Client = None):
+        client: storage.Client = None,
+        upload_only: bool = False,
+        num_workers: int = 1,
+        max_size: int = None,
+        jpeg_quality: int = 95):
     """Runs the ImageNet preprocessing and uploading to GCS.
 
     Args:
@@ -429,6 +500,10 @@ def run(raw_data_dir: str,
       gcs_output_path: str, the GCS bucket to write to.
       local_scratch_dir: str, the local directory path.
       client: An optional storage client.
+      upload_only: bool, upload shards already converted in `local_scratch_dir`.
+      num_workers: int, number of processes converting shards.
+      max_size: int, downscale images so that the longer side is at most `max_size`.
+      jpeg_quality: int, quality of re-encoded images.
 
     """
     if gcs_upload and gcs_project is None:
@@ -439,6 +514,16 @@ def run(raw_data_dir: str,
     elif gcs_upload and not gcs_output_path.startswith('gs://'):
         raise ValueError('GCS output path must start with gs://')
 
+    if upload_only:
+        training_records = read_index(
+            os.path.join(local_scratch_dir, TRAINING_DIRECTORY), TRAINING_DIRECTORY)
+        upload_to_gcs(training_records=training_records,
+                      validation_records=[],
+                      gcs_output_path=gcs_output_path,
+                      gcs_project=gcs_project,
+                      client=client)
+        return
+
     if raw_data_dir is None:
         raise AssertionError(
             'The ImageNet download path is no longer supported. Please download '
@@ -448,10 +533,15 @@ def run(raw_data_dir: str,
     # training_records, validation_records = convert_to_tf_records(
     training_records = convert_to_tf_records(
         raw_data_dir=raw_data_dir,
-        local_scratch_dir=local_scratch_dir)
+        local_scratch_dir=local_scratch_dir,
+        num_workers=num_workers,
+        max_size=max_size,
+        jpeg_quality=jpeg_quality)
 
     # Upload to GCS
     if gcs_upload:
+        training_records = read_index(
+            os.path.join(local_scratch_dir, TRAINING_DIRECTORY), TRAINING_DIRECTORY)
         upload_to_gcs(training_records=training_records,
                       validation_records=[],
                       gcs_output_path=gcs_output_path,
@@ -464,7 +554,11 @@ def main(_):
         gcs_upload=FLAGS.gcs_upload,
         gcs_project=FLAGS.project,
         gcs_output_path=FLAGS.gcs_output_path,
-        local_scratch_dir=FLAGS.local_scratch_dir)
+        local_scratch_dir=FLAGS.local_scratch_dir,
+        upload_only=FLAGS.upload_only,
+        num_workers=FLAGS.num_workers,
+        max_size=FLAGS.max_size,
+        jpeg_quality=FLAGS.jpeg_quality)
 
 
 if __name__ == '__main__':
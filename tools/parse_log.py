@@ -1,4 +1,5 @@
 import argparse
+import json
 import re
 
 import numpy as np
@@ -6,7 +7,9 @@ from toolz.curried import map, curry
 from datetime import timedelta
 from dateutil.parser import parse
 
-from hhutil.io import read_lines
+from hhutil.io import read_lines, fmt_path
+
+from hanser.train.metric_history import read_log
 
 def dtime(end, start):
     end = parse(end)
@@ -83,9 +86,35 @@ def parse_log(fp):
 
     return train_start, train_metrics, valid_metrics
 
+def parse_metric_log(fp):
+    # metric_log.jsonl written by Learner, train start is in learner_state.json besides it
+    fp = fmt_path(fp)
+    history = read_log(fp)
+    train_start = json.loads((fp.parent / "learner_state.json").read_text())['train_start']
+
+    def stage_metrics(h, epochs):
+        metric_names = set(m for e in epochs for m in h.get(e, {}) if m != 'end')
+        d = {
+            m: np.array([h.get(e, {}).get(m, -1) for e in epochs]) for m in metric_names
+        }
+        d['time'] = [h.get(e, {}).get('end') for e in epochs]
+        return d
+
+    epochs = sorted(history['train'].keys())
+    train_metrics = stage_metrics(history['train'], epochs)
+    valid_metrics = stage_metrics(history.get('eval', {}), epochs)
+
+    train_ends, valid_ends = train_metrics['time'], valid_metrics['time']
+    for i in range(len(train_ends)):
+        if valid_ends[i] is None:
+            valid_ends[i] = train_ends[i]
+
+    return train_start, train_metrics, valid_metrics
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-k','--key', type=str, required=True)
-parser.add_argument('-f','--log', type=str, help='Log file', required=True)
+parser.add_argument('-f','--log', type=str, help='Log file or metric_log.jsonl', required=True)
 parser.add_argument('--mode', choices=["final", "max", "all"], default='all')
 args = parser.parse_args()
 
@@ -98,7 +127,10 @@ def estimate_epoch_train_time(train_ends, valid_ends):
 
 
 log_file = args.log
-train_start, train_metrics, valid_metrics = parse_log(log_file)
+if log_file.endswith(".jsonl"):
+    train_start, train_metrics, valid_metrics = parse_metric_log(log_file)
+else:
+    train_start, train_metrics, valid_metrics = parse_log(log_file)
 epoch_train_time = estimate_epoch_train_time(train_metrics['time'], valid_metrics['time'])
 total_cost = timedelta(seconds=dtime(valid_metrics['time'][-1], train_start).seconds)
 main_valid_metrics = valid_metrics[args.key] * 100
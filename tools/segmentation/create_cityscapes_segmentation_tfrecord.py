@@ -2,6 +2,7 @@ import re
 import argparse
 from hhutil.io import fmt_path, eglob, copy
 from hanser.datasets.segmentation.tfrecord import convert_segmentation_dataset
+from hanser.datasets.segmentation.cityscapes import LABEL_MAP
 
 def create_split_file(image_dir, target):
     image_ids = [
@@ -28,6 +29,9 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output_dir', help='output path')
     parser.add_argument('-s', '--split', help='split')
     parser.add_argument('-n', '--num_shards', help='number of shards')
+    parser.add_argument('-w', '--num_workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--size', type=int, default=None, help='resize the shorter side')
+    parser.add_argument('--map_label', action='store_true', help='store train ids instead of label ids')
     args = parser.parse_args()
 
     root = fmt_path(args.root)
@@ -44,5 +48,7 @@ if __name__ == '__main__':
         split_f, output_dir, image_dir, label_dir,
         image_format="png", label_format="png", num_shards=num_shards,
         image_stem_transform=image_stem_transform,
-        label_stem_transform=label_stem_transform
-    )
\ No newline at end of file
+        label_stem_transform=label_stem_transform,
+        num_workers=args.num_workers, size=args.size,
+        label_map=LABEL_MAP if args.map_label else None,
+    )
@@ -9,6 +9,8 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output_dir', help='output path')
     parser.add_argument('-p', '--part', help='part')
     parser.add_argument('-n', '--num_shards', help='number of shards')
+    parser.add_argument('-w', '--num_workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--size', type=int, default=None, help='resize the shorter side')
     args = parser.parse_args()
 
     root = fmt_path(args.root)
@@ -20,4 +22,5 @@ if __name__ == '__main__':
     image_dir = root / 'JPEGImages'
     label_dir = root / root / 'SegmentationClassAug'
 
-    convert_segmentation_dataset(split_f, output_dir, image_dir, label_dir, num_shards=num_shards)
\ No newline at end of file
+    convert_segmentation_dataset(split_f, output_dir, image_dir, label_dir, num_shards=num_shards,
+        num_workers=args.num_workers, size=args.size)